@@ -0,0 +1,644 @@
+#!/usr/bin/env python
+"""Asynchronous counterpart of upload.HttpRpcServer.
+
+AsyncRpcServer sends many RPCs concurrently from a single thread. It runs an
+asyncore event loop over a few keep-alive connections instead of using one
+thread per request. upload.py uses it for the base file and separate patch
+uploads with --async_uploads.
+
+Send semantics are the same as upload.AbstractRpcServer.Send: it shares the
+wrapped server's host, cookie jar, extra headers, authentication lock,
+RetryPolicy and RpcStats, re-authenticates on 401/302 unless
+request_password_if_302 is False, and follows 301s by switching hosts.
+
+Usage:
+  rpc_server = upload.GetRpcServer(server)
+  async_server = async_rpc.AsyncRpcServer(rpc_server)
+  html = async_server.SendAsync("/%d" % issue)
+  api_data = async_server.SendAsync("/api/%d" % issue)
+  async_server.Run()
+  print html.Result(), api_data.Result()
+
+Futures may be chained with AddDoneCallback; callbacks run between event
+loop iterations and may call SendAsync again. An exception raised by a
+callback stops Run() and is raised from it. Proxies are not supported; use
+HttpRpcServer behind a proxy (see IsSupported).
+"""
+
+import asyncore
+import collections
+import errno
+import heapq
+import httplib
+import logging
+import select
+import socket
+import ssl
+import sys
+import time
+import urllib
+import urllib2
+import urlparse
+
+try:
+  import cStringIO as StringIO
+except ImportError:
+  import StringIO
+
+import upload
+
+
+class RpcFuture(object):
+  """The eventual response body (or error) of an asynchronous RPC."""
+
+  def __init__(self):
+    self._done = False
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+
+  def Done(self):
+    """Returns True once the RPC has finished, successfully or not."""
+    return self._done
+
+  def Result(self):
+    """Returns the response body, or raises the error the RPC failed with.
+
+    Raises:
+      RuntimeError: If the RPC hasn't finished; call AsyncRpcServer.Run().
+    """
+    if not self._done:
+      raise RuntimeError("RPC not finished; call AsyncRpcServer.Run() first")
+    if self._exc_info:
+      exc_type, exc_value, exc_traceback = self._exc_info
+      raise exc_type, exc_value, exc_traceback
+    return self._result
+
+  def AddDoneCallback(self, callback):
+    """Calls callback(future) when the RPC finishes, or now if it has."""
+    if self._done:
+      callback(self)
+    else:
+      self._callbacks.append(callback)
+
+  def _Finish(self, result=None, exc_info=None):
+    self._done = True
+    self._result = result
+    self._exc_info = exc_info
+    callbacks, self._callbacks = self._callbacks, []
+    for callback in callbacks:
+      callback(self)
+
+
+class _Request(object):
+  """State of one RPC across authentication, redirects and retries."""
+
+  def __init__(self, request_path, payload, headers, timeout, idempotent,
+               request_password_if_302, query, start_time):
+    self.request_path = request_path
+    self.payload = payload
+    self.headers = headers
+    self.timeout = timeout
+    self.idempotent = idempotent
+    self.request_password_if_302 = request_password_if_302
+    self.query = query
+    self.future = RpcFuture()
+    self.tries = 0
+    self.retries = 0
+    self.start_time = start_time
+    self.deadline = None
+    # The rpc_server's AuthGeneration() when the last try was sent.
+    self.auth_generation = None
+    # The same metrics as AbstractRpcServer.Send records in RpcStats.
+    self.stats = {"method": payload is None and "GET" or "POST",
+                  "path": upload.RpcStats.PathTemplate(request_path),
+                  "status": 0, "bytes_sent": 0, "bytes_received": 0,
+                  "ttfb": None, "latency": 0.0, "retries": 0,
+                  "authentications": 0, "auth_seconds": 0.0}
+    self.wall_start = time.time()
+
+
+def _IsClosedByServer(conn):
+  """Whether the server closed an idle connection, or sent on it unasked."""
+  try:
+    return bool(select.select([conn.socket], [], [], 0)[0])
+  except (select.error, socket.error, ValueError):
+    return True
+
+
+def _IsWouldBlock(error):
+  """Returns True if a non-blocking socket or SSL call needs to wait."""
+  if isinstance(error, ssl.SSLError):
+    return error.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                             ssl.SSL_ERROR_WANT_WRITE)
+  return error.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class _HttpConnection(asyncore.dispatcher):
+  """A non-blocking HTTP/1.1 connection carrying one request at a time."""
+
+  def __init__(self, owner, scheme, netloc, socket_map):
+    asyncore.dispatcher.__init__(self, map=socket_map)
+    self.owner = owner
+    self.key = (scheme, netloc)
+    self.request = None
+    self.reused = False
+    self.tls = scheme == "https"
+    self.handshaking = False
+    host, port = urllib.splitport(netloc)
+    if port:
+      port = int(port)
+    else:
+      port = self.tls and 443 or 80
+    self.host = host
+    try:
+      family, socktype, proto, unused, address = socket.getaddrinfo(
+          host, port, 0, socket.SOCK_STREAM)[0]
+      self.create_socket(family, socktype)
+      self.connect(address)
+    except socket.error:
+      if self.socket is not None:
+        self.close()
+      raise
+
+  # asyncore.dispatcher forwards unknown attributes to its socket, which
+  # changes when TLS wraps it; keep identity stable for set membership.
+  def __hash__(self):
+    return id(self)
+
+  def __eq__(self, other):
+    return self is other
+
+  def __ne__(self, other):
+    return self is not other
+
+  # Sending.
+
+  def Start(self, request, method, selector, headers):
+    """Sends a request on this connection."""
+    self.request = request
+    lines = ["%s %s HTTP/1.1" % (method, selector)]
+    lines.extend("%s: %s" % item for item in headers.items())
+    self.out_buffer = "\r\n".join(lines) + "\r\n\r\n"
+    self.body_source = None
+    payload = request.payload
+    if hasattr(payload, "read"):
+      payload.seek(0)
+      self.body_source = payload
+    elif payload is not None:
+      self.out_buffer += payload
+    self.status = None
+    self.response_headers = None
+    self.in_buffer = ""
+    self.body = []
+    self.body_length = 0
+    self.content_length = None
+    self.chunked = False
+    self.chunk_remaining = None
+    self.received_any = False
+    self.sent_all = False
+    self.try_start = time.time()
+    self.first_byte_time = None
+
+  def writable(self):
+    if not self.connected or self.handshaking:
+      return True
+    return bool(self.request and (self.out_buffer or self.body_source))
+
+  def handle_connect(self):
+    if self.tls:
+      context = self.owner.ssl_context
+      self.socket = context.wrap_socket(self.socket,
+                                        do_handshake_on_connect=False,
+                                        server_hostname=self.host)
+      self.handshaking = True
+
+  def _Handshake(self):
+    try:
+      self.socket.do_handshake()
+    except (ssl.SSLError, socket.error), e:
+      if _IsWouldBlock(e):
+        return
+      raise
+    self.handshaking = False
+
+  def handle_write(self):
+    if self.handshaking:
+      self._Handshake()
+      return
+    if not self.out_buffer and self.body_source:
+      self.out_buffer = self.body_source.read(64 * 1024)
+      if not self.out_buffer:
+        self.body_source = None
+        self.sent_all = True
+        return
+    try:
+      sent = self.socket.send(self.out_buffer)
+    except (ssl.SSLError, socket.error), e:
+      if _IsWouldBlock(e):
+        return
+      raise
+    self.out_buffer = self.out_buffer[sent:]
+    if not self.out_buffer and not self.body_source:
+      self.sent_all = True
+
+  # Receiving.
+
+  def handle_read(self):
+    if self.handshaking:
+      self._Handshake()
+      return
+    while True:
+      try:
+        data = self.socket.recv(64 * 1024)
+      except (ssl.SSLError, socket.error), e:
+        if _IsWouldBlock(e):
+          return
+        raise
+      if not data:
+        self.handle_close()
+        return
+      if self.request is None:
+        # Nothing is expected on an idle connection.
+        self.handle_close()
+        return
+      if not self.received_any:
+        self.received_any = True
+        self.first_byte_time = time.time()
+      self._Feed(data)
+      if not self.tls or not self.socket.pending():
+        return
+
+  def _Feed(self, data):
+    if self.response_headers is None:
+      self.in_buffer += data
+      while self.response_headers is None:
+        end = self.in_buffer.find("\r\n\r\n")
+        if end < 0:
+          return
+        head, self.in_buffer = (self.in_buffer[:end],
+                                self.in_buffer[end + 4:])
+        self._ParseHead(head)
+      data, self.in_buffer = self.in_buffer, ""
+      if self._BodyComplete(data):
+        self._Complete()
+    elif self._BodyComplete(data):
+      self._Complete()
+
+  def _ParseHead(self, head):
+    status_line, unused, header_text = head.partition("\r\n")
+    parts = status_line.split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+      raise httplib.BadStatusLine(status_line)
+    self.version = parts[0]
+    status = int(parts[1])
+    if status == 100:
+      return
+    self.status = status
+    self.reason = len(parts) > 2 and parts[2] or ""
+    self.response_headers = httplib.HTTPMessage(
+        StringIO.StringIO(header_text + "\r\n\r\n"))
+    transfer_encoding = self.response_headers.get("transfer-encoding", "")
+    self.chunked = transfer_encoding.lower() == "chunked"
+    if (self.request.method == "HEAD" or status in (204, 304) or
+        100 <= status < 200):
+      self.content_length = 0
+    elif not self.chunked and "content-length" in self.response_headers:
+      self.content_length = int(self.response_headers["content-length"])
+
+  def _BodyComplete(self, data):
+    """Consumes body data; returns True once the body is complete."""
+    if self.chunked:
+      self.in_buffer += data
+      while True:
+        if self.chunk_remaining is None:
+          end = self.in_buffer.find("\r\n")
+          if end < 0:
+            return False
+          size = int(self.in_buffer[:end].split(";")[0], 16)
+          if size == 0:
+            # Wait for the (usually empty) trailer section.
+            if self.in_buffer[end + 2:end + 4] == "\r\n":
+              return True
+            return self.in_buffer.find("\r\n\r\n", end) >= 0
+          self.in_buffer = self.in_buffer[end + 2:]
+          self.chunk_remaining = size
+        if len(self.in_buffer) < self.chunk_remaining + 2:
+          return False
+        self.body.append(self.in_buffer[:self.chunk_remaining])
+        self.in_buffer = self.in_buffer[self.chunk_remaining + 2:]
+        self.chunk_remaining = None
+    if data:
+      self.body.append(data)
+      self.body_length += len(data)
+    return (self.content_length is not None and
+            self.body_length >= self.content_length)
+
+  def _WillClose(self):
+    connection = self.response_headers.get("connection", "").lower()
+    if connection == "close":
+      return True
+    return self.version == "HTTP/1.0" and connection != "keep-alive"
+
+  def _Complete(self):
+    request, self.request = self.request, None
+    response = (self.status, self.reason, self.response_headers,
+                "".join(self.body))
+    request.stats["status"] = self.status
+    request.stats["bytes_received"] += len(response[3])
+    request.stats["ttfb"] = self.first_byte_time - self.try_start
+    if self._WillClose():
+      self.close()
+    self.owner._OnDone(self, request, response=response)
+
+  def handle_close(self):
+    request = self.request
+    if request is None:
+      self.close()
+      self.owner._OnDone(self, None)
+      return
+    if self.response_headers is not None and self.content_length is None \
+        and not self.chunked:
+      # The body was delimited by the connection closing.
+      self._Complete()
+      return
+    self.request = None
+    self.close()
+    # The server dropped the idle keep-alive connection, as in
+    # upload.KeepAliveHandlerMixin. A request sent completely is only sent
+    # again if it is idempotent: the server may have handled it.
+    if (self.reused and not self.received_any and
+        (request.idempotent or not self.sent_all)):
+      self.owner._OnDone(self, request, resend=True)
+      return
+    error = httplib.IncompleteRead("".join(self.body)) if \
+        self.response_headers else httplib.BadStatusLine("")
+    self.owner._OnDone(self, request, error=urllib2.URLError(error))
+
+  def handle_error(self):
+    exc_info = sys.exc_info()
+    request, self.request = self.request, None
+    self.close()
+    error = exc_info[1]
+    if not isinstance(error, urllib2.URLError):
+      error = urllib2.URLError(error)
+    self.owner._OnDone(self, request, error=error)
+
+  def Fail(self, error):
+    """Aborts the current request, e.g. on a timeout."""
+    request, self.request = self.request, None
+    self.close()
+    self.owner._OnDone(self, request, error=urllib2.URLError(error))
+
+
+class _CookieResponse(object):
+  """Just enough of a urllib2 response for cookielib.extract_cookies."""
+
+  def __init__(self, headers):
+    self._headers = headers
+
+  def info(self):
+    return self._headers
+
+
+def IsSupported(rpc_server):
+  """Returns False if rpc_server's requests would have to go via a proxy."""
+  scheme = urlparse.urlparse(rpc_server.host)[0]
+  return scheme not in urllib.getproxies()
+
+
+class AsyncRpcServer(object):
+  """Issues RPCs for an upload.AbstractRpcServer on one event loop."""
+
+  def __init__(self, rpc_server, max_connections=8, ssl_context=None):
+    """Creates a new AsyncRpcServer.
+
+    Args:
+      rpc_server: The AbstractRpcServer whose host, authentication, cookies
+        and retry policy are used.
+      max_connections: Maximum number of requests in flight at once.
+      ssl_context: ssl.SSLContext for https connections. Defaults to one
+        that verifies certificates against the system's CA store.
+    """
+    self.rpc_server = rpc_server
+    self.max_connections = max_connections
+    if ssl_context is None:
+      ssl_context = ssl.create_default_context()
+    self.ssl_context = ssl_context
+    self._map = {}
+    self._queue = collections.deque()
+    self._timers = []
+    self._idle = []
+    self._busy = set()
+    self._finished = []
+
+  def SendAsync(self, request_path, payload=None,
+                content_type="application/octet-stream",
+                timeout=None,
+                extra_headers=None,
+                content_encoding=None,
+                idempotent=None,
+                request_password_if_302=True,
+                **kwargs):
+    """Starts an RPC and returns an RpcFuture for its response body.
+
+    Takes the same arguments as upload.AbstractRpcServer.Send. Nothing is
+    sent until Run() is called.
+    """
+    clock = self.rpc_server.retry_policy.clock
+    start_time = clock()
+    if not self.rpc_server.authenticated:
+      authenticated = self.rpc_server.EnsureAuthenticated()
+      auth_seconds = clock() - start_time
+    else:
+      authenticated = False
+    headers = dict(self.rpc_server.extra_headers)
+    headers["Content-Type"] = content_type
+    if content_encoding and payload is not None:
+      payload = upload.CompressBody(payload, content_encoding)
+      headers["Content-Encoding"] = content_encoding
+    if extra_headers:
+      headers.update(extra_headers)
+    if idempotent is None:
+      idempotent = payload is None
+    request = _Request(request_path, payload, headers, timeout, idempotent,
+                       request_password_if_302, kwargs, start_time)
+    if authenticated:
+      request.stats["authentications"] += 1
+      request.stats["auth_seconds"] += auth_seconds
+    self._queue.append(request)
+    return request.future
+
+  def Send(self, request_path, payload=None, **kwargs):
+    """Sends one RPC, runs the loop until it is done and returns the body."""
+    future = self.SendAsync(request_path, payload, **kwargs)
+    self.Run()
+    return future.Result()
+
+  def Run(self):
+    """Runs the event loop until every started RPC has finished."""
+    while self._queue or self._busy or self._timers or self._finished:
+      now = time.time()
+      while self._timers and self._timers[0][0] <= now:
+        self._queue.append(heapq.heappop(self._timers)[2])
+      self._Dispatch()
+      if self._busy:
+        asyncore.loop(timeout=0.2, map=self._map, count=1)
+        self._CheckDeadlines()
+      elif self._timers and not self._finished:
+        time.sleep(max(0, self._timers[0][0] - time.time()))
+      finished, self._finished = self._finished, []
+      for request, response, error in finished:
+        self._Finish(request, response, error)
+
+  def Close(self):
+    """Closes all connections, abandoning any RPC still in flight.
+
+    Called after Run(), or when Run() raised, e.g. from a callback.
+    """
+    for conn in self._idle + list(self._busy):
+      conn.close()
+    self._idle = []
+    self._busy = set()
+    self._queue.clear()
+    self._timers = []
+    self._finished = []
+
+  def _Dispatch(self):
+    while self._queue:
+      request = self._queue[0]
+      url = self.rpc_server.host + request.request_path
+      if request.query:
+        url += "?" + urllib.urlencode(request.query)
+      scheme, netloc = urlparse.urlparse(url)[:2]
+      conn = None
+      for idle in list(self._idle):
+        if idle.key != (scheme, netloc) or not idle.connected:
+          continue
+        if _IsClosedByServer(idle):
+          self._idle.remove(idle)
+          idle.close()
+          continue
+        conn = idle
+        conn.reused = True
+        break
+      if conn is not None:
+        self._idle.remove(conn)
+      elif len(self._busy) + len(self._idle) < self.max_connections:
+        try:
+          conn = _HttpConnection(self, scheme, netloc, self._map)
+        except socket.error, e:
+          self._queue.popleft()
+          request.tries += 1
+          request.url = url
+          self._finished.append((request, None, urllib2.URLError(e)))
+          continue
+      elif self._idle:
+        # Make room by dropping an idle connection to another host.
+        self._idle.pop(0).close()
+        continue
+      else:
+        return
+      self._queue.popleft()
+      self._busy.add(conn)
+      request.tries += 1
+      if request.timeout:
+        request.deadline = time.time() + request.timeout
+      request.method = request.payload is None and "GET" or "POST"
+      request.url = url
+      request.auth_generation = self.rpc_server.AuthGeneration()
+      request.stats["retries"] = request.retries
+      headers = dict(request.headers)
+      headers["Host"] = self.rpc_server.host_override or netloc
+      headers["Connection"] = "keep-alive"
+      headers["Accept-Encoding"] = "identity"
+      if request.payload is not None:
+        headers["Content-Length"] = str(len(request.payload))
+        request.stats["bytes_sent"] += len(request.payload)
+      request.cookie_request = self._AddCookieHeader(url, headers)
+      selector = urlparse.urlunparse(("", "") + urlparse.urlparse(url)[2:])
+      conn.Start(request, request.method, selector, headers)
+
+  def _AddCookieHeader(self, url, headers):
+    """Adds the cookie jar's cookies; returns the urllib2.Request used."""
+    cookie_jar = getattr(self.rpc_server, "cookie_jar", None)
+    if cookie_jar is None:
+      return None
+    cookie_request = urllib2.Request(url)
+    cookie_jar.add_cookie_header(cookie_request)
+    if cookie_request.has_header("Cookie"):
+      headers["Cookie"] = cookie_request.get_header("Cookie")
+    return cookie_request
+
+  def _CheckDeadlines(self):
+    now = time.time()
+    for conn in list(self._busy):
+      request = conn.request
+      if request and request.deadline and now > request.deadline:
+        conn.Fail(socket.timeout("timed out"))
+
+  def _OnDone(self, conn, request, response=None, error=None, resend=False):
+    """Called by a connection when its request finished or it closed."""
+    self._busy.discard(conn)
+    if conn in self._idle:
+      self._idle.remove(conn)
+    if conn.connected:
+      self._idle.append(conn)
+    if request is None:
+      return
+    if resend:
+      request.tries -= 1
+      self._queue.appendleft(request)
+      return
+    self._finished.append((request, response, error))
+
+  def _Finish(self, request, response, error):
+    """Applies Send's auth, redirect and retry rules to a finished try."""
+    if error is None:
+      status, reason, headers, body = response
+      if request.cookie_request is not None:
+        self.rpc_server.cookie_jar.extract_cookies(_CookieResponse(headers),
+                                                   request.cookie_request)
+      if 200 <= status < 300:
+        self._Record(request)
+        request.future._Finish(result=body)
+        return
+      error = urllib2.HTTPError(request.url, status, reason, headers,
+                                StringIO.StringIO(body))
+    else:
+      request.stats["status"] = 0
+    policy = self.rpc_server.retry_policy
+    delay = policy.NextDelay(error, request.idempotent, request.retries,
+                             request.start_time)
+    if delay is not None:
+      request.retries += 1
+      upload.StatusUpdate("Error sending %s (%s), retrying in %.1fs..." %
+                          (request.request_path, error, delay))
+      heapq.heappush(self._timers, (time.time() + delay, id(request),
+                                    request))
+      return
+    if isinstance(error, urllib2.HTTPError) and request.tries <= 3:
+      if error.code in (401, 302) and request.request_password_if_302:
+        clock = self.rpc_server.retry_policy.clock
+        auth_start = clock()
+        if self.rpc_server.EnsureAuthenticated(request.auth_generation):
+          request.stats["authentications"] += 1
+          request.stats["auth_seconds"] += clock() - auth_start
+        self._queue.append(request)
+        return
+      if error.code == 301:
+        # Handle permanent redirect manually, like Send.
+        url_loc = urlparse.urlparse(error.info()["location"])
+        self.rpc_server.host = "%s://%s" % (url_loc[0], url_loc[1])
+        self._queue.append(request)
+        return
+    logging.debug("Async RPC %s failed: %s", request.request_path, error)
+    self._Record(request)
+    try:
+      raise error
+    except Exception:
+      request.future._Finish(exc_info=sys.exc_info())
+
+  def _Record(self, request):
+    request.stats["latency"] = time.time() - request.wall_start
+    self.rpc_server.stats.Record(request.stats)
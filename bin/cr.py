@@ -61,7 +61,8 @@ try:
 except ImportError, err:
     print >> sys.stderr, ("%s. Please make sure Rietveld's upload.py "
                           "exists and is in the PYTHONPATH" % err)
-from upload import (ErrorExit, RunShell, RunShellWithReturnCode, StatusUpdate)
+from upload import (ErrorExit, GetEnvironmentInt, RunShell,
+                    RunShellWithReturnCode, StatusUpdate)
 
 # global configurations
 SVN = "svn"
@@ -73,6 +74,10 @@ SVN_REPOSITORY_URL = os.environ.get('CR_SVN_REPOSITORY_URL', None)
 GIT_REPO_REGEX = os.environ.get('CR_GIT_REPO_REGEX', "__invalid_regex__")
 GIT_HTTP_URL = os.environ.get('CR_GIT_HTTP_URL', "")
 GIT_BASE_URL = os.environ.get('CR_GIT_BASE_URL', "")
+# seconds a cached issue page is reused without asking the server again
+CACHE_TTL = GetEnvironmentInt('CR_CACHE_TTL', 0, 0)
+# default limit on concurrent server requests of 'cr issues'
+MAX_IN_FLIGHT = GetEnvironmentInt('CR_MAX_IN_FLIGHT', 8, 1)
 logging.basicConfig(level=(logging.DEBUG if os.environ.get('DEBUG', None)
                            else logging.ERROR),
                     format=('%(asctime)s:%(levelname)s:'
@@ -134,12 +139,20 @@ class CrOptionParser(object):
                             metavar="ISSUE", default=None,
                             help="Issue number to which to add. "
                                  "Defaults to new issue.")
+    option_group.add_option("--resume", action="store_true", dest="resume",
+                            default=False,
+                            help="Continue an interrupted upload of the "
+                                 "same diff.")
     parser.add_option("--force", action="store_true",
                       dest="force", default=False,
                       help="Force commit without LGTM. Use with care!")
     parser.add_option("--difffile", action="store",
                       dest="difffile", default=None,
                       help="Use user's own diff file for debugging purpose.")
+    parser.add_option("-j", "--jobs", type="int", action="store",
+                      dest="jobs", default=MAX_IN_FLIGHT,
+                      help="Number of concurrent requests to the server "
+                           "(cr issues).")
 
 class FileInfo(object):
     """ A simple container for file information. """
@@ -207,15 +220,10 @@ class CrBaseVCS(object):
     CMD = None
 
     @staticmethod
-    def GetGoofySubjectHeader(diff):
-        """ Given a diff, return a subject liner pertaining to the diff """
-        add = 0
-        sub = 0
-        for l in diff.splitlines():
-            if re.match(r'^\+[^\+]', l):
-                add += 1
-            if re.match(r'^\-[^\-]', l):
-                sub += 1
+    def GetGoofySubjectHeader(diff_stats):
+        """ Given upload.DiffStats, return a subject liner for the diff """
+        add = diff_stats.added
+        sub = diff_stats.removed
 
         # "change_velocity" is an indicator as to how much the code changed.
         # One cannot simply use "lines_added" because there is a case such that
@@ -266,9 +274,9 @@ class CrBaseVCS(object):
                                '.java': 'java'}
         warn_msg = []
         err_msg = []
-        for line in diff.splitlines():
-            # TODO(kevinx): This is for svn. Take care of git.
-            m = re.match(r'^Index: (.+(\.\w+))$', line, re.IGNORECASE)
+        parsed_diff = upload.ParseDiff(diff)
+        for file_diff in parsed_diff.files:
+            m = re.match(r'^(.+(\.\w+))$', file_diff.filename)
             if m:
                 file_name = m.group(1)
                 file_suffix = m.group(2).lower()
@@ -276,17 +284,20 @@ class CrBaseVCS(object):
                     language = file_suffix_mapping[file_suffix]
                 else:
                     language = 'others'
-                # only check constraints for new lines
-            if not re.match(r"\+[^\+]", line):
-                continue
-            if (not allow_tabs
-                    and re.search(r"\t", line)
-                    and re.match(r'Makefile$', file_name, re.IGNORECASE)):
-                line = line.replace("\t", "[BADTAB]")
-                err_msg.append("Tab detected(%s):%s" % (file_name, line))
-            if len(line) - 1 > max_cols[language]:
-                warn_msg.append("Exceed %d cols(%s):%s" %
-                                (max_cols[language], file_name, line))
+            check_tabs = (not allow_tabs and
+                          re.match(r'Makefile$', file_name, re.IGNORECASE))
+            # only check constraints for new lines
+            for start, end in file_diff.added_lines:
+                if (end - start - 1 <= max_cols[language]
+                        and not check_tabs):
+                    continue
+                line = parsed_diff.text[start:end]
+                if check_tabs and "\t" in line:
+                    line = line.replace("\t", "[BADTAB]")
+                    err_msg.append("Tab detected(%s):%s" % (file_name, line))
+                if len(line) - 1 > max_cols[language]:
+                    warn_msg.append("Exceed %d cols(%s):%s" %
+                                    (max_cols[language], file_name, line))
         return err_msg, warn_msg
 
     def getBaseUrl(self, branch=None):
@@ -324,6 +335,13 @@ class CrBaseVCS(object):
     def moveFilesToChangelist(self, file_list, changelist_name):
         raise NotImplementedError("Please override moveFilesToChangelist")
 
+    def getIssueChangelists(self):
+        """
+        Return a list of (issue number, changelist name) for the local
+        changelists or branches that were uploaded as 'issue<num>'
+        """
+        raise NotImplementedError("Please override getIssueChangelists")
+
 
 class SubversionVCS(CrBaseVCS, upload.SubversionVCS):
     """ Inherit both CrBaseVCS and the base SubversionVCS """
@@ -337,11 +355,9 @@ class SubversionVCS(CrBaseVCS, upload.SubversionVCS):
         # (the ones with a "+" symbol) do not show up on diff. The only
         # way for them to show up is if the content also changed.
         files_in_diff = {}
-        for line in diff_output.splitlines():
-            m = re.match(r"Index: (.+)", line)
-            if m:
-                filename = m.group(1)
-                files_in_diff[filename] = True
+        for file_diff in upload.ParseDiff(diff_output).files:
+            if file_diff.header.startswith("Index: "):
+                files_in_diff[file_diff.filename] = True
         err_msgs = []
         for filename in files_in_diff.keys():
             if not os.path.islink(filename) and not filename in files_in_diff:
@@ -436,6 +452,14 @@ get around the problem by adding a bogus empty line to these files.""" %
 
         return changelist_to_filegroupinfo
 
+    def getIssueChangelists(self):
+        issue_changelists = []
+        for changelist in self.getFileGroupInfo():
+            m = re.match(r'issue(\d+)$', changelist or "")
+            if m:
+                issue_changelists.append((int(m.group(1)), changelist))
+        return sorted(issue_changelists)
+
     def moveFilesToChangelist(self, file_list, changelist_name):
         """ Move a bunch of files to a changelist using svn native command """
         if len(file_list) and self.options.changelist is None:
@@ -476,6 +500,7 @@ class GitVCS(CrBaseVCS, upload.GitVCS):
         env = os.environ.copy()
         if 'GIT_EXTERNAL_DIFF' in env:
             del env['GIT_EXTERNAL_DIFF']
+        self.diff_args = extra_args
         # Changed(open42): removed --cached to allow branches
         return RunShell([GIT, "diff", "--no-ext-diff", "--no-color",
                          "--full-index", "-M"]
@@ -607,6 +632,16 @@ class GitVCS(CrBaseVCS, upload.GitVCS):
 
         return changelist_to_filegroupinfo
 
+    def getIssueChangelists(self):
+        """ Local branches named 'issue<num>#<remote>#<local>' """
+        issue_changelists = []
+        branches, _current_branch = self._getGitBranches()
+        for branch in branches:
+            m = re.match(r'issue(\d+)#', branch)
+            if m:
+                issue_changelists.append((int(m.group(1)), branch))
+        return sorted(issue_changelists)
+
     # branch specific functions:
 
     def renameGitBranchWithIssueNum(self,
@@ -634,17 +669,13 @@ class GitVCS(CrBaseVCS, upload.GitVCS):
         git_dir += "/.git"
         return pwd, git_dir
 
-    def _getCurrentGitInfo(self):
+    def _getGitBranches(self):
         """
-        Get current path, git path, branch name. This is done via
-        'git status --porcelain', 'git diff --name-only --no-color',
-        and 'git branch -a --no-color'
-        Note that git_fileinfo is keyed by the file name, then the
-        branch name.
+        Return all branches from 'git branch -a' and the current one
+        (None if there is no current branch)
         """
         branches = []
-        full_branch, issue, current_branch, remote_branch = (
-            None, None, None, 'remotes/origin/master')
+        current_branch = None
         cmd = [GIT, "branch", "-a", "--no-color"]
         for branch in RunShell(cmd).splitlines():
             # Take care of "remotes/origin/HEAD -> origin/master"
@@ -654,7 +685,20 @@ class GitVCS(CrBaseVCS, upload.GitVCS):
                 ErrorExit("Unable to parse branch output: '%s'" % branch)
             branches.append(m.group(2))
             if m.group(1) == '*':
-                full_branch = current_branch = m.group(2)
+                current_branch = m.group(2)
+        return branches, current_branch
+
+    def _getCurrentGitInfo(self):
+        """
+        Get current path, git path, branch name. This is done via
+        'git status --porcelain', 'git diff --name-only --no-color',
+        and 'git branch -a --no-color'
+        Note that git_fileinfo is keyed by the file name, then the
+        branch name.
+        """
+        issue, remote_branch = None, 'remotes/origin/master'
+        branches, full_branch = self._getGitBranches()
+        current_branch = full_branch
         if not full_branch:
             ErrorExit("Unable to determine current branch (git branch)")
 
@@ -840,29 +884,169 @@ def ParseUserArguments(vcs, opt_svn_revision, opt_changelist, opt_files):
     return (cl, filegroup_info.fileinfo_list)
 
 
-def fetchContentFromUrl(rpc_server, url):
-    """ Generic url fetch function """
-    tries = 3
-    while tries > 0:
+class ResponseCache(object):
+    """
+    On-disk cache of GET responses in ~/.codereview_response_cache, one
+    JSON file per server and url. Cached responses are revalidated with
+    If-None-Match/If-Modified-Since, so an unchanged page costs a 304
+    instead of a download; within CR_CACHE_TTL seconds they are reused
+    without asking the server at all.
+    """
+
+    def __init__(self, server, ttl=None):
+        self.directory = os.path.expanduser("~/.codereview_response_cache")
+        self.server = server
+        self.ttl = CACHE_TTL if ttl is None else ttl
+
+    def _getPath(self, url):
+        name = re.sub(r"[^\w.-]", "_", "%s%s" % (self.server, url))
+        return os.path.join(self.directory, name + ".json")
+
+    def load(self, url, fields):
+        """ Returns the entry saved for url with the given fields, or None """
+        try:
+            cache_file = open(self._getPath(url), "r")
+            try:
+                entry = json.load(cache_file)
+            finally:
+                cache_file.close()
+            if not isinstance(entry, dict):
+                raise ValueError("not a JSON object")
+            return dict((field, _toUtf8(entry[field])) for field in fields)
+        except (IOError, ValueError, KeyError), e:
+            # no cached copy yet, or an unreadable one
+            logger.debug("No cached response for %s: %s" % (url, e))
+            return None
+
+    def save(self, url, entry):
+        path = self._getPath(url)
+        try:
+            # a body that isn't UTF-8 can't be stored as JSON (ValueError)
+            data = json.dumps(entry)
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, 0700)
+            cache_file = open(path + ".tmp", "w")
+            try:
+                cache_file.write(data)
+            finally:
+                cache_file.close()
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError, ValueError), e:
+            logger.debug("Could not cache %s: %s" % (url, e))
+
+    def fetch(self, rpc_server, url):
+        """ Returns the content of url, from the cache when still valid """
+        entry = self.load(url, ('body', 'etag', 'last_modified',
+                                'timestamp'))
+        headers = {}
+        if entry:
+            if time.time() - entry['timestamp'] < self.ttl:
+                logger.debug("Reusing cached %s" % url)
+                return entry['body']
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
         try:
-            return rpc_server.Send(url)
+            content, info = rpc_server.Send(url, extra_headers=headers,
+                                            return_info=True)
         except urllib2.HTTPError, e:
-            err_html = e.read()
-            if (e.code == 404 or e.msg == 'Not found' or
-                    re.match(r'No issue exists', err_html, re.IGNORECASE)):
-                ErrorExit("Error in http://%s%s, maybe it is closed?\n%s" %
-                          (SERVER, url, err_html))
-            print("Error %d in 'http://%s%s', retrying..." %
-                  (e.code, SERVER, url))
-            time.sleep(1)
-            tries -= 1
-        except urllib2.URLError, e:
-            ErrorExit("Unable to find server '%s' (%s)" % (SERVER, str(e)))
+            if e.code != 304 or not entry:
+                raise
+            logger.debug("%s is not modified" % url)
+            entry['timestamp'] = time.time()
+            self.save(url, entry)
+            return entry['body']
+        etag = info.getheader('ETag')
+        last_modified = info.getheader('Last-Modified')
+        if etag or last_modified or self.ttl > 0:
+            self.save(url, {'body': content,
+                            'etag': etag,
+                            'last_modified': last_modified,
+                            'timestamp': time.time()})
+        return content
+
+    def getParsed(self, key, *contents):
+        """ Returns what was stored by setParsed for the same contents """
+        entry = self.load(key, ('checksum', 'value'))
+        if entry and entry['checksum'] == self._checksum(contents):
+            return entry['value']
+        return None
+
+    def setParsed(self, key, value, *contents):
+        self.save(key, {'checksum': self._checksum(contents),
+                        'value': value})
+
+    @staticmethod
+    def _checksum(contents):
+        return [upload.md5(content).hexdigest() for content in contents]
+
+
+def _toUtf8(value):
+    """ Turns the unicode strings json returns back into UTF-8 strs """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_toUtf8(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_toUtf8(key), _toUtf8(item))
+                    for key, item in value.iteritems())
+    return value
+
+
+def fetchContentFromUrl(rpc_server, url, cache=None):
+    """
+    Generic url fetch function. Retries happen in rpc_server.Send; with a
+    ResponseCache, unchanged pages are not downloaded again.
+    """
+    return fetchContentsFromUrls(rpc_server, [url], cache)[0]
+
+
+def fetchContentsFromUrls(rpc_server, urls, cache=None):
+    """
+    Fetch independent urls concurrently, like fetchContentFromUrl does for
+    one url. Errors are reported for the first failing url in the list, as
+    if the urls were fetched one after another.
+    """
+    results = tryFetchingUrls(rpc_server, urls, cache, len(urls))
+    for url, (_content, error) in zip(urls, results):
+        if error is not None:
+            exitOnFetchError(url, error)
+    return [content for content, _error in results]
+
+
+def tryFetchingUrls(rpc_server, urls, cache, num_threads):
+    """
+    Fetch urls with up to num_threads requests in flight. Return a list of
+    (content, None) or (None, exception) in the order of urls.
+    """
+    def fetch(url):
+        try:
+            if cache is not None:
+                return cache.fetch(rpc_server, url), None
+            return rpc_server.Send(url), None
         except Exception, e:
-            ErrorExit("Fatal error in http://%s%s:\n%s" %
-                      (SERVER, url, str(e)))
-    if tries == 0:
-        ErrorExit("Failed fetching from 'http://%s%s'" % (SERVER, url))
+            return None, e
+
+    if num_threads > 1 and len(urls) > 1:
+        # log in once here rather than once per thread
+        rpc_server.EnsureAuthenticated()
+    return upload.ParallelMap(fetch, urls, num_threads)
+
+
+def exitOnFetchError(url, e):
+    """ Report why fetching url failed and exit """
+    if isinstance(e, urllib2.HTTPError):
+        err_html = e.read()
+        if (e.code == 404 or e.msg == 'Not found' or
+                re.match(r'No issue exists', err_html, re.IGNORECASE)):
+            ErrorExit("Error in http://%s%s, maybe it is closed?\n%s" %
+                      (SERVER, url, err_html))
+        ErrorExit("Failed fetching from 'http://%s%s' (error %d)" %
+                  (SERVER, url, e.code))
+    if isinstance(e, urllib2.URLError):
+        ErrorExit("Unable to find server '%s' (%s)" % (SERVER, str(e)))
+    ErrorExit("Fatal error in http://%s%s:\n%s" % (SERVER, url, str(e)))
 
 
 def getRawHTMLMessagesFromMondrian(html, api_data):
@@ -922,6 +1106,55 @@ def getRawHTMLMessagesFromMondrian(html, api_data):
             'messages': raw_msgs}
 
 
+def fetchMondrianPageInfo(rpc_server, issue_num, for_write=False):
+    """
+    Fetch and parse the issue page and its API data. Both go through a
+    ResponseCache, and the parse is skipped when neither has changed.
+    With for_write, the pages are always revalidated with the server, so
+    the xsrfToken handed to a POST is never a stale one.
+    """
+    if for_write:
+        cache = ResponseCache(SERVER, ttl=0)
+    else:
+        cache = ResponseCache(SERVER)
+    html, api_data = fetchContentsFromUrls(
+        rpc_server, ["/%d" % issue_num, "/api/%d" % issue_num], cache)
+    return parseMondrianPageInfo(issue_num, html, api_data, cache)
+
+
+def parseMondrianPageInfo(issue_num, html, api_data, cache):
+    """ getRawHTMLMessagesFromMondrian, unless cache has the same pages """
+    parsed_key = "/%d#parsed" % issue_num
+    page_info = cache.getParsed(parsed_key, html, api_data)
+    if page_info is None:
+        page_info = getRawHTMLMessagesFromMondrian(html, api_data)
+        cache.setParsed(parsed_key, page_info, html, api_data)
+    return page_info
+
+
+def getLgtmApprovers(mondrian_msgs, quiet=False):
+    """
+    Return the list of people who LGTM'ed and how long ago the last LGTM
+    was (None without any LGTM)
+    """
+    approvers = []
+    lgtm_ago = None
+    for msg_pack in mondrian_msgs:
+        msg = msg_pack['msg']
+        logger.debug("...msg:'%s'" % msg)
+        if re.search(r"LGTM|LTGM|looks good to me", msg, re.IGNORECASE):
+            _approver = msg_pack['commenter']
+            if _approver == "me" and os.environ.get('LGTM', None) is None:
+                if not quiet:
+                    print("You should not LGTM or solicit LGTM in "
+                          "your own comment!")
+            else:
+                if _approver not in approvers:
+                    approvers.append(_approver)
+                lgtm_ago = msg_pack['ago']
+    return approvers, lgtm_ago
+
+
 def printCrHelp(prog, vcs_cmd):
     global SVN, GIT
     help_params = {'prog': prog, 'cl': 'issue6415002',
@@ -938,6 +1171,7 @@ def printCrHelp(prog, vcs_cmd):
 ...
 %(prog)s finish
 %(prog)s finish --changelist %(cl)s
+%(prog)s issues   # LGTM/closed state of all your issues
 
 # Normal UNIX diff:
 %(prog)s diff
@@ -1012,7 +1246,8 @@ def executeUploadPy(vcs,
     else:
         message = ""
     if first_upload:
-        goofy_subject = CrBaseVCS.GetGoofySubjectHeader(diff_data) + " "
+        goofy_subject = CrBaseVCS.GetGoofySubjectHeader(
+            vcs.GetDiffStats(diff_data)) + " "
     else:
         goofy_subject = ""
 
@@ -1039,6 +1274,8 @@ def executeUploadPy(vcs,
 
     if options.send_mail:
         upload_argv.extend(["--send_mail"])
+    if options.resume:
+        upload_argv.append("--resume")
     if options.reviewers:
         upload_argv.extend(["-r", options.reviewers])
     cc = []
@@ -1294,9 +1531,9 @@ def executeCheckIn(vcs, prog, argv):
         print("Checking for LGTM status from %s for changelist '%s'... " %
               (SERVER, cl))
 
-    html = fetchContentFromUrl(rpc_server, "/%d" % issue_num)
-    api_data = fetchContentFromUrl(rpc_server, "/api/%d" % issue_num)
-    mondrian_page_info = getRawHTMLMessagesFromMondrian(html, api_data)
+    # the page's xsrfToken is used to close and publish below
+    mondrian_page_info = fetchMondrianPageInfo(rpc_server, issue_num,
+                                               for_write=True)
 
     if options.message:
         mondrian_description = options.message
@@ -1314,22 +1551,10 @@ def executeCheckIn(vcs, prog, argv):
         lgtm_ago = "now"
         approval_message = "FORCE CHECK IN"
     else:
-        approvers = []
-        lgtm_ago = None
-        mondrian_msgs = mondrian_page_info['messages']
-        for msg_pack in mondrian_msgs:
-            msg = msg_pack['msg']
-            logger.debug("...msg:'%s'" % msg)
-            if re.search(r"LGTM|LTGM|looks good to me", msg, re.IGNORECASE):
-                _approver = msg_pack['commenter']
-                if _approver == "me" and os.environ.get('LGTM', None) is None:
-                    print("You should not LGTM or solicit LGTM in "
-                          "your own comment!")
-                else:
-                    if _approver not in approvers:
-                        approvers.append(_approver)
-                    lgtm_ago = msg_pack['ago']
-                    approval_message = "LGTM'ed"
+        approvers, lgtm_ago = getLgtmApprovers(
+            mondrian_page_info['messages'])
+        if lgtm_ago:
+            approval_message = "LGTM'ed"
 
     if not lgtm_ago:
         ErrorExit("Sorry, changelist '%s' does not yet have an LGTM.\n" % cl +
@@ -1372,10 +1597,11 @@ def executeCheckIn(vcs, prog, argv):
         pload = "xsrf_token=" + mondrian_page_info['xsrfToken']
         close_html = rpc_server.Send(url,
                                      content_type=UPLOAD_CONTENT_TYPE,
-                                     payload=pload)
+                                     payload=pload,
+                                     idempotent=True)
         # make sure the string is in sync with
         # .../codereview/views.py (def close(...))
-        if re.search(r'Closed', html, re.IGNORECASE):
+        if re.search(r'Closed', close_html, re.IGNORECASE):
             print("Closed issue '%d' on http://%s/%d" %
                   (issue_num, SERVER, issue_num))
         else:
@@ -1392,8 +1618,8 @@ def executeCheckIn(vcs, prog, argv):
     pload = urllib.urlencode(pload_arr)
     update_html = "Fatal error: Mondrian did not return a 302"
 
-    tries = 3
-    while tries > 0:
+    # Retry with the server's backoff policy instead of in lockstep.
+    for _attempt in rpc_server.retry_policy.Attempts():
         try:
             logger.debug("Uploading to %s ..." % url)
             update_html = rpc_server.Send(url,
@@ -1412,13 +1638,66 @@ def executeCheckIn(vcs, prog, argv):
                 return
         print("Error posting a commit message to "
               "http://%s%s, trying again..." % (SERVER, url))
-        time.sleep(2)
-        tries -= 1
 
     ErrorExit("Unable to publish '%s' to http://%s%s:\n%s" %
               (vcs_message, SERVER, url, update_html))
 
 
+def executeIssues(vcs, prog, argv):
+    """
+    Show the review state of every local 'issue<num>' branch (git) or
+    changelist (svn):
+    cr issues [-j <concurrent requests>]
+    """
+    options, _args = CrOptionParser.parser.parse_args(argv)
+    issue_changelists = vcs.getIssueChangelists()
+    if not issue_changelists:
+        print "No issue branches or changelists found."
+        return
+
+    rpc_server = upload.GetRpcServer(SERVER,
+                                     host_override=None,
+                                     save_cookies=True,
+                                     account_type=upload.AUTH_ACCOUNT_TYPE)
+    cache = ResponseCache(SERVER)
+    urls = []
+    for issue_num, _cl in issue_changelists:
+        urls.extend(["/%d" % issue_num, "/api/%d" % issue_num])
+    results = tryFetchingUrls(rpc_server, urls, cache, max(options.jobs, 1))
+
+    for i, (issue_num, cl) in enumerate(issue_changelists):
+        (html, html_error), (api_data, api_error) = results[2 * i:2 * i + 2]
+        error = html_error or api_error
+        if error is not None:
+            if isinstance(error, urllib2.HTTPError) and error.code == 404:
+                state, detail = "missing", "not found, maybe deleted?"
+            else:
+                state, detail = "error", str(error)
+            print("%-16s %-8s %s" % ("issue%d" % issue_num, state, detail))
+            print("%16s %s" % ("", cl))
+            continue
+
+        page_info = parseMondrianPageInfo(issue_num, html, api_data, cache)
+        approvers, lgtm_ago = getLgtmApprovers(page_info['messages'],
+                                               quiet=True)
+        if json.loads(api_data).get('closed'):
+            state = "closed"
+        elif lgtm_ago:
+            state = "LGTM"
+        else:
+            state = "pending"
+        if page_info['messages']:
+            last_msg = page_info['messages'][-1]
+            activity = "%s by %s" % (last_msg['ago'], last_msg['commenter'])
+        else:
+            activity = "no messages"
+        approval = ("LGTM'ed by %s %s" % (",".join(approvers), lgtm_ago)
+                    if lgtm_ago else "no LGTM yet")
+        print("%-16s %-8s %s; last activity %s" %
+              ("issue%d" % issue_num, state, approval, activity))
+        print("%16s %s: %s" % ("", cl, page_info['title']))
+
+
 def getVcsArgsAndRemnantArgs(argv):
     """
     Get two lists of arguments:
@@ -1461,11 +1740,28 @@ def Main(argv):
         argv.remove('--verbose')
         argv.append('--verbose')
 
+    for i, arg in enumerate(argv):
+        # cr --rpc-stats=file.json <command> ...: dump server timings at exit
+        if arg.startswith('--rpc-stats='):
+            upload.rpc_stats.DumpAtExit(arg.split('=', 1)[1])
+            del argv[i]
+            break
+        if arg == '--rpc-stats' and i + 1 < len(argv):
+            upload.rpc_stats.DumpAtExit(argv[i + 1])
+            del argv[i:i + 2]
+            break
+
     if 'CR' in os.environ:
         prog = os.environ['CR']    # another script calls this script
     else:
         prog = os.path.basename(argv[0])
 
+    if len(argv) > 1 and argv[1] == 'agent':
+        # the optional background agent, see cr_agent.py
+        import cr_agent
+        cr_agent.executeAgent(prog, argv[2:])
+        return
+
     #vcs_args, remnant_args = getVcsArgsAndRemnantArgs(argv[1:])
     #vcs_options, args = upload.parser.parse_args(vcs_args)
     vcs_options, args = upload.parser.parse_args([])
@@ -1520,6 +1816,8 @@ def Main(argv):
         vcs.executeAllCmd(['commit'] + argv[2:])
     elif cmd in ['commit', 'ci', 'finish']:
         executeCheckIn(vcs, prog, argv[2:])
+    elif cmd == 'issues':
+        executeIssues(vcs, prog, argv[2:])
     elif vcs.CMD == GIT and cmd in ['br', 'branch']:
         vcs.parseGitBranchOptions(argv[2:])
     elif vcs.CMD == GIT and cmd in ['cl', 'changelist']:
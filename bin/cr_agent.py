@@ -0,0 +1,513 @@
+#!python
+
+"""
+An optional per-user background agent for cr. It keeps the imports of
+cr.py, upload.py and BeautifulSoup, the HttpRpcServer with its loaded
+authentication cookies, and the detected VCS of each directory warm, so
+that commands forwarded to it skip that setup.
+
+cr agent start     # start the agent (uses the current CR_* settings)
+cr agent status
+cr agent stop
+
+With CR_AGENT=1 the bin/cr script runs this file as a thin client instead
+of cr.py: the command, working directory and environment are sent over a
+Unix socket, and the agent runs it in a forked copy of itself. Output and
+the exit code come back over the socket, and stdin is forwarded. When no
+agent is running, or its CR_* settings differ from the caller's, the
+client runs cr.py directly.
+
+Commands run by the agent have no terminal, so they can't ask for a
+password without echoing it; they fail instead and ask the user to log in
+once without the agent. The agent then picks up the saved cookies.
+"""
+
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+
+SOCKET_PATH = os.path.expanduser(
+    os.environ.get('CR_AGENT_SOCKET', "~/.codereview_agent.sock"))
+
+# Entries of a directory or its parents that upload.GuessVCSName looks for.
+VCS_MARKERS = ('.hg', '.svn', '.git', 'CVS')
+
+# Frames are a one letter channel, a length and the data. Client to agent:
+# 'r' request (json), 'i' stdin data, 'c' stdin closed. Agent to client:
+# 'o' stdout, 'e' stderr, 'x' exit code, 'f' run cr.py locally instead.
+FRAME_HEADER = struct.Struct("!cI")
+
+
+def sendFrame(sock, channel, data=""):
+    sock.sendall(FRAME_HEADER.pack(channel, len(data)) + data)
+
+
+def _recvExactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+def recvFrame(sock):
+    """ Returns (channel, data), or (None, None) once the peer is gone """
+    header = _recvExactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None, None
+    channel, size = FRAME_HEADER.unpack(header)
+    data = _recvExactly(sock, size) if size else ""
+    if data is None:
+        return None, None
+    return channel, data
+
+
+def getCrEnvironment(env):
+    """ The settings cr.py reads once at import time """
+    return dict((key, value) for key, value in env.items()
+                if key.startswith('CR_') or key == 'DEBUG')
+
+
+def getVcsFingerprint(directory):
+    """
+    Identifies the checkout GuessVCSName would detect in directory: the
+    inodes of directory and of the VCS_MARKERS in it and its parents.
+    Deleting and re-cloning a checkout, or switching it to another VCS,
+    changes the fingerprint.
+    """
+    fingerprint = []
+    try:
+        stat = os.stat(directory)
+    except OSError:
+        return None
+    fingerprint.append((directory, stat.st_dev, stat.st_ino))
+    while True:
+        for name in VCS_MARKERS:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            fingerprint.append((path, stat.st_dev, stat.st_ino))
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return tuple(fingerprint)
+        directory = parent
+
+
+def connectAgent():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+# Client side.
+
+def runClient(argv):
+    """
+    Runs a cr command in the agent. Returns its exit code, or None if the
+    command should run locally.
+    """
+    sock = connectAgent()
+    if sock is None:
+        return None
+    request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+    try:
+        sendFrame(sock, 'r', json.dumps(request))
+        stdin_open = True
+        while True:
+            readers = [sock, sys.stdin] if stdin_open else [sock]
+            readable = select.select(readers, [], [])[0]
+            if sys.stdin in readable:
+                data = os.read(sys.stdin.fileno(), 65536)
+                if data:
+                    sendFrame(sock, 'i', data)
+                else:
+                    sendFrame(sock, 'c')
+                    stdin_open = False
+            if sock in readable:
+                channel, data = recvFrame(sock)
+                if channel == 'o':
+                    sys.stdout.write(data)
+                    sys.stdout.flush()
+                elif channel == 'e':
+                    sys.stderr.write(data)
+                    sys.stderr.flush()
+                elif channel == 'x':
+                    return int(data)
+                elif channel == 'f':
+                    return None
+                else:
+                    print >> sys.stderr, "cr agent went away"
+                    return 1
+    finally:
+        sock.close()
+
+
+def runLocally(argv):
+    cr_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cr.py")
+    os.execv(sys.executable, [sys.executable, cr_py] + argv[1:])
+
+
+def main(argv):
+    if argv[1:2] == ['agent']:
+        runLocally(argv)
+    try:
+        exit_code = runClient(argv)
+    except KeyboardInterrupt:
+        exit_code = 1
+    if exit_code is None:
+        runLocally(argv)
+    sys.exit(exit_code)
+
+
+# Agent side.
+
+class Agent(object):
+    """ Serves cr commands on SOCKET_PATH, one forked worker per command """
+
+    def __init__(self):
+        import cr
+        import upload
+        self.cr = cr
+        self.upload = upload
+        self.cr_env = getCrEnvironment(os.environ)
+        self.rpc_servers = {}
+        self.cookie_mtime = None
+        self.vcs_names = {}
+        self.listener = None
+        self.running = True
+        self._installCaches()
+
+    def _installCaches(self):
+        """
+        Make the forked workers reuse the agent's HttpRpcServer and VCS
+        detection instead of creating them again.
+        """
+        upload = self.upload
+        create_rpc_server = upload.GetRpcServer
+        guess_vcs_name = upload.GuessVCSName
+
+        def GetRpcServer(server, email=None, host_override=None,
+                         save_cookies=True,
+                         account_type=upload.AUTH_ACCOUNT_TYPE):
+            key = (server, email, host_override, save_cookies, account_type)
+            if key not in self.rpc_servers:
+                self.rpc_servers[key] = create_rpc_server(*key)
+            return self.rpc_servers[key]
+
+        def GuessVCSName(options):
+            for attribute, value in options.__dict__.iteritems():
+                if attribute.startswith("p4") and value is not None:
+                    return guess_vcs_name(options)
+            cwd = os.getcwd()
+            fingerprint = getVcsFingerprint(cwd)
+            cached = self.vcs_names.get(cwd)
+            if cached and cached[0] == fingerprint:
+                return cached[1]
+            vcs_name = guess_vcs_name(options)
+            if vcs_name[0] == upload.VCS_UNKNOWN:
+                # not a working copy (yet); don't remember that
+                self.vcs_names.pop(cwd, None)
+                return vcs_name
+            self.vcs_names[cwd] = (fingerprint, vcs_name)
+            return vcs_name
+
+        upload.GetRpcServer = GetRpcServer
+        upload.GuessVCSName = GuessVCSName
+        self.rpc_server = GetRpcServer(
+            self.cr.SERVER, host_override=None, save_cookies=True,
+            account_type=upload.AUTH_ACCOUNT_TYPE)
+        self.cookie_mtime = self._getCookieMtime()
+
+    def _getCookieMtime(self):
+        try:
+            return os.stat(
+                os.path.expanduser("~/.codereview_upload_cookies")).st_mtime
+        except OSError:
+            return None
+
+    def _refreshCookies(self):
+        """ Pick up logins done by earlier workers """
+        mtime = self._getCookieMtime()
+        if mtime == self.cookie_mtime:
+            return
+        self.cookie_mtime = mtime
+        for rpc_server in self.rpc_servers.values():
+            if not rpc_server.save_cookies:
+                continue
+            try:
+                rpc_server.cookie_jar.load()
+                rpc_server.authenticated = True
+            except Exception, e:
+                self.cr.logger.debug("Could not reload cookies: %s" % e)
+
+    def listen(self):
+        if os.path.exists(SOCKET_PATH):
+            os.unlink(SOCKET_PATH)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0077)
+        try:
+            self.listener.bind(SOCKET_PATH)
+        finally:
+            os.umask(old_umask)
+        self.listener.listen(16)
+
+    def serve(self):
+        try:
+            while self.running:
+                self._reapWorkers()
+                if not select.select([self.listener], [], [], 1.0)[0]:
+                    continue
+                conn = self.listener.accept()[0]
+                try:
+                    self._handle(conn)
+                finally:
+                    conn.close()
+        finally:
+            self.listener.close()
+            if os.path.exists(SOCKET_PATH):
+                os.unlink(SOCKET_PATH)
+
+    def _reapWorkers(self):
+        while True:
+            try:
+                pid = os.waitpid(-1, os.WNOHANG)[0]
+            except OSError:
+                return
+            if not pid:
+                return
+
+    def _handle(self, conn):
+        channel, data = recvFrame(conn)
+        if channel != 'r':
+            return
+        request = json.loads(data)
+        if request.get('command') == 'status':
+            sendFrame(conn, 'o', "cr agent %d is running for %s\n" %
+                      (os.getpid(), self.cr.SERVER))
+            sendFrame(conn, 'x', "0")
+            return
+        if request.get('command') == 'stop':
+            self.running = False
+            sendFrame(conn, 'x', "0")
+            return
+        if getCrEnvironment(request['env']) != self.cr_env:
+            sendFrame(conn, 'f')
+            return
+        self._refreshCookies()
+        try:
+            os.chdir(request['cwd'])
+            self.upload.GuessVCSName(self.upload.parser.parse_args([])[0])
+        except Exception, e:
+            # the worker reports it properly
+            self.cr.logger.debug("Could not detect the VCS: %s" % e)
+        finally:
+            os.chdir("/")
+        if os.fork() == 0:
+            self.listener.close()
+            try:
+                exit_code = Worker(self, conn, request).run()
+            except BaseException:
+                exit_code = 1
+            os._exit(exit_code)
+
+
+class Worker(object):
+    """
+    Runs one command. The command itself runs in a further child whose
+    stdin, stdout and stderr are pipes that this process relays.
+    """
+
+    def __init__(self, agent, conn, request):
+        self.agent = agent
+        self.conn = conn
+        self.request = request
+
+    def run(self):
+        stdin_read, stdin_write = os.pipe()
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.dup2(stdin_read, 0)
+            os.dup2(stdout_write, 1)
+            os.dup2(stderr_write, 2)
+            for fd in (stdin_read, stdin_write, stdout_read, stdout_write,
+                       stderr_read, stderr_write):
+                os.close(fd)
+            self.conn.close()
+            os._exit(self._runCommand())
+        for fd in (stdin_read, stdout_write, stderr_write):
+            os.close(fd)
+        outputs = {stdout_read: 'o', stderr_read: 'e'}
+        conn_open = True
+        while outputs:
+            readers = outputs.keys() + ([self.conn] if conn_open else [])
+            try:
+                readable = select.select(readers, [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                if fd is self.conn:
+                    conn_open = self._relayInput(pid, stdin_write)
+                    if not conn_open and stdin_write is not None:
+                        os.close(stdin_write)
+                        stdin_write = None
+                    continue
+                data = os.read(fd, 65536)
+                if data:
+                    self._send(outputs[fd], data)
+                else:
+                    os.close(fd)
+                    del outputs[fd]
+        if stdin_write is not None:
+            os.close(stdin_write)
+        status = os.waitpid(pid, 0)[1]
+        if os.WIFEXITED(status):
+            exit_code = os.WEXITSTATUS(status)
+        else:
+            exit_code = 128 + os.WTERMSIG(status)
+        self._send('x', str(exit_code))
+        return 0
+
+    def _send(self, channel, data=""):
+        try:
+            sendFrame(self.conn, channel, data)
+        except socket.error:
+            # the client is gone; keep draining the command's output
+            pass
+
+    def _relayInput(self, pid, stdin_write):
+        """ Returns False once the client has no more input for us """
+        channel, data = recvFrame(self.conn)
+        if channel == 'i':
+            if stdin_write is not None:
+                try:
+                    os.write(stdin_write, data)
+                except OSError:
+                    pass
+            return True
+        if channel is None:
+            # the client went away (e.g. Ctrl-C): interrupt the command
+            try:
+                os.kill(pid, signal.SIGINT)
+            except OSError:
+                pass
+        return False
+
+    def _runCommand(self):
+        cr = self.agent.cr
+        os.environ.clear()
+        os.environ.update(self.request['env'])
+        sys.argv = list(self.request['argv'])
+        sys.stdin = os.fdopen(0, "r")
+        # unbuffered, so that output and prompts reach the client promptly
+        sys.stdout = os.fdopen(1, "w", 0)
+        sys.stderr = os.fdopen(2, "w", 0)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        import getpass
+        getpass.getpass = self._refusePassword
+        exit_code = 0
+        try:
+            os.chdir(self.request['cwd'])
+            cr.Main(list(self.request['argv']))
+        except SystemExit, e:
+            if e.code is None:
+                exit_code = 0
+            elif isinstance(e.code, int):
+                exit_code = e.code
+            else:
+                print >> sys.stderr, e.code
+                exit_code = 1
+        except KeyboardInterrupt:
+            print
+            cr.StatusUpdate("Interrupted.")
+            exit_code = 1
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            exit_code = 1
+        # the caller ends this process with os._exit, which skips atexit
+        self.agent.upload.rpc_stats.DumpIfRequested()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        return exit_code
+
+
+    def _refusePassword(self, prompt="Password: ", stream=None):
+        """
+        Replaces getpass.getpass in the command. Without a terminal the
+        password would be echoed by the client's terminal and relayed in
+        clear, so ask the user to log in without the agent instead.
+        """
+        print >> sys.stderr, (
+            "cr agent: can't ask for a password without a terminal. Log in "
+            "once without the agent, e.g. with 'CR_AGENT= cr %s', then try "
+            "again." % " ".join(self.request['argv'][1:]))
+        sys.exit(1)
+
+
+def executeAgent(prog, argv):
+    """ cr agent start|stop|status """
+    action = argv[0] if argv else 'status'
+    if action in ('stop', 'status'):
+        sock = connectAgent()
+        if sock is None:
+            print "No cr agent is running (%s)" % SOCKET_PATH
+            sys.exit(1 if action == 'status' else 0)
+        try:
+            sendFrame(sock, 'r', json.dumps({'command': action}))
+            while True:
+                channel, data = recvFrame(sock)
+                if channel == 'o':
+                    sys.stdout.write(data)
+                if channel in ('x', None):
+                    break
+        finally:
+            sock.close()
+        if action == 'stop':
+            print "Stopped the cr agent"
+        return
+    if action != 'start':
+        print >> sys.stderr, "Usage: %s agent start|stop|status" % prog
+        sys.exit(1)
+    if connectAgent() is not None:
+        print "A cr agent is already running (%s)" % SOCKET_PATH
+        return
+    agent = Agent()
+    agent.listen()
+    if os.fork():
+        agent.listener.close()
+        print "Started the cr agent on %s" % SOCKET_PATH
+        return
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    os.chdir("/")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+    try:
+        agent.serve()
+    finally:
+        os._exit(0)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
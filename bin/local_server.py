@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+"""A local stand-in for the code review server.
+
+It implements just enough of the Rietveld/Mondrian upload protocol (/upload,
+upload_patch, upload_content, mail) and of the pages cr.py reads (/N, /api/N,
+close, publish) to run upload.py and cr offline, e.g. to test --compress or
+to benchmark uploads without a real server. Everything is kept in memory.
+
+Patches and files larger than upload.MAX_UPLOAD_SIZE are accepted in chunks
+(upload_patch_chunk, upload_content_chunk), which are checked against their
+checksums and reassembled once the last one has arrived.
+
+Compressed request bodies (Content-Encoding: gzip or deflate) are
+decompressed, and the bytes received on the wire and after decoding are
+counted per request path. GET /stats returns those counters as JSON.
+
+Usage:
+  python local_server.py [--port 8080] [--verbose]
+  upload.py -s localhost:8080 --compress gzip ...
+"""
+
+import BaseHTTPServer
+import cgi
+import json
+import optparse
+import re
+import SocketServer
+import sys
+import threading
+import time
+import zlib
+
+try:
+  import cStringIO as StringIO
+except ImportError:
+  import StringIO
+
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import md5
+
+import upload
+
+
+class IssueStore(object):
+  """In-memory issues, patchsets and patches, shared by all handlers."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.last_id = 0
+    # issue id -> dict with the issue's metadata and list of patchset ids.
+    self.issues = {}
+    # patchset id -> dict with the issue id and filename -> patch id.
+    self.patchsets = {}
+    # patch id -> dict with the filename, diff text and uploaded contents.
+    self.patches = {}
+    # request path template -> dict of counters, see RecordRequest.
+    self.stats = {}
+    # chunked upload key -> dict of chunk index -> data, see AddChunk.
+    self.chunks = {}
+
+  def NewId(self):
+    self.last_id += 1
+    return self.last_id
+
+  def NewPatch(self, patchset_id, filename, text):
+    patch_id = self.NewId()
+    self.patches[patch_id] = {"filename": filename,
+                              "patchset": patchset_id,
+                              "text": text,
+                              "base": None,
+                              "current": None}
+    self.patchsets[patchset_id]["files"][filename] = patch_id
+    return patch_id
+
+  def FindPreviousBase(self, issue_id, filename, checksum):
+    """Returns a patch of an earlier patchset with the same base file."""
+    for patchset_id in reversed(self.issues[issue_id]["patchsets"][:-1]):
+      patch_id = self.patchsets[patchset_id]["files"].get(filename)
+      if patch_id is None:
+        continue
+      patch = self.patches[patch_id]
+      if (patch["base"] is not None and
+          md5(patch["base"]).hexdigest() == checksum):
+        return patch
+    return None
+
+  def AddChunk(self, key, fields):
+    """Stores one chunk of the chunked upload identified by key.
+
+    Returns:
+      A (content, error) pair. content is the reassembled content once every
+      chunk has arrived, else None. error is a message if a checksum didn't
+      match, else None.
+    """
+    data = fields.get("data", "")
+    index = int(fields["chunk_index"])
+    count = int(fields["chunk_count"])
+    if md5(data).hexdigest() != fields.get("chunk_checksum"):
+      return None, "Checksum mismatch for chunk %d of %s." % (
+          index, fields.get("filename"))
+    chunks = self.chunks.setdefault(key, {})
+    chunks[index] = data
+    if len(chunks) < count:
+      return None, None
+    del self.chunks[key]
+    content = "".join(chunks[i] for i in range(count))
+    if md5(content).hexdigest() != fields.get("checksum"):
+      return None, "Checksum mismatch for %s." % fields.get("filename")
+    return content, None
+
+  def RecordRequest(self, template, wire_bytes, body_bytes, seconds):
+    counters = self.stats.setdefault(template, {"requests": 0,
+                                                "wire_bytes": 0,
+                                                "body_bytes": 0,
+                                                "seconds": 0.0})
+    counters["requests"] += 1
+    counters["wire_bytes"] += wire_bytes
+    counters["body_bytes"] += body_bytes
+    counters["seconds"] += seconds
+
+
+class LocalServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Handles the code review requests made by upload.py and cr.py."""
+
+  protocol_version = "HTTP/1.1"
+
+  # (method, path regex, handler method name, stats template)
+  ROUTES = [
+      ("POST", r"/upload$", "Upload", "/upload"),
+      ("POST", r"/(\d+)/upload_patch/(\d+)$", "UploadPatch",
+       "/N/upload_patch/P"),
+      ("POST", r"/(\d+)/upload_content/(\d+)/(\d+)$", "UploadContent",
+       "/N/upload_content/P/F"),
+      ("POST", r"/(\d+)/upload_patch_chunk/(\d+)$", "UploadPatchChunk",
+       "/N/upload_patch_chunk/P"),
+      ("POST", r"/(\d+)/upload_content_chunk/(\d+)/(\d+)$",
+       "UploadContentChunk", "/N/upload_content_chunk/P/F"),
+      ("POST", r"/(\d+)/mail$", "Mail", "/N/mail"),
+      ("POST", r"/(\d+)/close$", "Close", "/N/close"),
+      ("POST", r"/(\d+)/publish$", "Publish", "/N/publish"),
+      ("GET", r"/api/(\d+)$", "ApiIssue", "/api/N"),
+      ("GET", r"/(\d+)$", "IssuePage", "/N"),
+      ("GET", r"/stats$", "Stats", "/stats"),
+  ]
+
+  def do_GET(self):
+    self.Dispatch("GET")
+
+  def do_POST(self):
+    self.Dispatch("POST")
+
+  def Dispatch(self, method):
+    start = time.time()
+    path = self.path.split("?", 1)[0]
+    for route_method, regex, name, template in self.ROUTES:
+      match = re.match(regex, path)
+      if route_method == method and match:
+        break
+    else:
+      self.ReadBody()
+      self.Respond(404, "No such page: %s" % path)
+      return
+    wire_bytes, body = self.ReadBody()
+    if body is None:
+      return
+    getattr(self, name)(body, *[int(g) for g in match.groups()])
+    store = self.server.store
+    store.lock.acquire()
+    try:
+      store.RecordRequest(template, wire_bytes, len(body),
+                          time.time() - start)
+    finally:
+      store.lock.release()
+    if self.server.verbose:
+      print "%s %s: %d bytes on the wire, %d decoded (%s)" % (
+          method, path, wire_bytes, len(body),
+          self.headers.get("Content-Encoding", "identity"))
+
+  def ReadBody(self):
+    """Returns (wire bytes, decoded body), or (n, None) after an error."""
+    length = int(self.headers.get("Content-Length", 0))
+    raw = self.rfile.read(length) if length else ""
+    encoding = self.headers.get("Content-Encoding", "identity")
+    try:
+      if encoding == "gzip":
+        body = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+      elif encoding == "deflate":
+        body = zlib.decompress(raw)
+      elif encoding == "identity":
+        body = raw
+      else:
+        self.Respond(415, "Unsupported Content-Encoding %s" % encoding)
+        return length, None
+    except zlib.error, e:
+      self.Respond(400, "Bad %s request body: %s" % (encoding, e))
+      return length, None
+    return length, body
+
+  def ParseForm(self, body):
+    """Returns the multipart/form-data fields of body as a dict."""
+    form = cgi.FieldStorage(
+        fp=StringIO.StringIO(body),
+        headers={"content-type": self.headers.get("Content-Type", ""),
+                 "content-length": str(len(body))},
+        environ={"REQUEST_METHOD": "POST"},
+        keep_blank_values=True)
+    fields = {}
+    for key in form.keys():
+      fields[key] = form.getfirst(key)
+    return fields
+
+  def Respond(self, code, body, content_type="text/plain", headers=None):
+    self.send_response(code)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def RespondCacheable(self, body, content_type):
+    """Responds with an ETag, or with 304 if the client has this body."""
+    etag = '"%s"' % md5(body).hexdigest()
+    if self.headers.get("If-None-Match") == etag:
+      self.Respond(304, "", headers={"ETag": etag})
+      return
+    self.Respond(200, body, content_type=content_type,
+                 headers={"ETag": etag})
+
+  def log_message(self, format, *args):
+    if self.server.verbose > 1:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  # Upload protocol.
+
+  def Upload(self, body):
+    fields = self.ParseForm(body)
+    store = self.server.store
+    store.lock.acquire()
+    try:
+      if fields.get("issue"):
+        issue_id = int(fields["issue"])
+        if issue_id not in store.issues:
+          self.Respond(404, "No issue exists with that id (%d)" % issue_id)
+          return
+        issue = store.issues[issue_id]
+        msg = "Issue updated."
+      else:
+        issue_id = store.NewId()
+        issue = store.issues[issue_id] = {
+            "subject": fields.get("subject", ""),
+            "description": fields.get("description", ""),
+            "owner_email": fields.get("user", "test@example.com"),
+            "reviewers": filter(None, fields.get("reviewers", "").split(",")),
+            "cc": filter(None, fields.get("cc", "").split(",")),
+            "base_url": fields.get("base", ""),
+            "private": bool(fields.get("private")),
+            "closed": False,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "patchsets": [],
+            "messages": []}
+        msg = "Issue created."
+      issue["modified"] = time.strftime("%Y-%m-%d %H:%M:%S")
+      patchset_id = store.NewId()
+      store.patchsets[patchset_id] = {"issue": issue_id, "files": {}}
+      issue["patchsets"].append(patchset_id)
+
+      base_hashes = {}
+      for entry in filter(None, fields.get("base_hashes", "").split("|")):
+        checksum, filename = entry.split(":", 1)
+        base_hashes[filename] = checksum
+
+      lines = ["%s URL: http://%s/%d" % (msg, self.headers.get("Host"),
+                                         issue_id),
+               str(patchset_id)]
+      for filename, text in upload.SplitPatch(fields.get("data", "")):
+        patch_id = store.NewPatch(patchset_id, filename, text)
+        lines.append("%s %s" % (self.PatchKey(issue_id, patch_id, filename,
+                                              base_hashes),
+                                filename))
+    finally:
+      store.lock.release()
+    self.Respond(200, "\n".join(lines))
+
+  def PatchKey(self, issue_id, patch_id, filename, base_hashes):
+    """Returns "nobase_ID" if an earlier patchset has the same base file."""
+    store = self.server.store
+    previous = None
+    if filename in base_hashes:
+      previous = store.FindPreviousBase(issue_id, filename,
+                                        base_hashes[filename])
+    if previous is None:
+      return str(patch_id)
+    store.patches[patch_id]["base"] = previous["base"]
+    return "nobase_%d" % patch_id
+
+  def UploadPatch(self, body, issue_id, patchset_id):
+    fields = self.ParseForm(body)
+    store = self.server.store
+    store.lock.acquire()
+    try:
+      if patchset_id not in store.patchsets:
+        self.Respond(404, "No patch set exists with that id (%d)" %
+                     patchset_id)
+        return
+      patch_id = store.NewPatch(patchset_id, fields["filename"],
+                                fields.get("data", ""))
+    finally:
+      store.lock.release()
+    self.Respond(200, "OK\n%d" % patch_id)
+
+  def UploadContent(self, body, issue_id, patchset_id, patch_id):
+    fields = self.ParseForm(body)
+    content = fields.get("data", "")
+    if (not fields.get("file_too_large") and
+        md5(content).hexdigest() != fields.get("checksum")):
+      self.Respond(200, "ERROR: Checksum mismatch for %s." %
+                   fields.get("filename"))
+      return
+    store = self.server.store
+    store.lock.acquire()
+    try:
+      if patch_id not in store.patches:
+        self.Respond(404, "No patch exists with that id (%d)" % patch_id)
+        return
+      if fields.get("is_current") == "True":
+        store.patches[patch_id]["current"] = content
+      else:
+        store.patches[patch_id]["base"] = content
+    finally:
+      store.lock.release()
+    self.Respond(200, "OK")
+
+  def UploadPatchChunk(self, body, issue_id, patchset_id):
+    fields = self.ParseForm(body)
+    store = self.server.store
+    store.lock.acquire()
+    try:
+      if patchset_id not in store.patchsets:
+        self.Respond(404, "No patch set exists with that id (%d)" %
+                     patchset_id)
+        return
+      filename = fields["filename"]
+      patch_id = store.patchsets[patchset_id]["files"].get(filename)
+      if (patch_id is not None and
+          md5(store.patches[patch_id]["text"]).hexdigest() ==
+          fields.get("checksum")):
+        # The last chunk was sent again after the patch was assembled.
+        self.Respond(200, "OK\n%d" % patch_id)
+        return
+      text, error = store.AddChunk((patchset_id, filename), fields)
+      if text is not None:
+        patch_id = store.NewPatch(patchset_id, filename, text)
+    finally:
+      store.lock.release()
+    if error:
+      self.Respond(200, "ERROR: %s" % error)
+    elif text is None:
+      self.Respond(200, "OK")
+    else:
+      self.Respond(200, "OK\n%d" % patch_id)
+
+  def UploadContentChunk(self, body, issue_id, patchset_id, patch_id):
+    fields = self.ParseForm(body)
+    is_current = fields.get("is_current") == "True"
+    store = self.server.store
+    store.lock.acquire()
+    try:
+      if patch_id not in store.patches:
+        self.Respond(404, "No patch exists with that id (%d)" % patch_id)
+        return
+      content, error = store.AddChunk((patch_id, is_current), fields)
+      if content is not None:
+        store.patches[patch_id][is_current and "current" or "base"] = content
+    finally:
+      store.lock.release()
+    if error:
+      self.Respond(200, "ERROR: %s" % error)
+    else:
+      self.Respond(200, "OK")
+
+  def Mail(self, body, issue_id):
+    self.Respond(200, "OK")
+
+  # Pages read by cr.py.
+
+  def IssuePage(self, body, issue_id):
+    issue = self.server.store.issues.get(issue_id)
+    if issue is None:
+      self.Respond(404, "No issue exists with that id (%d)" % issue_id)
+      return
+    messages = []
+    for i, (commenter, text) in enumerate(issue["messages"]):
+      messages.append(
+          '<div id="msg%d" name="%d"><div><table><tr>'
+          '<td>%s</td><td></td><td></td><td>just now</td>'
+          '</tr></table></div><div class="message-body">%s</div></div>' %
+          (i + 1, i + 1, cgi.escape(commenter), cgi.escape(text)))
+    html = ("<html><head><script>var xsrfToken = 'localxsrf';</script>"
+            "<title>%s</title></head><body>%s%s</body></html>" %
+            (cgi.escape(issue["subject"]),
+             "Closed" if issue["closed"] else "",
+             "".join(messages)))
+    self.RespondCacheable(html, "text/html; charset=utf-8")
+
+  def ApiIssue(self, body, issue_id):
+    issue = self.server.store.issues.get(issue_id)
+    if issue is None:
+      self.Respond(404, "No issue exists with that id (%d)" % issue_id)
+      return
+    api_data = dict((key, value) for key, value in issue.items()
+                    if key != "messages")
+    api_data["issue"] = issue_id
+    api_data["owner"] = issue["owner_email"].split("@")[0]
+    self.RespondCacheable(json.dumps(api_data, sort_keys=True),
+                          "application/json")
+
+  def Close(self, body, issue_id):
+    issue = self.server.store.issues.get(issue_id)
+    if issue is None:
+      self.Respond(404, "No issue exists with that id (%d)" % issue_id)
+      return
+    issue["closed"] = True
+    self.Respond(200, "Closed")
+
+  def Publish(self, body, issue_id):
+    issue = self.server.store.issues.get(issue_id)
+    if issue is None:
+      self.Respond(404, "No issue exists with that id (%d)" % issue_id)
+      return
+    fields = cgi.parse_qs(body)
+    issue["messages"].append(("me", fields.get("message", [""])[0]))
+    self.Respond(302, "Found",
+                 headers={"Location": "http://%s/%d" %
+                                      (self.headers.get("Host"), issue_id)})
+
+  def Stats(self, body):
+    store = self.server.store
+    store.lock.acquire()
+    try:
+      stats = json.dumps(store.stats, indent=2, sort_keys=True)
+    finally:
+      store.lock.release()
+    self.Respond(200, stats, content_type="application/json")
+
+
+class LocalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """A threaded HTTP server holding one IssueStore."""
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, verbose=0):
+    BaseHTTPServer.HTTPServer.__init__(self, address, LocalServerHandler)
+    self.store = IssueStore()
+    self.verbose = verbose
+
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [options]")
+  parser.add_option("--host", action="store", dest="host",
+                    default="localhost",
+                    help="Address to listen on (default '%default').")
+  parser.add_option("-p", "--port", type="int", action="store", dest="port",
+                    default=8080,
+                    help="Port to listen on (default %default).")
+  parser.add_option("-v", "--verbose", action="count", dest="verbose",
+                    default=0,
+                    help="Print a line per request; twice for access logs.")
+  options, args = parser.parse_args(sys.argv[1:])
+  server = LocalServer((options.host, options.port), options.verbose)
+  print "Serving on http://%s:%d/" % (options.host, server.server_port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    print
+
+
+if __name__ == "__main__":
+  main()
@@ -33,23 +33,40 @@ against by using the '--rev' option.
 # This code is derived from appcfg.py in the App Engine SDK (open source),
 # and from ASPN recipe #146306.
 
+import atexit
 import ConfigParser
 import cookielib
 import errno
 import fnmatch
 import getpass
+import httplib
+import json
 import logging
 import marshal
 import mimetypes
 import optparse
 import os
+import Queue
+import random
 import re
+import select
 import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import urllib
 import urllib2
 import urlparse
+import zlib
+from xml.etree import ElementTree
+
+try:
+  import cStringIO as StringIO
+except ImportError:
+  import StringIO
 
 # The md5 module was deprecated in Python 2.5.
 try:
@@ -84,9 +101,18 @@ AUTH_ACCOUNT_TYPE = "HOSTED"
 DEFAULT_REVIEW_SERVER = os.environ.get('CR_SERVER',
                                        "code.__MY_DOMAIN__.com")
 
-# Max size of patch or base file.
+# Max size of patch or base file sent in one request. Larger ones are sent
+# in chunks of this size, see UploadInChunks.
 MAX_UPLOAD_SIZE = 900 * 1024
 
+# Content-Encodings CompressBody supports for --compress.
+UPLOAD_COMPRESSIONS = ("gzip", "deflate")
+
+# Content-Encoding for uploaded patches and files, one of UPLOAD_COMPRESSIONS
+# or None. Can be changed with --compress; checked before the parser below
+# is built.
+DEFAULT_UPLOAD_COMPRESSION = os.environ.get('CR_UPLOAD_COMPRESSION') or None
+
 # Constants for version control names.  Used by GuessVCSName.
 VCS_GIT = "Git"
 VCS_MERCURIAL = "Mercurial"
@@ -157,7 +183,9 @@ def StatusUpdate(msg):
     msg: The string to print.
   """
   if verbosity > 0:
-    print msg
+    # One write per message, so that messages from parallel uploads
+    # don't end up on the same line.
+    sys.stdout.write(msg + "\n")
 
 
 def ErrorExit(msg):
@@ -166,6 +194,28 @@ def ErrorExit(msg):
   sys.exit(1)
 
 
+def GetEnvironmentInt(name, default, minimum):
+  """Returns the integer in an environment variable, exiting if it is invalid.
+
+  Args:
+    name: Name of the environment variable.
+    default: Value used when the variable is unset or empty.
+    minimum: Smallest value accepted.
+
+  Returns:
+    The value as an int.
+  """
+  value = os.environ.get(name) or str(default)
+  try:
+    number = int(value)
+  except ValueError:
+    number = None
+  if number is None or number < minimum:
+    ErrorExit("Invalid $%s %r, must be an integer of at least %d" %
+              (name, value, minimum))
+  return number
+
+
 class ClientLoginError(urllib2.HTTPError):
   """Raised to indicate there was an error authenticating with ClientLogin."""
 
@@ -176,11 +226,415 @@ class ClientLoginError(urllib2.HTTPError):
     self.info = args.get("Info", None)
 
 
+class ConnectionPool(object):
+  """Keeps idle persistent HTTP connections around, keyed by host.
+
+  Connections are checked out for the duration of one request and returned
+  afterwards, so a pool may be shared by several threads. Idle connections
+  the server has closed in the meantime are discarded instead of handed out.
+  """
+
+  def __init__(self, max_idle_per_host=8):
+    """Creates a new ConnectionPool.
+
+    Args:
+      max_idle_per_host: Number of idle connections kept open per host.
+        Connections beyond that are closed when they are returned.
+    """
+    self.max_idle_per_host = max_idle_per_host
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def Get(self, key, connection_factory):
+    """Returns a (connection, reused) tuple for the given key.
+
+    An idle connection is handed out if there is one, otherwise
+    connection_factory is called to create a fresh one.
+    """
+    while True:
+      self._lock.acquire()
+      try:
+        idle = self._idle.get(key)
+        if not idle:
+          break
+        conn = idle.pop()
+      finally:
+        self._lock.release()
+      if not _IsClosedByServer(conn):
+        return conn, True
+      logging.debug("Discarding idle connection closed by the server")
+      conn.close()
+    return connection_factory(), False
+
+  def Put(self, key, conn):
+    """Returns a connection to the pool after its response was read."""
+    self._lock.acquire()
+    try:
+      idle = self._idle.setdefault(key, [])
+      if len(idle) < self.max_idle_per_host:
+        idle.append(conn)
+        return
+    finally:
+      self._lock.release()
+    conn.close()
+
+  def CloseAll(self):
+    """Closes every idle connection."""
+    self._lock.acquire()
+    try:
+      idle, self._idle = self._idle, {}
+    finally:
+      self._lock.release()
+    for conns in idle.values():
+      for conn in conns:
+        conn.close()
+
+
+def _IsClosedByServer(conn):
+  """Whether an idle connection has become readable, i.e. was closed.
+
+  Nothing is expected on an idle HTTP/1.1 connection, so anything to read
+  is the server's FIN (or garbage), and the connection can't be used.
+  """
+  if conn.sock is None:
+    # httplib opens a new socket for the next request.
+    return False
+  try:
+    return bool(select.select([conn.sock], [], [], 0)[0])
+  except (select.error, socket.error, ValueError):
+    return True
+
+
+def _IsDroppedConnection(err):
+  """Whether err is how a server's closing of an idle connection shows up.
+
+  A server may close a keep-alive connection at any time while it is idle.
+  A request sent on it then fails with a reset or broken pipe, or with an
+  empty status line, before any byte of a response arrives.
+  """
+  if isinstance(err, httplib.BadStatusLine):
+    return (err.line in ("", "''") or
+            err.line.startswith("No status line received"))
+  return (isinstance(err, socket.error) and
+          err.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
+class KeepAliveHandlerMixin(object):
+  """Opens urllib2 requests on pooled HTTP/1.1 keep-alive connections.
+
+  Unlike urllib2.AbstractHTTPHandler.do_open, the response body is read
+  completely before returning, so the connection can go back to the pool
+  and be reused by the next request to the same host.
+
+  A request whose reused connection turns out to be dropped is sent again
+  on a new one, but only if no part of a response had arrived. Once a
+  request with a payload was sent completely, it is only sent again if its
+  urllib2.Request has a true "idempotent" attribute, as set by
+  AbstractRpcServer.Send: the server may have handled it before the
+  connection died. All other errors raise urllib2.URLError and are left to
+  the caller's RetryPolicy.
+  """
+
+  def _KeepAliveOpen(self, connection_class, req):
+    host = req.get_host()
+    if not host:
+      raise urllib2.URLError("no host given")
+
+    headers = dict(req.unredirected_hdrs)
+    headers.update(dict((k, v) for k, v in req.headers.items()
+                        if k not in headers))
+    headers["Connection"] = "keep-alive"
+    headers = dict((name.title(), val) for name, val in headers.items())
+    tunnel_headers = {}
+    if req._tunnel_host and "Proxy-Authorization" in headers:
+      # Proxy-Authorization should not be sent to the origin server.
+      tunnel_headers["Proxy-Authorization"] = headers.pop(
+          "Proxy-Authorization")
+    key = (connection_class.__name__, host, req._tunnel_host)
+
+    def NewConnection():
+      conn = connection_class(host, timeout=req.timeout)
+      if req._tunnel_host:
+        conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+      return conn
+
+    idempotent = getattr(req, "idempotent", req.get_data() is None)
+    while True:
+      conn, reused = self.connection_pool.Get(key, NewConnection)
+      if hasattr(req.data, "seek"):
+        req.data.seek(0)
+      if reused and conn.sock:
+        # The socket keeps the timeout it was opened with; apply this one's.
+        timeout = req.timeout
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+          timeout = socket.getdefaulttimeout()
+        conn.sock.settimeout(timeout)
+      sent = False
+      try:
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        sent = True
+        r = conn.getresponse()
+      except (httplib.HTTPException, socket.error), err:
+        conn.close()
+        # Once the whole request was sent, even an empty status line may
+        # mean the server handled it and failed before answering.
+        if reused and _IsDroppedConnection(err) and (idempotent or not sent):
+          logging.debug("Re-opening dropped connection to %s", host)
+          continue
+        raise urllib2.URLError(err)
+      try:
+        first_byte_time = time.time()
+        body = r.read()
+      except (httplib.HTTPException, socket.error), err:
+        # The server has answered, so the request must not be resent here.
+        conn.close()
+        raise urllib2.URLError(err)
+      break
+
+    if r.will_close:
+      conn.close()
+    else:
+      self.connection_pool.Put(key, conn)
+
+    resp = urllib.addinfourl(StringIO.StringIO(body), r.msg,
+                             req.get_full_url())
+    resp.code = r.status
+    resp.msg = r.reason
+    resp.first_byte_time = first_byte_time
+    return resp
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+  """HTTP handler that reuses connections from a ConnectionPool."""
+
+  def __init__(self, connection_pool):
+    urllib2.HTTPHandler.__init__(self)
+    self.connection_pool = connection_pool
+
+  def http_open(self, req):
+    return self._KeepAliveOpen(httplib.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+  """HTTPS handler that reuses connections from a ConnectionPool.
+
+  Keeping the TLS connection open means the handshake is only paid once per
+  pooled connection instead of once per request.
+  """
+
+  def __init__(self, connection_pool):
+    urllib2.HTTPSHandler.__init__(self)
+    self.connection_pool = connection_pool
+
+  def https_open(self, req):
+    return self._KeepAliveOpen(httplib.HTTPSConnection, req)
+
+
+class RetryPolicy(object):
+  """Decides whether a failed RPC is retried and how long to wait first.
+
+  Delays grow exponentially with "full jitter" (a random delay between zero
+  and the exponential cap), so clients that failed together don't retry in
+  lockstep. No retry is started once the total time spent on a call would
+  exceed the budget.
+  """
+
+  def __init__(self, max_tries=4, initial_delay=0.5, max_delay=16.0,
+               budget=60.0, clock=time.time, sleep=time.sleep,
+               random_source=random):
+    """Creates a new RetryPolicy.
+
+    Args:
+      max_tries: Maximum number of attempts per call, including the first.
+      initial_delay: Cap in seconds of the delay before the first retry.
+      max_delay: Cap in seconds of any single delay.
+      budget: Maximum number of seconds a call may spend, including retries.
+      clock: Function returning the current time in seconds.
+      sleep: Function waiting for a number of seconds.
+      random_source: Object whose uniform(a, b) picks the jittered delays,
+        e.g. a random.Random. Defaults to the random module.
+    """
+    self.max_tries = max_tries
+    self.initial_delay = initial_delay
+    self.max_delay = max_delay
+    self.budget = budget
+    self.clock = clock
+    self.sleep = sleep
+    self.random_source = random_source
+
+  def IsRetryable(self, error, idempotent):
+    """Classifies an error raised while sending a request.
+
+    Args:
+      error: An urllib2.HTTPError, urllib2.URLError, httplib.HTTPException
+        or socket.error.
+      idempotent: Whether the request may safely reach the server twice.
+
+    Returns:
+      True if the request should be tried again.
+    """
+    if isinstance(error, urllib2.HTTPError):
+      if error.code == 503:
+        # The server shed the request without processing it.
+        return True
+      return idempotent and 500 <= error.code < 600
+    reason = getattr(error, "reason", error)
+    if isinstance(reason, socket.timeout):
+      return idempotent
+    if isinstance(reason, socket.error):
+      if reason.errno == errno.ECONNREFUSED:
+        # Nothing was sent.
+        return True
+      return idempotent and reason.errno in (errno.ECONNRESET, errno.EPIPE,
+                                             errno.ETIMEDOUT)
+    if isinstance(reason, httplib.HTTPException):
+      # E.g. BadStatusLine: the connection died before a response.
+      return idempotent
+    return False
+
+  def Backoff(self, retries):
+    """Returns a jittered delay in seconds before retry number retries."""
+    cap = min(self.max_delay, self.initial_delay * 2 ** (retries - 1))
+    return self.random_source.uniform(0, cap)
+
+  def NextDelay(self, error, idempotent, retries, start_time):
+    """Returns the seconds to wait before retrying, or None to give up.
+
+    Args:
+      error: The error raised by the last attempt.
+      idempotent: Whether the request may safely reach the server twice.
+      retries: Number of retries already made for this call.
+      start_time: The policy's clock() when the call started.
+    """
+    if retries + 1 >= self.max_tries or not self.IsRetryable(error,
+                                                              idempotent):
+      return None
+    delay = self.Backoff(retries + 1)
+    if isinstance(error, urllib2.HTTPError):
+      retry_after = error.info().get("Retry-After", "")
+      if retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    if self.clock() - start_time + delay > self.budget:
+      return None
+    return delay
+
+  def Attempts(self):
+    """Yields attempt numbers 0, 1, ..., sleeping with backoff in between.
+
+    For retry loops whose failures are not exceptions, e.g. an unexpected
+    response page. Stops after max_tries attempts or when the budget is
+    used up.
+    """
+    start_time = self.clock()
+    attempt = 0
+    while True:
+      yield attempt
+      attempt += 1
+      if attempt >= self.max_tries:
+        return
+      delay = self.Backoff(attempt)
+      if self.clock() - start_time + delay > self.budget:
+        return
+      self.sleep(delay)
+
+
+class RpcStats(object):
+  """Collects metrics of every request made through AbstractRpcServer.Send.
+
+  Each request is recorded as a dict with its method, path template (numeric
+  path components replaced by N), status, bytes sent and received, time to
+  first byte and total latency in seconds, number of retries, and the number
+  and duration of authentications it needed.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.requests = []
+    self.dump_path = None
+
+  @staticmethod
+  def PathTemplate(request_path):
+    """Returns request_path with numeric components replaced by N."""
+    return re.sub(r"(?<=/)\d+(?=/|$)", "N", request_path)
+
+  def Record(self, entry):
+    """Adds the metrics of one request."""
+    self.lock.acquire()
+    try:
+      self.requests.append(entry)
+    finally:
+      self.lock.release()
+
+  def Summary(self):
+    """Returns totals per "METHOD /path/template"."""
+    summary = {}
+    self.lock.acquire()
+    try:
+      requests = list(self.requests)
+    finally:
+      self.lock.release()
+    for entry in requests:
+      key = "%s %s" % (entry["method"], entry["path"])
+      totals = summary.setdefault(key, {
+          "count": 0, "errors": 0, "bytes_sent": 0, "bytes_received": 0,
+          "latency": 0.0, "max_latency": 0.0, "retries": 0,
+          "authentications": 0, "auth_seconds": 0.0})
+      totals["count"] += 1
+      if not entry["status"] or entry["status"] >= 400:
+        totals["errors"] += 1
+      for field in ("bytes_sent", "bytes_received", "latency", "retries",
+                    "authentications", "auth_seconds"):
+        totals[field] += entry[field]
+      totals["max_latency"] = max(totals["max_latency"], entry["latency"])
+    return summary
+
+  def Dump(self, path):
+    """Writes the recorded requests and their summary to path as JSON."""
+    self.lock.acquire()
+    try:
+      requests = list(self.requests)
+    finally:
+      self.lock.release()
+    stats_file = open(path, "w")
+    try:
+      json.dump({"requests": requests, "summary": self.Summary()},
+                stats_file, indent=2, sort_keys=True)
+    finally:
+      stats_file.close()
+
+  def DumpAtExit(self, path):
+    """Dumps the statistics to path when the process exits."""
+    if self.dump_path is None:
+      atexit.register(self._DumpAtExit)
+    self.dump_path = path
+
+  def DumpIfRequested(self):
+    """Dumps the statistics now if DumpAtExit was called.
+
+    For processes that end with os._exit, which skips atexit handlers, such
+    as the commands run by cr's agent.
+    """
+    if self.dump_path is not None:
+      self._DumpAtExit()
+
+  def _DumpAtExit(self):
+    try:
+      self.Dump(self.dump_path)
+    except (IOError, OSError), e:
+      print >>sys.stderr, "Could not write RPC statistics to %s: %s" % (
+          self.dump_path, e)
+
+
+# Metrics of all requests made by this process; see --rpc_stats.
+rpc_stats = RpcStats()
+
+
 class AbstractRpcServer(object):
   """Provides a common interface for a simple RPC server."""
 
   def __init__(self, host, auth_function, host_override=None, extra_headers={},
-               save_cookies=False, account_type=AUTH_ACCOUNT_TYPE):
+               save_cookies=False, account_type=AUTH_ACCOUNT_TYPE,
+               retry_policy=None, stats=None):
     """Creates a new HttpRpcServer.
 
     Args:
@@ -195,6 +649,10 @@ class AbstractRpcServer(object):
         implement this functionality.  Defaults to False.
       account_type: Account type used for authentication. Defaults to
         AUTH_ACCOUNT_TYPE.
+      retry_policy: RetryPolicy for server errors and dropped connections.
+        Defaults to RetryPolicy().
+      stats: RpcStats recording every request. Defaults to the module's
+        rpc_stats.
     """
     self.host = host
     if (not self.host.startswith("http://") and
@@ -206,6 +664,12 @@ class AbstractRpcServer(object):
     self.extra_headers = extra_headers
     self.save_cookies = save_cookies
     self.account_type = account_type
+    self.retry_policy = retry_policy or RetryPolicy()
+    self.stats = stats or rpc_stats
+    # Serializes authentication between threads sending at the same time.
+    # _auth_generation counts the authentications done so far.
+    self._auth_lock = threading.Lock()
+    self._auth_generation = 0
     self.opener = self._GetOpener()
     if self.host_override:
       logging.info("Server: %s; Host: %s", self.host, self.host_override)
@@ -223,6 +687,9 @@ class AbstractRpcServer(object):
   def _CreateRequest(self, url, data=None):
     """Creates a new urllib request."""
     logging.debug("Creating request for: '%s' with payload:\n%s", url, data)
+    if hasattr(data, "seek"):
+      # Streamed bodies are re-sent from the start on every attempt.
+      data.seek(0)
     req = urllib2.Request(url, data=data)
     if self.host_override:
       req.add_header("Host", self.host_override)
@@ -356,10 +823,49 @@ class AbstractRpcServer(object):
       self._GetAuthCookie(auth_token)
       return
 
+  def AuthGeneration(self):
+    """Returns the number of authentications done so far.
+
+    Read it before sending a request, and pass it to EnsureAuthenticated if
+    the server refuses the request.
+    """
+    return self._auth_generation
+
+  def EnsureAuthenticated(self, generation=None):
+    """Authenticates, unless this server is or another thread just did.
+
+    Safe to call from several threads at once: only one of them prompts for
+    credentials, and the others use its cookie.
+
+    Args:
+      generation: The AuthGeneration() seen when a request was sent that
+        the server refused with a 401 or 302. Authenticates again unless
+        another thread has done so since. With None, only authenticates if
+        this server isn't authenticated yet.
+
+    Returns:
+      True if this call authenticated.
+    """
+    self._auth_lock.acquire()
+    try:
+      if generation is None:
+        if self.authenticated:
+          return False
+      elif generation != self._auth_generation:
+        return False
+      self._Authenticate()
+      self._auth_generation += 1
+      return True
+    finally:
+      self._auth_lock.release()
+
   def Send(self, request_path, payload=None,
            content_type="application/octet-stream",
            timeout=None,
            extra_headers=None,
+           content_encoding=None,
+           idempotent=None,
+           return_info=False,
            request_password_if_302=True,  # Add(open42):
            **kwargs):
     """Sends an RPC and returns the response.
@@ -373,52 +879,98 @@ class AbstractRpcServer(object):
       extra_headers: Dict containing additional HTTP headers that should be
         included in the request (string header names mapped to their values),
         or None to not include any additional headers.
+      content_encoding: "gzip" or "deflate" to compress the payload and send
+        it with that Content-Encoding, or None to send it as is.
+      idempotent: Whether the request can safely be sent twice, e.g. after
+        the connection was reset. Defaults to True for requests without a
+        payload and False otherwise. See RetryPolicy.IsRetryable.
+      return_info: If True, return the response headers along with the body.
       kwargs: Any keyword arguments are converted into query string parameters.
 
     Returns:
-      The response body, as a string.
+      The response body, as a string, or a (body, headers) tuple if
+      return_info is True.
     """
+    stats = {"method": payload is None and "GET" or "POST",
+             "path": RpcStats.PathTemplate(request_path),
+             "status": 0, "bytes_sent": 0, "bytes_received": 0,
+             "ttfb": None, "latency": 0.0, "retries": 0,
+             "authentications": 0, "auth_seconds": 0.0}
+    start_time = time.time()
+
+    def Authenticate(generation=None):
+      auth_start = time.time()
+      if self.EnsureAuthenticated(generation):
+        stats["authentications"] += 1
+        stats["auth_seconds"] += time.time() - auth_start
+
     # TODO: Don't require authentication.  Let the server say
     # whether it is necessary.
     if not self.authenticated:
-      self._Authenticate()
+      Authenticate()
+
+    if content_encoding and payload is not None:
+      payload = CompressBody(payload, content_encoding)
+      extra_headers = dict(extra_headers or {})
+      extra_headers["Content-Encoding"] = content_encoding
+
+    if idempotent is None:
+      idempotent = payload is None
 
-    old_timeout = socket.getdefaulttimeout()
-    socket.setdefaulttimeout(timeout)
     try:
       tries = 0
+      retries = 0
+      retry_start = self.retry_policy.clock()
       while True:
         tries += 1
+        stats["retries"] = retries
         args = dict(kwargs)
         url = "%s%s" % (self.host, request_path)
         if args:
           url += "?" + urllib.urlencode(args)
         req = self._CreateRequest(url=url, data=payload)
+        req.idempotent = idempotent
         req.add_header("Content-Type", content_type)
         if extra_headers:
           for header, value in extra_headers.items():
             req.add_header(header, value)
+        if payload is not None:
+          stats["bytes_sent"] += len(payload)
+        try_start = time.time()
+        auth_generation = self.AuthGeneration()
         try:
-          f = self.opener.open(req)
+          # The timeout is per request: Send runs on several threads at once,
+          # so the process-wide socket default must not be changed.
+          f = self.opener.open(req, timeout=timeout)
           response = f.read()
           f.close()
+          self._RecordResponse(stats, f, try_start, len(response))
+          if return_info:
+            return response, f.info()
           return response
         except urllib2.HTTPError, e:
+          self._RecordResponse(stats, e.fp, try_start,
+                               int(e.info().get("Content-Length") or 0))
+          stats["status"] = e.code
+          delay = self.retry_policy.NextDelay(e, idempotent, retries,
+                                              retry_start)
+          if delay is not None:
+            retries += 1
+            StatusUpdate("Error %d from %s, retrying in %.1fs..." %
+                         (e.code, request_path, delay))
+            self.retry_policy.sleep(delay)
+            continue
           if tries > 3:
             raise
           elif e.code == 401 or e.code == 302:
             #self._Authenticate()
             # Change start (open42): Don't authenticate again, 302 is normal
             if request_password_if_302:
-              self._Authenticate()
+              Authenticate(auth_generation)
             else:
               logging.debug("e.code = " + str(e))
               raise
             # Change end(open42)
-
-##           elif e.code >= 500 and e.code < 600:
-##             # Server Error - try again.
-##             continue
           elif e.code == 301:
             # Handle permanent redirect manually.
             url = e.info()["location"]
@@ -426,8 +978,28 @@ class AbstractRpcServer(object):
             self.host = '%s://%s' % (url_loc[0], url_loc[1])
           else:
             raise
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+          stats["status"] = 0
+          delay = self.retry_policy.NextDelay(e, idempotent, retries,
+                                              retry_start)
+          if delay is None:
+            raise
+          retries += 1
+          StatusUpdate("Error sending %s (%s), retrying in %.1fs..." %
+                       (request_path, e, delay))
+          self.retry_policy.sleep(delay)
     finally:
-      socket.setdefaulttimeout(old_timeout)
+      stats["latency"] = time.time() - start_time
+      self.stats.Record(stats)
+
+  @staticmethod
+  def _RecordResponse(stats, response, try_start, length):
+    """Fills in the status, size and time to first byte of a response."""
+    stats["status"] = getattr(response, "code", 0) or 0
+    stats["bytes_received"] += length
+    first_byte_time = getattr(response, "first_byte_time", None)
+    if first_byte_time is not None:
+      stats["ttfb"] = first_byte_time - try_start
 
 
 class HttpRpcServer(AbstractRpcServer):
@@ -443,15 +1015,19 @@ class HttpRpcServer(AbstractRpcServer):
   def _GetOpener(self):
     """Returns an OpenerDirector that supports cookies and ignores redirects.
 
+    HTTP and HTTPS requests go through a ConnectionPool so that consecutive
+    RPCs to the review server share one keep-alive connection.
+
     Returns:
       A urllib2.OpenerDirector object.
     """
+    self.connection_pool = ConnectionPool()
     opener = urllib2.OpenerDirector()
     opener.add_handler(urllib2.ProxyHandler())
     opener.add_handler(urllib2.UnknownHandler())
-    opener.add_handler(urllib2.HTTPHandler())
+    opener.add_handler(KeepAliveHTTPHandler(self.connection_pool))
     opener.add_handler(urllib2.HTTPDefaultErrorHandler())
-    opener.add_handler(urllib2.HTTPSHandler())
+    opener.add_handler(KeepAliveHTTPSHandler(self.connection_pool))
     opener.add_handler(urllib2.HTTPErrorProcessor())
     if self.save_cookies:
       self.cookie_file = os.path.expanduser("~/.codereview_upload_cookies")
@@ -478,6 +1054,14 @@ class HttpRpcServer(AbstractRpcServer):
     return opener
 
 
+# Number of files uploaded concurrently. Can be changed with --upload_threads.
+DEFAULT_UPLOAD_THREADS = GetEnvironmentInt('CR_UPLOAD_THREADS', 8, 1)
+
+# optparse would reject a bad default with a traceback on every parse_args.
+if DEFAULT_UPLOAD_COMPRESSION not in (None,) + UPLOAD_COMPRESSIONS:
+  ErrorExit("Invalid $CR_UPLOAD_COMPRESSION %r, must be one of: %s" %
+            (DEFAULT_UPLOAD_COMPRESSION, ", ".join(UPLOAD_COMPRESSIONS)))
+
 parser = optparse.OptionParser(
     usage="%prog [options] [-- diff_options] [path...]")
 parser.add_option("-y", "--assume_yes", action="store_true",
@@ -494,6 +1078,10 @@ group.add_option("--noisy", action="store_const", const=3,
                  dest="verbose", help="Print all logs.")
 group.add_option("--print_diffs", dest="print_diffs", action="store_true",
                  help="Print full diffs.")
+group.add_option("--rpc_stats", action="store", dest="rpc_stats",
+                 metavar="FILE", default=None,
+                 help="Write per-request timings and sizes to FILE as JSON "
+                      "when done.")
 # Review server
 group = parser.add_option_group("Review server options")
 group.add_option("-s", "--server", action="store", dest="server",
@@ -566,6 +1154,27 @@ group.add_option("--vcs", action="store", dest="vcs",
 group.add_option("--emulate_svn_auto_props", action="store_true",
                  dest="emulate_svn_auto_props", default=False,
                  help=("Emulate Subversion's auto properties feature."))
+group.add_option("--upload_threads", type="int", action="store",
+                 dest="upload_threads", metavar="N",
+                 default=DEFAULT_UPLOAD_THREADS,
+                 help=("Number of files to read and upload in parallel. "
+                       "Defaults to $CR_UPLOAD_THREADS or %default."))
+group.add_option("--async_uploads", action="store_true",
+                 dest="async_uploads", default=False,
+                 help=("Send the file and patch uploads from one thread over "
+                       "up to --upload_threads connections, instead of one "
+                       "thread per upload. Ignored behind a proxy."))
+group.add_option("--compress", action="store", dest="compress",
+                 metavar="ENCODING", default=DEFAULT_UPLOAD_COMPRESSION,
+                 choices=list(UPLOAD_COMPRESSIONS),
+                 help=("Compress uploaded patches and files with 'gzip' or "
+                       "'deflate'. The server must accept compressed "
+                       "request bodies. Defaults to $CR_UPLOAD_COMPRESSION."))
+group.add_option("--resume", action="store_true", dest="resume",
+                 default=False,
+                 help=("Continue an interrupted upload of the same diff, "
+                       "uploading only the patches and files it did not "
+                       "finish."))
 # Perforce-specific
 group = parser.add_option_group("Perforce-specific options "
                                 "(overrides P4 environment variables)")
@@ -650,43 +1259,213 @@ def GetRpcServer(server, email=None, host_override=None, save_cookies=True,
                           save_cookies=save_cookies)
 
 
-def EncodeMultipartFormData(fields, files):
-  """Encode form fields for multipart/form-data.
+class MultipartFormData(object):
+  """A multipart/form-data request body that is produced while it is sent.
+
+  The body is kept as a list of parts, each either a string or a
+  (file object, offset, length) tuple, so no copy of the whole payload is
+  ever built. It behaves like a read-only file: httplib streams it to the
+  socket in blocks, and len() gives the Content-Length up front.
+  """
+
+  def __init__(self, parts):
+    """Creates a new MultipartFormData.
+
+    Args:
+      parts: A sequence of strings and (file object, offset, length) tuples.
+    """
+    self._parts = parts
+    self._length = 0
+    for part in parts:
+      if isinstance(part, str):
+        self._length += len(part)
+      else:
+        self._length += part[2]
+    self.seek(0)
+
+  def __len__(self):
+    return self._length
+
+  def __iter__(self):
+    """Yields the body in blocks of up to 64KB."""
+    self.seek(0)
+    while True:
+      chunk = self.read(64 * 1024)
+      if not chunk:
+        break
+      yield chunk
+
+  def seek(self, offset, whence=0):
+    """Rewinds the body, e.g. before resending a request.
+
+    Only seek(0) is supported.
+    """
+    if offset or whence:
+      raise IOError("MultipartFormData can only be rewound to the start")
+    self._index = 0
+    self._offset = 0
+
+  def read(self, size=-1):
+    """Returns up to size bytes of the body, or the rest if size < 0."""
+    chunks = []
+    while self._index < len(self._parts) and size != 0:
+      part = self._parts[self._index]
+      if isinstance(part, str):
+        part_length = len(part)
+        if size < 0:
+          chunk = part[self._offset:]
+        else:
+          chunk = part[self._offset:self._offset + size]
+      else:
+        fileobj, start, part_length = part
+        remaining = part_length - self._offset
+        if size >= 0:
+          remaining = min(size, remaining)
+        fileobj.seek(start + self._offset)
+        chunk = fileobj.read(remaining)
+        if len(chunk) != remaining:
+          raise IOError("File changed size while being uploaded")
+      self._offset += len(chunk)
+      if size > 0:
+        size -= len(chunk)
+      chunks.append(chunk)
+      if self._offset >= part_length:
+        self._index += 1
+        self._offset = 0
+    return "".join(chunks)
+
+
+def EncodeMultipartFormDataStream(fields, files):
+  """Encode form fields for multipart/form-data without joining them.
 
   Args:
     fields: A sequence of (name, value) elements for regular form fields.
     files: A sequence of (name, filename, value) elements for data to be
-           uploaded as files.
+           uploaded as files. value is either a string or a file object
+           opened in binary mode, which is read from its current position
+           to the end while the request is sent.
   Returns:
-    (content_type, body) ready for httplib.HTTP instance.
-
-  Source:
-    http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/146306
+    (content_type, body) where body is a MultipartFormData.
   """
   BOUNDARY = '-M-A-G-I-C---B-O-U-N-D-A-R-Y-'
   CRLF = '\r\n'
-  lines = []
+  parts = []
   for (key, value) in fields:
-    lines.append('--' + BOUNDARY)
-    lines.append('Content-Disposition: form-data; name="%s"' % key)
-    lines.append('')
     if isinstance(value, unicode):
       value = value.encode('utf-8')
-    lines.append(value)
+    parts.append(CRLF.join(['--' + BOUNDARY,
+                            'Content-Disposition: form-data; name="%s"' % key,
+                            '',
+                            value,
+                            '']))
   for (key, filename, value) in files:
-    lines.append('--' + BOUNDARY)
-    lines.append('Content-Disposition: form-data; name="%s"; filename="%s"' %
-             (key, filename))
-    lines.append('Content-Type: %s' % GetContentType(filename))
-    lines.append('')
+    parts.append(CRLF.join([
+        '--' + BOUNDARY,
+        'Content-Disposition: form-data; name="%s"; filename="%s"' %
+        (key, filename),
+        'Content-Type: %s' % GetContentType(filename),
+        '',
+        '']))
     if isinstance(value, unicode):
       value = value.encode('utf-8')
-    lines.append(value)
-  lines.append('--' + BOUNDARY + '--')
-  lines.append('')
-  body = CRLF.join(lines)
+    if isinstance(value, str):
+      parts.append(value)
+    else:
+      start = value.tell()
+      value.seek(0, os.SEEK_END)
+      parts.append((value, start, value.tell() - start))
+    parts.append(CRLF)
+  parts.append('--' + BOUNDARY + '--' + CRLF)
   content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
-  return content_type, body
+  return content_type, MultipartFormData(parts)
+
+
+def EncodeMultipartFormData(fields, files):
+  """Encode form fields for multipart/form-data.
+
+  Args:
+    fields: A sequence of (name, value) elements for regular form fields.
+    files: A sequence of (name, filename, value) elements for data to be
+           uploaded as files.
+  Returns:
+    (content_type, body) ready for httplib.HTTP instance.
+
+  Source:
+    http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/146306
+  """
+  content_type, body = EncodeMultipartFormDataStream(fields, files)
+  return content_type, body.read()
+
+
+def CompressBody(body, encoding):
+  """Compresses a request body for the given HTTP Content-Encoding.
+
+  Args:
+    body: A string or a MultipartFormData. A MultipartFormData is compressed
+      block by block, so only the compressed body is held in memory.
+    encoding: "gzip" or "deflate" (zlib format, as HTTP defines it).
+
+  Returns:
+    The compressed body, as a string.
+  """
+  if encoding == "gzip":
+    wbits = 16 + zlib.MAX_WBITS
+  elif encoding == "deflate":
+    wbits = zlib.MAX_WBITS
+  else:
+    raise ValueError("Unsupported Content-Encoding %r" % encoding)
+  compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+  if isinstance(body, basestring):
+    body = [body]
+  compressed = [compressor.compress(chunk) for chunk in body]
+  compressed.append(compressor.flush())
+  return "".join(compressed)
+
+
+def UploadInChunks(rpc_server, url, form_fields, filename, content, options):
+  """Uploads content larger than MAX_UPLOAD_SIZE as a series of chunks.
+
+  Each chunk of up to MAX_UPLOAD_SIZE bytes is posted to url in its own
+  multipart/form-data request, along with form_fields, its index, the number
+  of chunks, its MD5 checksum and the checksum of the whole content, so the
+  server can reassemble the chunks in order and verify them. Only one chunk
+  is encoded (and compressed) at a time. Chunks may be sent again, so each
+  one is retried like any idempotent request.
+
+  Args:
+    rpc_server: The RPC server to send the chunks with.
+    url: The chunk upload URL, e.g. /ISSUE/upload_content_chunk/PS/FILE.
+    form_fields: A list of (name, value) fields sent with every chunk.
+    filename: The filename of the multipart "data" part.
+    content: The string to upload.
+    options: The command line options, for --compress.
+
+  Returns:
+    The response to the last chunk or the first one that didn't start with
+    "OK", or None if the server doesn't support chunked uploads.
+  """
+  chunk_count = (len(content) + MAX_UPLOAD_SIZE - 1) // MAX_UPLOAD_SIZE
+  checksum = md5(content).hexdigest()
+  response_body = None
+  for index in xrange(chunk_count):
+    chunk = content[index * MAX_UPLOAD_SIZE:(index + 1) * MAX_UPLOAD_SIZE]
+    fields = list(form_fields) + [("checksum", checksum),
+                                  ("chunk_index", str(index)),
+                                  ("chunk_count", str(chunk_count)),
+                                  ("chunk_checksum", md5(chunk).hexdigest())]
+    ctype, body = EncodeMultipartFormDataStream(fields,
+                                                [("data", filename, chunk)])
+    try:
+      response_body = rpc_server.Send(url, body, content_type=ctype,
+                                      content_encoding=options.compress,
+                                      idempotent=True)
+    except urllib2.HTTPError, e:
+      if index == 0 and e.code == 404:
+        return None
+      raise
+    if not response_body.startswith("OK"):
+      break
+  return response_body
 
 
 def GetContentType(filename):
@@ -754,10 +1533,252 @@ def RunShell(command, silent_ok=False, universal_newlines=True,
     ErrorExit("No output from %s" % command)
   return data
 
+def ParallelMap(function, items, num_threads):
+  """Calls function on every item, using up to num_threads worker threads.
+
+  Items are handed out in the given order, so callers can put the most
+  expensive work first. Once a call fails no further items are started.
+
+  Args:
+    function: A function taking a single item.
+    items: A sequence of items.
+    num_threads: Maximum number of concurrent calls. With 1 or less, the
+      items are processed one after another in the calling thread.
+
+  Returns:
+    A list with the result of function for each item, in the order of items.
+    If any call raised an exception (including SystemExit from ErrorExit),
+    the first one is re-raised in the calling thread.
+  """
+  items = list(items)
+  if num_threads <= 1 or len(items) <= 1:
+    return [function(item) for item in items]
+
+  results = [None] * len(items)
+  errors = []
+  work = Queue.Queue()
+  for index, item in enumerate(items):
+    work.put((index, item))
+
+  def Worker():
+    while not errors:
+      try:
+        index, item = work.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[index] = function(item)
+      except:
+        errors.append(sys.exc_info())
+
+  threads = []
+  for unused in range(min(num_threads, len(items))):
+    thread = threading.Thread(target=Worker)
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    # Join with a timeout so that Ctrl-C still reaches the main thread.
+    while thread.isAlive():
+      thread.join(0.5)
+  if errors:
+    exc_type, exc_value, exc_traceback = errors[0]
+    raise exc_type, exc_value, exc_traceback
+  return results
+
+
+def GetAsyncRpcServer(rpc_server, options):
+  """Returns an async_rpc.AsyncRpcServer for --async_uploads, or None.
+
+  None means the uploads are sent with rpc_server on ParallelMap threads:
+  without --async_uploads, or if the server is only reachable via a proxy.
+  """
+  if not options.async_uploads:
+    return None
+  import async_rpc
+  if not async_rpc.IsSupported(rpc_server):
+    StatusUpdate("Not using --async_uploads behind a proxy.")
+    return None
+  return async_rpc.AsyncRpcServer(rpc_server,
+                                  max_connections=max(options.upload_threads,
+                                                      1))
+
+
+class BaseFileManifest(object):
+  """Checksums of the base files already uploaded to an issue.
+
+  The manifest lives in ~/.codereview_base_manifests, one file per server and
+  issue. Each entry maps a filename to the key of the uploaded base version
+  (see VersionControlSystem.GetBaseFileKey) and the md5 of its content. When
+  a later patchset has the same key, the base file is neither read again nor
+  uploaded: its recorded checksum goes into base_hashes, and the server
+  answers with a "nobase_" file id.
+  """
+
+  def __init__(self, server, issue):
+    directory = os.path.expanduser("~/.codereview_base_manifests")
+    name = re.sub(r"[^\w.-]", "_", "%s_%s" % (server, issue))
+    self.path = os.path.join(directory, name + ".json")
+    self.entries = {}
+    try:
+      manifest_file = open(self.path, "r")
+      try:
+        self.entries = json.load(manifest_file)
+      finally:
+        manifest_file.close()
+    except (IOError, ValueError):
+      # No manifest yet, or an unreadable one: every base file is read.
+      pass
+
+  def Lookup(self, filename, key):
+    """Returns the recorded checksum of filename's base at key, or None."""
+    entry = self.entries.get(filename)
+    if key is None or not entry or entry["key"] != key:
+      return None
+    return entry["checksum"]
+
+  def Update(self, vcs, files):
+    """Records the base files that were read and saves the manifest.
+
+    Args:
+      vcs: The VersionControlSystem the files came from.
+      files: The dictionary returned by GetBaseFiles. Entries that are None
+        were skipped and keep their recorded checksum.
+    """
+    for filename, info in files.iteritems():
+      if info is None:
+        continue
+      base_content, new_content = info[0], info[1]
+      key = vcs.GetBaseFileKey(filename)
+      if key is None or base_content is None or new_content is not None:
+        self.entries.pop(filename, None)
+        continue
+      self.entries[filename] = {"key": key,
+                                "checksum": md5(base_content).hexdigest()}
+    directory = os.path.dirname(self.path)
+    try:
+      if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+      temp_path = self.path + ".tmp"
+      manifest_file = open(temp_path, "w")
+      try:
+        json.dump(self.entries, manifest_file)
+      finally:
+        manifest_file.close()
+      os.rename(temp_path, self.path)
+    except (IOError, OSError), e:
+      logging.info("Unable to save base file manifest %s: %s", self.path, e)
+
+
+class UploadJournal(object):
+  """Progress of the last upload from a directory, for --resume.
+
+  The journal lives in ~/.codereview_upload_journals, one file per server
+  and working directory. It records the checksum of the diff, the issue and
+  patch set created for it, and every patch and file uploaded so far. It is
+  written after each completed upload and removed once the whole upload
+  succeeded.
+  """
+
+  def __init__(self, server, directory=None):
+    directory = directory or os.getcwd()
+    journal_dir = os.path.expanduser("~/.codereview_upload_journals")
+    name = re.sub(r"[^\w.-]", "_", server) + "_" + md5(directory).hexdigest()
+    self.path = os.path.join(journal_dir, name + ".json")
+    self.lock = threading.Lock()
+    self.entries = None
+
+  def Load(self):
+    """Loads the journal; returns False if there is none."""
+    try:
+      journal_file = open(self.path, "r")
+      try:
+        self.entries = self._ToStr(json.load(journal_file))
+      finally:
+        journal_file.close()
+    except (IOError, ValueError):
+      return False
+    return True
+
+  @classmethod
+  def _ToStr(cls, value):
+    """Turns the unicode strings json returns back into UTF-8 strs."""
+    if isinstance(value, unicode):
+      return value.encode("utf-8")
+    if isinstance(value, list):
+      return [cls._ToStr(item) for item in value]
+    if isinstance(value, dict):
+      return dict((cls._ToStr(key), cls._ToStr(item))
+                  for key, item in value.iteritems())
+    return value
+
+  def Start(self, diff, issue, patchset, patches, separate_patches):
+    """Records the patch set just created for diff."""
+    self.entries = {"diff_checksum": md5(diff).hexdigest(),
+                    "issue": issue,
+                    "patchset": patchset,
+                    "patches": patches,
+                    "separate_patches": separate_patches,
+                    "uploaded_patches": {},
+                    "uploaded_files": []}
+    self._Save()
+
+  def Matches(self, diff):
+    """Returns True if the journal was written for this diff."""
+    return self.entries["diff_checksum"] == md5(diff).hexdigest()
+
+  def GetPatchKey(self, filename):
+    """Returns the key of filename's uploaded separate patch, or None."""
+    return self.entries["uploaded_patches"].get(filename)
+
+  def RecordPatch(self, filename, patch_key):
+    self.lock.acquire()
+    try:
+      self.entries["uploaded_patches"][filename] = patch_key
+      self._Save()
+    finally:
+      self.lock.release()
+
+  def IsFileUploaded(self, filename, is_base):
+    return [filename, is_base] in self.entries["uploaded_files"]
+
+  def RecordFile(self, filename, is_base):
+    self.lock.acquire()
+    try:
+      self.entries["uploaded_files"].append([filename, is_base])
+      self._Save()
+    finally:
+      self.lock.release()
+
+  def Delete(self):
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+
+  def _Save(self):
+    directory = os.path.dirname(self.path)
+    try:
+      if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+      temp_path = self.path + ".tmp"
+      journal_file = open(temp_path, "w")
+      try:
+        json.dump(self.entries, journal_file)
+      finally:
+        journal_file.close()
+      os.rename(temp_path, self.path)
+    except (IOError, OSError), e:
+      logging.info("Unable to save upload journal %s: %s", self.path, e)
+
 
 class VersionControlSystem(object):
   """Abstract base class providing an interface to the VCS."""
 
+  # Whether GetBaseFiles may call GetBaseFile from several threads at once.
+  # Subclasses that set this must guard any state they fill in lazily.
+  thread_safe_base_files = False
+
   def __init__(self, options):
     """Constructor.
 
@@ -780,6 +1801,14 @@ class VersionControlSystem(object):
     raise NotImplementedError(
         "abstract method -- subclass %s must override" % self.__class__)
 
+  def GetDiffStats(self, diff):
+    """Returns the DiffStats of diff, as returned by GenerateDiff.
+
+    The default counts the lines of the diff's ParsedDiff, which is usually
+    parsed already. Subclasses may ask the VCS instead.
+    """
+    return DiffStats.FromParsedDiff(ParseDiff(diff))
+
   def GetUnknownFiles(self):
     """Return a list of files unknown to the VCS."""
     raise NotImplementedError(
@@ -813,77 +1842,191 @@ class VersionControlSystem(object):
     raise NotImplementedError(
         "abstract method -- subclass %s must override" % self.__class__)
 
+  def GetBaseFileKey(self, filename):
+    """Identifies the base version of a file without reading its content.
+
+    Used with a BaseFileManifest to skip base files that were already
+    uploaded for an earlier patchset.
+
+    Returns:
+      A string that changes whenever GetBaseFile would return a different
+      base_content, or None if this VCS can't tell cheaply. Files with a
+      new_content must return None as well.
+    """
+    return None
 
-  def GetBaseFiles(self, diff):
+  def PrefetchBaseFiles(self, filenames):
+    """Prepares GetBaseFile for filenames, e.g. with a few bulk commands.
+
+    Called by GetBaseFiles before it calls GetBaseFile for each file. The
+    default does nothing.
+    """
+
+  def GetBaseFiles(self, diff, manifest=None):
     """Helper that calls GetBase file for each file in the patch.
 
+    Args:
+      diff: The diff, as returned by PostProcessDiff.
+      manifest: An optional BaseFileManifest. Files whose base version is
+        recorded there are not read and map to None instead; UploadBaseFiles
+        only reads them if the server doesn't already have their base.
+
     Returns:
       A dictionary that maps from filename to GetBaseFile's tuple.  Filenames
       are retrieved based on lines that start with "Index:" or
-      "Property changes on:".
+      "Property changes on:". If the VCS is thread_safe_base_files, up to
+      options.upload_threads files are read at the same time.
     """
     files = {}
-    for line in diff.splitlines(True):
-      if line.startswith('Index:') or line.startswith('Property changes on:'):
-        unused, filename = line.split(':', 1)
-        # On Windows if a file has property changes its filename uses '\'
-        # instead of '/'.
-        filename = filename.strip().replace('\\', '/')
-        files[filename] = self.GetBaseFile(filename)
+    filenames = []
+    for file_diff in ParseDiff(diff).files:
+      # On Windows if a file has property changes its filename uses '\'
+      # instead of '/'.
+      filename = file_diff.filename.replace('\\', '/')
+      if filename in files:
+        continue
+      files[filename] = None
+      if not (manifest and
+              manifest.Lookup(filename, self.GetBaseFileKey(filename))):
+        filenames.append(filename)
+    files.update(self.ReadBaseFiles(filenames))
     return files
 
+  def ReadBaseFiles(self, filenames):
+    """Returns a dictionary of filename to GetBaseFile's tuple.
+
+    The files are prefetched together, then read on up to
+    options.upload_threads threads if the VCS is thread_safe_base_files.
+    """
+    if not filenames:
+      return {}
+    self.PrefetchBaseFiles(filenames)
+    num_threads = 1
+    if self.thread_safe_base_files:
+      num_threads = self.options.upload_threads
+    return dict(zip(filenames,
+                    ParallelMap(self.GetBaseFile, filenames, num_threads)))
+
 
   def UploadBaseFiles(self, issue, rpc_server, patch_list, patchset, options,
-                      files):
-    """Uploads the base files (and if necessary, the current ones as well)."""
+                      files, journal=None):
+    """Uploads the base files (and if necessary, the current ones as well).
 
-    def UploadFile(filename, file_id, content, is_binary, status, is_base):
-      """Uploads a file to the server."""
-      file_too_large = False
+    Up to options.upload_threads files are uploaded at the same time, on
+    threads or with --async_uploads from this one. Files the UploadJournal
+    journal lists as uploaded are skipped, and each completed upload is
+    recorded in it.
+    """
+
+    def FileRequest(filename, file_id, content, is_binary, status, is_base):
+      """Returns the (url, body, content_type) uploading a file.
+
+      Files larger than MAX_UPLOAD_SIZE are uploaded in chunks right away,
+      and None is returned instead, unless the server doesn't accept
+      chunked uploads.
+      """
       if is_base:
         type = "base"
       else:
         type = "current"
-      if len(content) > MAX_UPLOAD_SIZE:
-        print ("Not uploading the %s file for %s because it's too large." %
-               (type, filename))
-        file_too_large = True
-        content = ""
-      checksum = md5(content).hexdigest()
-      if options.verbose > 0 and not file_too_large:
-        print "Uploading %s file for %s" % (type, filename)
-      url = "/%d/upload_content/%d/%d" % (int(issue), int(patchset), file_id)
       form_fields = [("filename", filename),
                      ("status", status),
-                     ("checksum", checksum),
                      ("is_binary", str(is_binary)),
                      ("is_current", str(not is_base)),
                     ]
-      if file_too_large:
-        form_fields.append(("file_too_large", "1"))
       if options.email:
         form_fields.append(("user", options.email))
-      ctype, body = EncodeMultipartFormData(form_fields,
-                                            [("data", filename, content)])
-      response_body = rpc_server.Send(url, body,
-                                      content_type=ctype)
+      if len(content) > MAX_UPLOAD_SIZE:
+        if options.verbose > 0:
+          print "Uploading %s file for %s in chunks" % (type, filename)
+        url = "/%d/upload_content_chunk/%d/%d" % (int(issue), int(patchset),
+                                                  file_id)
+        response_body = UploadInChunks(rpc_server, url, form_fields,
+                                       filename, content, options)
+        if response_body is not None:
+          FileUploaded(response_body, filename, is_base)
+          return None
+        print ("Not uploading the %s file for %s because it's too large." %
+               (type, filename))
+        form_fields.append(("file_too_large", "1"))
+        content = ""
+      elif options.verbose > 0:
+        print "Uploading %s file for %s" % (type, filename)
+      form_fields.append(("checksum", md5(content).hexdigest()))
+      url = "/%d/upload_content/%d/%d" % (int(issue), int(patchset),
+                                          file_id)
+      ctype, body = EncodeMultipartFormDataStream(
+          form_fields, [("data", filename, content)])
+      return url, body, ctype
+
+    def FileUploaded(response_body, filename, is_base):
+      """Checks the server's response and records the upload."""
       if not response_body.startswith("OK"):
         StatusUpdate("  --> %s" % response_body)
         sys.exit(1)
+      if journal:
+        journal.RecordFile(filename, is_base)
+
+    def UploadFile(filename, file_id, content, is_binary, status, is_base):
+      """Uploads a file to the server."""
+      request = FileRequest(filename, file_id, content, is_binary, status,
+                            is_base)
+      if request is None:
+        return
+      url, body, ctype = request
+      response_body = rpc_server.Send(url, body,
+                                      content_type=ctype,
+                                      content_encoding=options.compress,
+                                      idempotent=True)
+      FileUploaded(response_body, filename, is_base)
 
     patches = dict()
     [patches.setdefault(v, k) for k, v in patch_list]
+    # Files GetBaseFiles skipped for the manifest are read now, unless they
+    # are unchanged since an earlier patchset and the server still has them.
+    files.update(self.ReadBaseFiles(
+        [filename for filename, file_id_str in patches.items()
+         if files[filename] is None and "nobase" not in file_id_str]))
+    uploads = []
     for filename in patches.keys():
-      base_content, new_content, is_binary, status = files[filename]
       file_id_str = patches.get(filename)
-      if file_id_str.find("nobase") != -1:
+      nobase = file_id_str.find("nobase") != -1
+      if files[filename] is None:
+        continue
+      base_content, new_content, is_binary, status = files[filename]
+      if nobase:
         base_content = None
         file_id_str = file_id_str[file_id_str.rfind("_") + 1:]
       file_id = int(file_id_str)
-      if base_content != None:
-        UploadFile(filename, file_id, base_content, is_binary, status, True)
-      if new_content != None:
-        UploadFile(filename, file_id, new_content, is_binary, status, False)
+      for content, is_base in ((base_content, True), (new_content, False)):
+        if content is None:
+          continue
+        if journal and journal.IsFileUploaded(filename, is_base):
+          continue
+        uploads.append((filename, file_id, content, is_binary, status,
+                        is_base))
+    # Start with the largest files so the last uploads to finish are short.
+    uploads.sort(key=lambda upload: len(upload[2]), reverse=True)
+    async_server = GetAsyncRpcServer(rpc_server, options)
+    if async_server is None:
+      ParallelMap(lambda upload: UploadFile(*upload), uploads,
+                  options.upload_threads)
+      return
+    for upload in uploads:
+      request = FileRequest(*upload)
+      if request is None:
+        continue
+      url, body, ctype = request
+      future = async_server.SendAsync(url, body, content_type=ctype,
+                                      content_encoding=options.compress,
+                                      idempotent=True)
+      future.AddDoneCallback(
+          lambda future, filename=upload[0], is_base=upload[5]:
+          FileUploaded(future.Result(), filename, is_base))
+    try:
+      async_server.Run()
+    finally:
+      async_server.Close()
 
   def IsImage(self, filename):
     """Returns true if the filename has an image extension."""
@@ -906,6 +2049,16 @@ class VersionControlSystem(object):
 class SubversionVCS(VersionControlSystem):
   """Implementation of the VersionControlSystem interface for Subversion."""
 
+  thread_safe_base_files = True
+
+  # Values of the item and props attributes of "svn status --xml" -> the
+  # letters of the first two columns of "svn status".
+  STATUS_LETTERS = {"added": "A", "conflicted": "C", "deleted": "D",
+                    "external": "X", "ignored": "I", "incomplete": "!",
+                    "missing": "!", "modified": "M", "none": " ",
+                    "normal": " ", "obstructed": "~", "replaced": "R",
+                    "unversioned": "?"}
+
   def __init__(self, options):
     super(SubversionVCS, self).__init__(options)
     if self.options.revision:
@@ -919,6 +2072,18 @@ class SubversionVCS(VersionControlSystem):
     # Cache output from "svn list -r REVNO dirname".
     # Keys: dirname, Values: 2-tuple (ouput for start rev and end rev).
     self.svnls_cache = {}
+    # Caches filled by PrefetchBaseFiles. Keys: filename, Values: the status
+    # line, a dict of the working (False) or BASE (True) revision's
+    # properties, and the (output, return code) of "svn cat". GetBaseFile
+    # only reads them, so GetBaseFiles' threads need no lock for them.
+    self.status_cache = {}
+    self.props_cache = {False: {}, True: {}}
+    self.cat_cache = {}
+    # Status of each path changed in the --rev range, see
+    # _GetRevisionRangeStatus. None until it has been asked for.
+    self.range_status = None
+    # Guards range_status and svnls_cache, which GetStatus fills in.
+    self.status_lock = threading.Lock()
     # Base URL is required to fetch files deleted in an older revision.
     # Result is cached to not guess it over and over again in GetBaseFile().
     required = self.options.download_base or self.options.revision is not None
@@ -964,10 +2129,9 @@ class SubversionVCS(VersionControlSystem):
     cmd.extend(args)
     data = RunShell(cmd)
     count = 0
-    for line in data.splitlines():
-      if line.startswith("Index:") or line.startswith("Property changes on:"):
-        count += 1
-        logging.info(line)
+    for file_diff in ParseDiff(data).files:
+      count += 1
+      logging.info(file_diff.header)
     if not count:
       ErrorExit("No valid patches found in output from svn diff")
     return data
@@ -1021,8 +2185,156 @@ class SubversionVCS(VersionControlSystem):
       file.close()
     return result
 
+  def PrefetchBaseFiles(self, filenames):
+    """Gets the status, properties and base contents of all files at once.
+
+    Runs one "svn status --xml" and one "svn proplist --xml" per revision
+    for all files, then "svn cat" for the files that need their base
+    content, in parallel. GetStatus, _GetProperty and _CatBase look the
+    results up and only run svn for files that aren't cached. Only the
+    working copy is prefetched, not --rev diffs.
+    """
+    if self.options.revision or not filenames:
+      return
+    out, returncode = RunShellWithReturnCode(
+        ["svn", "status", "--xml", "--ignore-externals"] + filenames)
+    if returncode:
+      return
+    for entry in ElementTree.fromstring(out).iter("entry"):
+      wc_status = entry.find("wc-status")
+      columns = (self.STATUS_LETTERS.get(wc_status.get("item"), " ") +
+                 self.STATUS_LETTERS.get(wc_status.get("props"), " ") +
+                 (wc_status.get("wc-locked") == "true" and "L" or " ") +
+                 (wc_status.get("copied") == "true" and "+" or " ") +
+                 (wc_status.get("switched") == "true" and "S" or " ") +
+                 "  ")
+      self.status_cache[entry.get("path")] = columns + " " + entry.get("path")
+
+    added = []
+    based = []
+    for filename in filenames:
+      status = self.status_cache.get(filename)
+      if status is None:
+        continue
+      if status[0] == "A" and status[3] != "+":
+        added.append(filename)
+      else:
+        based.append(filename)
+    for base, names in ((False, added), (True, based)):
+      if not names:
+        continue
+      cmd = ["svn", "proplist", "--xml", "--verbose"]
+      if base:
+        cmd += ["-r", "BASE"]
+      out, returncode = RunShellWithReturnCode(cmd + names)
+      if returncode:
+        # A file may not exist in the revision; ask for each one later.
+        continue
+      props = self.props_cache[base]
+      for name in names:
+        props[name] = {}
+      for target in ElementTree.fromstring(out).iter("target"):
+        props[target.get("path")] = dict(
+            (prop.get("name"), prop.text or "")
+            for prop in target.iter("property"))
+
+    to_cat = []
+    for filename in based:
+      status = self.status_cache[filename]
+      if status[0] not in ("M", "D", "R", "A"):
+        continue
+      is_binary = self._IsBinaryMimeType(
+          self._GetProperty(filename, "svn:mime-type", True).strip())
+      if not is_binary or self.IsImage(filename):
+        to_cat.append((filename, not is_binary))
+
+    def Cat(item):
+      filename, universal_newlines = item
+      return RunShellWithReturnCode(["svn", "cat", filename],
+                                    universal_newlines=universal_newlines)
+    contents = ParallelMap(Cat, to_cat, self.options.upload_threads)
+    self.cat_cache.update(zip(to_cat, contents))
+
+  def _IsBinaryMimeType(self, mimetype):
+    """Returns True if files of the svn:mime-type mimetype are binary."""
+    return (bool(mimetype) and
+            not mimetype.startswith("text/") and
+            not mimetype in TEXT_MIMETYPES)
+
+  def _GetProperty(self, filename, name, base):
+    """Returns a property of a working copy file, or "" if it has none.
+
+    Args:
+      filename: The file.
+      name: The property, e.g. "svn:mime-type".
+      base: If True, the BASE revision's property is returned.
+    """
+    props = self.props_cache[base].get(filename)
+    if props is not None:
+      return props.get(name, "")
+    cmd = ["svn", "propget", name, filename]
+    if base:
+      cmd[1:1] = ["-r", "BASE"]
+    value, returncode = RunShellWithReturnCode(cmd)
+    if returncode:
+      # File does not exist in the requested revision.
+      # Reset value, it contains an error message.
+      return ""
+    return value
+
+  def _CatBase(self, filename, universal_newlines):
+    """Returns the (output, return code) of "svn cat" for a file."""
+    result = self.cat_cache.get((filename, universal_newlines))
+    if result is not None:
+      return result
+    return RunShellWithReturnCode(["svn", "cat", filename],
+                                  universal_newlines=universal_newlines)
+
+  def _GetRevisionRangeStatus(self):
+    """Returns filename -> status for the files changed in the --rev range.
+
+    Runs "svn diff --summarize --xml" once instead of two "svn list" per
+    directory. Returns an empty dict if svn can't summarize the range, in
+    which case GetStatus falls back to listing directories.
+    """
+    self.status_lock.acquire()
+    try:
+      if self.range_status is None:
+        self.range_status = self._LoadRevisionRangeStatus()
+      return self.range_status
+    finally:
+      self.status_lock.release()
+
+  def _LoadRevisionRangeStatus(self):
+    """Runs "svn diff --summarize" for _GetRevisionRangeStatus."""
+    range_status = {}
+    out, returncode = RunShellWithReturnCode(
+        ["svn", "diff", "--summarize", "--xml", "-r", self.options.revision])
+    if returncode:
+      logging.info("svn diff --summarize failed, listing directories")
+      return range_status
+    for path in ElementTree.fromstring(out).iter("path"):
+      filename = path.text or ""
+      # Paths are URLs or relative to the working copy, depending on the
+      # svn version.
+      if self.svn_base and filename.startswith(self.svn_base):
+        filename = filename[len(self.svn_base):]
+      item = path.get("item")
+      if item == "added":
+        status = "A   "
+      elif item == "deleted":
+        status = "D   "
+      else:
+        # Modified, replaced or only with property changes; the file is in
+        # both revisions.
+        status = "M   "
+      range_status[filename] = status
+    return range_status
+
   def GetStatus(self, filename):
     """Returns the status of a file."""
+    if filename in self.status_cache:
+      return self.status_cache[filename]
     if not self.options.revision:
       status = RunShell(["svn", "status", "--ignore-externals", filename])
       if not status:
@@ -1037,32 +2349,21 @@ class SubversionVCS(VersionControlSystem):
         status = status_lines[2]
       else:
         status = status_lines[0]
-    # If we have a revision to diff against we need to run "svn list"
-    # for the old and the new revision and compare the results to get
-    # the correct status for a file.
+    # If we have a revision to diff against, one "svn diff --summarize"
+    # gives the status of every changed file.
+    elif filename in self._GetRevisionRangeStatus():
+      status = self.range_status[filename]
+    # Otherwise we need to run "svn list" for the old and the new revision
+    # and compare the results to get the correct status for a file.
     else:
       dirname, relfilename = os.path.split(filename)
-      if dirname not in self.svnls_cache:
-        cmd = ["svn", "list", "-r", self.rev_start, dirname or "."]
-        out, err, returncode = RunShellWithReturnCodeAndStderr(cmd)
-        if returncode:
-          # Directory might not yet exist at start revison
-          # svn: Unable to find repository location for 'abc' in revision nnn
-          if re.match('^svn: Unable to find repository location for .+ in revision \d+', err):
-            old_files = ()
-          else:
-            ErrorExit("Failed to get status for %s:\n%s" % (filename, err))
-        else:
-          old_files = out.splitlines()
-        args = ["svn", "list"]
-        if self.rev_end:
-          args += ["-r", self.rev_end]
-        cmd = args + [dirname or "."]
-        out, returncode = RunShellWithReturnCode(cmd)
-        if returncode:
-          ErrorExit("Failed to run command %s" % cmd)
-        self.svnls_cache[dirname] = (old_files, out.splitlines())
-      old_files, new_files = self.svnls_cache[dirname]
+      self.status_lock.acquire()
+      try:
+        if dirname not in self.svnls_cache:
+          self.svnls_cache[dirname] = self._ListDirectory(filename, dirname)
+        old_files, new_files = self.svnls_cache[dirname]
+      finally:
+        self.status_lock.release()
       if relfilename in old_files and relfilename not in new_files:
         status = "D   "
       elif relfilename in old_files and relfilename in new_files:
@@ -1071,6 +2372,28 @@ class SubversionVCS(VersionControlSystem):
         status = "A   "
     return status
 
+  def _ListDirectory(self, filename, dirname):
+    """Returns the "svn list" of dirname at the start and end revision."""
+    cmd = ["svn", "list", "-r", self.rev_start, dirname or "."]
+    out, err, returncode = RunShellWithReturnCodeAndStderr(cmd)
+    if returncode:
+      # Directory might not yet exist at start revison
+      # svn: Unable to find repository location for 'abc' in revision nnn
+      if re.match('^svn: Unable to find repository location for .+ in revision \d+', err):
+        old_files = ()
+      else:
+        ErrorExit("Failed to get status for %s:\n%s" % (filename, err))
+    else:
+      old_files = out.splitlines()
+    args = ["svn", "list"]
+    if self.rev_end:
+      args += ["-r", self.rev_end]
+    cmd = args + [dirname or "."]
+    out, returncode = RunShellWithReturnCode(cmd)
+    if returncode:
+      ErrorExit("Failed to run command %s" % cmd)
+    return old_files, out.splitlines()
+
   def GetBaseFile(self, filename):
     status = self.GetStatus(filename)
     base_content = None
@@ -1083,8 +2406,7 @@ class SubversionVCS(VersionControlSystem):
     if status[0] == "A" and status[3] != "+":
       # We'll need to upload the new content if we're adding a binary file
       # since diff's output won't contain it.
-      mimetype = RunShell(["svn", "propget", "svn:mime-type", filename],
-                          silent_ok=True)
+      mimetype = self._GetProperty(filename, "svn:mime-type", False)
       base_content = ""
       is_binary = bool(mimetype) and not mimetype.startswith("text/")
       if is_binary and self.IsImage(filename):
@@ -1092,25 +2414,19 @@ class SubversionVCS(VersionControlSystem):
     elif (status[0] in ("M", "D", "R") or
           (status[0] == "A" and status[3] == "+") or  # Copied file.
           (status[0] == " " and status[1] == "M")):  # Property change.
-      args = []
       if self.options.revision:
         url = "%s/%s@%s" % (self.svn_base, filename, self.rev_start)
+        mimetype, returncode = RunShellWithReturnCode(
+            ["svn", "propget", "svn:mime-type", url])
+        if returncode:
+          # File does not exist in the requested revision.
+          # Reset mimetype, it contains an error message.
+          mimetype = ""
       else:
-        # Don't change filename, it's needed later.
-        url = filename
-        args += ["-r", "BASE"]
-      cmd = ["svn"] + args + ["propget", "svn:mime-type", url]
-      mimetype, returncode = RunShellWithReturnCode(cmd)
-      if returncode:
-        # File does not exist in the requested revision.
-        # Reset mimetype, it contains an error message.
-        mimetype = ""
-      else:
-        mimetype = mimetype.strip()
+        mimetype = self._GetProperty(filename, "svn:mime-type", True)
+      mimetype = mimetype.strip()
       get_base = False
-      is_binary = (bool(mimetype) and
-        not mimetype.startswith("text/") and
-        not mimetype in TEXT_MIMETYPES)
+      is_binary = self._IsBinaryMimeType(mimetype)
       if status[0] == " ":
         # Empty base content just to force an upload.
         base_content = ""
@@ -1142,8 +2458,7 @@ class SubversionVCS(VersionControlSystem):
                                   universal_newlines=universal_newlines,
                                   silent_ok=True)
         else:
-          base_content, ret_code = RunShellWithReturnCode(
-            ["svn", "cat", filename], universal_newlines=universal_newlines)
+          base_content, ret_code = self._CatBase(filename, universal_newlines)
           if ret_code and status[0] == "R":
             # It's a replaced file without local history (see issue208).
             # The base file needs to be fetched from the server.
@@ -1154,15 +2469,15 @@ class SubversionVCS(VersionControlSystem):
           elif ret_code:
             ErrorExit("Got error status from 'svn cat %s'" % filename)
         if not is_binary:
-          args = []
           if self.rev_start:
             url = "%s/%s@%s" % (self.svn_base, filename, self.rev_start)
+            keywords, returncode = RunShellWithReturnCode(
+                ["svn", "propget", "svn:keywords", url])
+            if returncode:
+              keywords = ""
           else:
-            url = filename
-            args += ["-r", "BASE"]
-          cmd = ["svn"] + args + ["propget", "svn:keywords", url]
-          keywords, returncode = RunShellWithReturnCode(cmd)
-          if keywords and not returncode:
+            keywords = self._GetProperty(filename, "svn:keywords", True)
+          if keywords:
             base_content = self._CollapseKeywords(base_content, keywords)
     else:
       StatusUpdate("svn status returned unexpected output: %s" % status)
@@ -1170,16 +2485,94 @@ class SubversionVCS(VersionControlSystem):
     return base_content, new_content, is_binary, status[0:5]
 
 
+class GitBlobReader(object):
+  """Reads git objects through one long-lived `git cat-file --batch`.
+
+  Starting `git show` once per blob costs a process spawn and a scan of the
+  repository's packfiles each time; the batch process pays that once. It is
+  started on the first Read and shut down by Close, which also runs at exit.
+  """
+
+  def __init__(self):
+    self._process = None
+    self._lock = threading.Lock()
+
+  def _Start(self):
+    logging.info("Running %s", ["git", "cat-file", "--batch"])
+    env = os.environ.copy()
+    env['LC_MESSAGES'] = 'C'
+    self._process = subprocess.Popen(["git", "cat-file", "--batch"],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     shell=use_shell, env=env)
+    atexit.register(self.Close)
+
+  def Read(self, object_name):
+    """Returns the exact bytes of a git object.
+
+    Args:
+      object_name: A blob hash or any other name git accepts, such as
+        "HEAD:path/to/file".
+
+    Returns:
+      The object's content as a str, or None if there is no such object.
+    """
+    self._lock.acquire()
+    try:
+      if self._process is None:
+        self._Start()
+      try:
+        self._process.stdin.write(object_name + "\n")
+        self._process.stdin.flush()
+        header = self._process.stdout.readline()
+      except IOError, e:
+        ErrorExit("Error talking to 'git cat-file --batch': %s" % e)
+      if not header.endswith("\n"):
+        ErrorExit("'git cat-file --batch' exited while reading %s" %
+                  object_name)
+      fields = header.split()
+      if len(fields) != 3:
+        # "<name> missing", or "ambiguous" for an ambiguous short hash.
+        return None
+      size = int(fields[2])
+      data = self._process.stdout.read(size)
+      if len(data) != size or self._process.stdout.read(1) != "\n":
+        ErrorExit("Short read of %s from 'git cat-file --batch'" %
+                  object_name)
+      return data
+    finally:
+      self._lock.release()
+
+  def Close(self):
+    """Stops the git process, if it was started."""
+    self._lock.acquire()
+    try:
+      if self._process is None:
+        return
+      self._process.stdin.close()
+      self._process.stdout.close()
+      self._process.wait()
+      self._process = None
+    finally:
+      self._lock.release()
+
+
 class GitVCS(VersionControlSystem):
   """Implementation of the VersionControlSystem interface for Git."""
 
+  thread_safe_base_files = True
+
   def __init__(self, options):
     super(GitVCS, self).__init__(options)
+    # Reads the blobs named in self.hashes, see GetFileContent.
+    self.blob_reader = GitBlobReader()
     # Map of filename -> (hash before, hash after) of base file.
     # Hashes for "no such file" are represented as None.
     self.hashes = {}
     # Map of new filename -> old filename for renames.
     self.renames = {}
+    # The revision and path arguments of the last diff, see GetDiffStats.
+    self.diff_args = None
 
   def PostProcessDiff(self, gitdiff):
     """Converts the diff output to include an svn-style "Index:" line as well
@@ -1191,9 +2584,9 @@ class GitVCS(VersionControlSystem):
     def IsFileNew(filename):
       return filename in self.hashes and self.hashes[filename][0] is None
 
-    def AddSubversionPropertyChange(filename):
-      """Add svn's property change information into the patch if given file is
-      new file.
+    def GetSubversionPropertyChange(filename):
+      """Returns svn's property change information for the patch if given
+      file is new file, else "".
 
       We use Subversion's auto-props setting to retrieve its property.
       See http://svnbook.red-bean.com/en/1.1/ch07.html#svn-ch-7-sect-1.3.2 for
@@ -1202,42 +2595,49 @@ class GitVCS(VersionControlSystem):
       if self.options.emulate_svn_auto_props and IsFileNew(filename):
         svnprops = GetSubversionPropertyChanges(filename)
         if svnprops:
-          svndiff.append("\n" + svnprops + "\n")
+          return "\n" + svnprops + "\n"
+      return ""
 
-    svndiff = []
-    filecount = 0
-    filename = None
-    for line in gitdiff.splitlines():
-      match = re.match(r"diff --git a/(.*) b/(.*)$", line)
-      if match:
-        # Add auto property here for previously seen file.
-        if filename is not None:
-          AddSubversionPropertyChange(filename)
-        filecount += 1
-        # Intentionally use the "after" filename so we can show renames.
-        filename = match.group(2)
-        svndiff.append("Index: %s\n" % filename)
-        if match.group(1) != match.group(2):
-          self.renames[match.group(2)] = match.group(1)
-      else:
-        # The "index" line in a git diff looks like this (long hashes elided):
+    parsed = ParseDiff(gitdiff)
+    if not parsed.files:
+      ErrorExit("No valid patches found in output from git diff")
+    # The svn-style diff is built from the git diff's parts, and its
+    # ParsedDiff from the git diff's FileDiffs, so it isn't parsed again.
+    svndiff = [gitdiff[:parsed.files[0].start]]
+    length = len(svndiff[0])
+    files = []
+    for file_diff in parsed.files:
+      # Intentionally use the "after" filename so we can show renames.
+      filename = file_diff.filename
+      if file_diff.old_filename != filename:
+        self.renames[filename] = file_diff.old_filename
+      if file_diff.hashes:
+        # The "index" line in a git diff looks like this (long hashes
+        # elided):
         #   index 82c0d44..b2cee3f 100755
         # We want to save the left hash, as that identifies the base file.
-        match = re.match(r"index (\w+)\.\.(\w+)", line)
-        if match:
-          before, after = (match.group(1), match.group(2))
-          if before == NULL_HASH:
-            before = None
-          if after == NULL_HASH:
-            after = None
-          self.hashes[filename] = (before, after)
-      svndiff.append(line + "\n")
-    if not filecount:
-      ErrorExit("No valid patches found in output from git diff")
-    # Add auto property for the last seen file.
-    assert filename is not None
-    AddSubversionPropertyChange(filename)
-    return "".join(svndiff)
+        before, after = file_diff.hashes
+        if before == NULL_HASH:
+          before = None
+        if after == NULL_HASH:
+          after = None
+        self.hashes[filename] = (before, after)
+      index_line = "Index: %s\n" % filename
+      text = gitdiff[file_diff.start:file_diff.end]
+      if not text.endswith("\n"):
+        text += "\n"
+      props = GetSubversionPropertyChange(filename)
+      svn_file_diff = file_diff.Shifted(length + len(index_line) -
+                                        file_diff.start)
+      svn_file_diff.start = length
+      svn_file_diff.header = index_line.rstrip("\n")
+      length += len(index_line) + len(text) + len(props)
+      svn_file_diff.end = length
+      files.append(svn_file_diff)
+      svndiff.extend((index_line, text, props))
+    svndiff = "".join(svndiff)
+    RememberParsedDiff(ParsedDiff(svndiff, files))
+    return svndiff
 
   def GenerateDiff(self, extra_args):
     extra_args = extra_args[:]
@@ -1252,9 +2652,48 @@ class GitVCS(VersionControlSystem):
     # git config key "diff.external" is used).
     env = os.environ.copy()
     if 'GIT_EXTERNAL_DIFF' in env: del env['GIT_EXTERNAL_DIFF']
+    self.diff_args = extra_args
     return RunShell(["git", "diff", "--no-ext-diff", "--full-index", "-M"]
                     + extra_args, env=env)
 
+  def GetDiffStats(self, diff):
+    """Returns the DiffStats of diff from `git diff --numstat`.
+
+    This runs git a second time over the revisions of the last GenerateDiff,
+    for exact counts: the parsed diff misses blank lines and lines that
+    start with another "+" or "-". Binary files count 0 lines either way,
+    and renames count under the new name. The parsed diff is counted
+    instead if diff wasn't made by GenerateDiff, e.g. with --difffile, or
+    if git fails.
+    """
+    if self.diff_args is None:
+      return super(GitVCS, self).GetDiffStats(diff)
+    env = os.environ.copy()
+    if 'GIT_EXTERNAL_DIFF' in env: del env['GIT_EXTERNAL_DIFF']
+    out, retcode = RunShellWithReturnCode(
+        ["git", "diff", "--no-ext-diff", "--numstat", "-z", "-M"] +
+        self.diff_args, universal_newlines=False, env=env)
+    if retcode:
+      return super(GitVCS, self).GetDiffStats(diff)
+    stats = DiffStats()
+    # Each file is "ADDED\tREMOVED\tPATH\0", or for a rename
+    # "ADDED\tREMOVED\t\0OLD_PATH\0NEW_PATH\0". Binary files count "-".
+    fields = out.split("\0")
+    i = 0
+    while i < len(fields):
+      if not fields[i]:
+        i += 1
+        continue
+      added, removed, filename = fields[i].split("\t", 2)
+      if filename:
+        i += 1
+      else:
+        filename = fields[i + 2]
+        i += 3
+      stats.Add(filename, added != "-" and int(added) or 0,
+                removed != "-" and int(removed) or 0)
+    return stats
+
   def GetUnknownFiles(self):
     status = RunShell(["git", "ls-files", "--exclude-standard", "--others"],
                       silent_ok=True)
@@ -1262,12 +2701,20 @@ class GitVCS(VersionControlSystem):
 
   def GetFileContent(self, file_hash, is_binary):
     """Returns the content of a file identified by its git hash."""
-    data, retcode = RunShellWithReturnCode(["git", "show", file_hash],
-                                            universal_newlines=not is_binary)
-    if retcode:
-      ErrorExit("Got error status from 'git show %s'" % file_hash)
+    data = self.blob_reader.Read(file_hash)
+    if data is None:
+      ErrorExit("Got error status from 'git cat-file' for %s" % file_hash)
+    if not is_binary:
+      # Match the universal newlines mode the diff is read with.
+      data = data.replace("\r\n", "\n").replace("\r", "\n")
     return data
 
+  def GetBaseFileKey(self, filename):
+    """Returns the base blob hash, which identifies the base content."""
+    if filename in self.renames or self.IsImage(filename):
+      return None
+    return self.hashes.get(filename, (None, None))[0]
+
   def GetBaseFile(self, filename):
     hash_before, hash_after = self.hashes.get(filename, (None,None))
     base_content = None
@@ -1278,10 +2725,12 @@ class GitVCS(VersionControlSystem):
     if filename in self.renames:
       status = "A +"  # Match svn attribute name for renames.
       if filename not in self.hashes:
-        # If a rename doesn't change the content, we never get a hash.
-        # Open42(added silent_ok=True so that empty files can be added):
-        base_content = RunShell(["git", "show", "HEAD:" + filename],
-                                silent_ok=True)
+        # If a rename doesn't change the content, we never get a hash. The
+        # new name doesn't exist yet at the revision the diff starts from,
+        # so read the old one there.
+        base_rev = re.split(r":|\.\.", self.options.revision or "HEAD")[0]
+        base_content = self.GetFileContent(
+            "%s:%s" % (base_rev, self.renames[filename]), False)
     elif not hash_before:
       status = "A"
       base_content = ""
@@ -1307,41 +2756,105 @@ class GitVCS(VersionControlSystem):
 
 
 class CVSVCS(VersionControlSystem):
-  """Implementation of the VersionControlSystem interface for CVS."""
+  """Implementation of the VersionControlSystem interface for CVS.
+
+  Only the statuses are fetched in bulk, with one "cvs status". Each base
+  file is read with its own "cvs -Q update -p": with several files, cvs
+  writes the header naming each file to stderr and the contents to stdout,
+  which has nothing that marks where a file ends.
+
+  Base files are read one at a time. Every cvs process briefly takes the
+  master lock of the repository directories it reads, and one that finds
+  it taken sleeps for 30 seconds.
+  """
 
   def __init__(self, options):
     super(CVSVCS, self).__init__(options)
+    # Filled by PrefetchBaseFiles. Keys: filename, Values: (status letter,
+    # working revision).
+    self.status_cache = {}
 
-  def GetOriginalContent_(self, filename):
-    RunShell(["cvs", "up", filename], silent_ok=True)
-    # TODO need detect file content encoding
-    content = open(filename).read()
-    return content.replace("\r\n", "\n")
+  def RunCvs(self, args):
+    """Runs a cvs command with its stderr merged into its output.
 
-  def GetBaseFile(self, filename):
-    base_content = None
-    new_content = None
-    is_binary = False
-    status = "A"
+    cvs reports on stderr which directory it is working on, and flushes
+    stdout before doing so. The merged output thus tells which directory
+    each part of the output belongs to.
 
-    output, retcode = RunShellWithReturnCode(["cvs", "status", filename])
+    Returns:
+      A (output, return code) tuple.
+    """
+    command = ["cvs"] + args
+    logging.info("Running %s", command)
+    env = os.environ.copy()
+    env['LC_MESSAGES'] = 'C'
+    p = subprocess.Popen(command, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, shell=use_shell, env=env)
+    output = p.communicate()[0]
+    return output, p.returncode
+
+  def _LoadStatus(self, filenames):
+    """Gets the status of many files with one "cvs status"."""
+    output, retcode = self.RunCvs(["status"] + filenames)
     if retcode:
-      ErrorExit("Got error status from 'cvs status %s'" % filename)
-
-    if output.find("Status: Locally Modified") != -1:
-      status = "M"
-      temp_filename = "%s.tmp123" % filename
-      os.rename(filename, temp_filename)
-      base_content = self.GetOriginalContent_(filename)
-      os.rename(temp_filename, filename)
-    elif output.find("Status: Locally Added"):
-      status = "A"
-      base_content = ""
-    elif output.find("Status: Needs Checkout"):
-      status = "D"
-      base_content = self.GetOriginalContent_(filename)
+      ErrorExit("Got error status from 'cvs status':\n%s" % output)
+    wanted = set(filenames)
+    dirname = ""
+    filename = None
+    for line in output.splitlines():
+      match = re.match(r"cvs [\w.-]+: Examining (.*)$", line)
+      if match:
+        dirname = match.group(1).rstrip("/")
+        dirname = dirname != "." and dirname + "/" or ""
+        continue
+      # "File: no file <name>" is printed for removed files.
+      match = re.match(r"File: (?:no file )?(.*?)\s+Status: (.*)$", line)
+      if match:
+        filename = dirname + match.group(1)
+        if filename not in wanted:
+          filename = None
+          continue
+        cvs_status = match.group(2).strip()
+        if cvs_status in ("Locally Modified", "Needs Merge"):
+          status = "M"
+        elif cvs_status in ("Locally Removed", "Needs Checkout"):
+          status = "D"
+        else:
+          # As before the statuses were fetched in bulk, anything else,
+          # e.g. "Locally Added" or "Unresolved Conflict", is sent as added.
+          status = "A"
+        self.status_cache[filename] = (status, None)
+        continue
+      match = re.match(r"\s+Working revision:\s+-?(\d[\d.]*)", line)
+      if match and filename:
+        self.status_cache[filename] = (self.status_cache[filename][0],
+                                       match.group(1))
+    for filename in filenames:
+      if filename not in self.status_cache:
+        logging.info("'cvs status' didn't report on %s", filename)
+        self.status_cache[filename] = ("A", None)
+
+  def PrefetchBaseFiles(self, filenames):
+    """Gets the status of all files in one "cvs status"."""
+    filenames = [filename for filename in filenames
+                 if filename not in self.status_cache]
+    if filenames:
+      self._LoadStatus(filenames)
 
-    return (base_content, new_content, is_binary, status)
+  def GetBaseFile(self, filename):
+    # The status lookup is a no-op when called from GetBaseFiles, which
+    # prefetches all statuses before reading the files.
+    self.PrefetchBaseFiles([filename])
+    status, revision = self.status_cache[filename]
+    base_content = ""
+    if status != "A" and revision:
+      # The working file is left alone.
+      base_content = RunShell(["cvs", "-Q", "update", "-p", "-r", revision,
+                               filename], silent_ok=True,
+                              universal_newlines=False)
+      # TODO need detect file content encoding
+      base_content = base_content.replace("\r\n", "\n")
+    return (base_content, None, False, status)
 
   def GenerateDiff(self, extra_args):
     cmd = ["cvs", "diff", "-u", "-N"]
@@ -1352,10 +2865,10 @@ class CVSVCS(VersionControlSystem):
     data, retcode = RunShellWithReturnCode(cmd)
     count = 0
     if retcode in [0, 1]:
-      for line in data.splitlines():
-        if line.startswith("Index:"):
+      for file_diff in ParseDiff(data).files:
+        if file_diff.header.startswith("Index:"):
           count += 1
-          logging.info(line)
+          logging.info(file_diff.header)
 
     if not count:
       ErrorExit("No valid patches found in output from cvs diff")
@@ -1372,9 +2885,145 @@ class CVSVCS(VersionControlSystem):
         unknown_files.append(line)
     return unknown_files
 
+class HgCommandServer(object):
+  """Runs hg commands through one long-lived `hg serve --cmdserver pipe`.
+
+  Every hg process starts a Python interpreter and loads Mercurial and the
+  repository, which costs far more than small commands such as "hg cat"
+  themselves. The server pays that once. It is started in the current
+  directory on the first RunCommand and shut down by Close, which also runs
+  at exit.
+  """
+
+  def __init__(self):
+    self._process = None
+    # Where the server's stderr goes; commands' errors come on a channel.
+    self._devnull = None
+    self._lock = threading.Lock()
+    # Set when the server couldn't be started, e.g. with hg older than 1.9.
+    self.unavailable = False
+
+  def _ReadChannel(self):
+    """Reads one message from the server.
+
+    Returns:
+      A (channel, data) tuple. For the input channels "I" and "L" data is
+      the number of bytes the server asks for.
+    """
+    header = self._process.stdout.read(5)
+    if len(header) != 5:
+      ErrorExit("'hg serve --cmdserver' exited unexpectedly")
+    channel, length = struct.unpack(">cI", header)
+    if channel in "IL":
+      return channel, length
+    data = self._process.stdout.read(length)
+    if len(data) != length:
+      ErrorExit("Short read from 'hg serve --cmdserver'")
+    return channel, data
+
+  def _Start(self):
+    command = ["hg", "serve", "--cmdserver", "pipe",
+               "--config", "ui.interactive=False"]
+    logging.info("Running %s", command)
+    env = os.environ.copy()
+    env['LC_MESSAGES'] = 'C'
+    self._devnull = open(os.devnull, "w")
+    try:
+      self._process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=self._devnull,
+                                       cwd=os.getcwd(), shell=use_shell,
+                                       env=env)
+    except OSError, e:
+      logging.info("Can't start the hg command server: %s", e)
+      self.unavailable = True
+      self._devnull.close()
+      self._devnull = None
+      return
+    atexit.register(self.Close)
+    # The server greets with its capabilities on the output channel.
+    header = self._process.stdout.read(5)
+    if len(header) == 5:
+      channel, length = struct.unpack(">cI", header)
+      hello = self._process.stdout.read(length)
+      if channel == "o" and "runcommand" in hello.split("\n", 1)[0].split():
+        return
+    logging.info("hg doesn't support the command server")
+    self.unavailable = True
+    self._Stop()
+
+  def _Stop(self):
+    """Waits for the started hg process to exit and closes its files."""
+    self._process.stdin.close()
+    self._process.stdout.close()
+    self._process.wait()
+    self._process = None
+    self._devnull.close()
+    self._devnull = None
+
+  def RunCommand(self, args):
+    """Runs one hg command.
+
+    Args:
+      args: The arguments to hg, without "hg" itself.
+
+    Returns:
+      A (stdout, stderr, return code) tuple, or None if the server isn't
+      available and the command has to be run as a separate process.
+    """
+    self._lock.acquire()
+    try:
+      if self.unavailable:
+        return None
+      if self._process is None:
+        self._Start()
+        if self.unavailable:
+          return None
+      logging.info("Running %s", ["hg"] + args)
+      data = "\0".join(args)
+      output = []
+      errout = []
+      try:
+        self._process.stdin.write("runcommand\n" +
+                                  struct.pack(">I", len(data)) + data)
+        self._process.stdin.flush()
+        while True:
+          channel, data = self._ReadChannel()
+          if channel == "o":
+            output.append(data)
+          elif channel == "e":
+            errout.append(data)
+          elif channel == "r":
+            return ("".join(output), "".join(errout),
+                    struct.unpack(">i", data)[0])
+          elif channel in "IL":
+            # Nothing is ever typed in; an empty chunk means end of input.
+            self._process.stdin.write(struct.pack(">I", 0))
+            self._process.stdin.flush()
+          elif channel.isupper():
+            ErrorExit("Unexpected channel %r from 'hg serve --cmdserver'" %
+                      channel)
+      except IOError, e:
+        ErrorExit("Error talking to 'hg serve --cmdserver': %s" % e)
+    finally:
+      self._lock.release()
+
+  def Close(self):
+    """Stops the hg process, if it was started."""
+    self._lock.acquire()
+    try:
+      if self._process is None:
+        return
+      self._Stop()
+    finally:
+      self._lock.release()
+
+
 class MercurialVCS(VersionControlSystem):
   """Implementation of the VersionControlSystem interface for Mercurial."""
 
+  thread_safe_base_files = True
+
   def __init__(self, options, repo_dir):
     super(MercurialVCS, self).__init__(options)
     # Absolute path to repository (we can be in a subdir)
@@ -1383,10 +3032,39 @@ class MercurialVCS(VersionControlSystem):
     cwd = os.path.normpath(os.getcwd())
     assert cwd.startswith(self.repo_dir)
     self.subdir = cwd[len(self.repo_dir):].lstrip(r"\/")
+    self.command_server = HgCommandServer()
+    # Filled by PrefetchBaseFiles. Keys: path relative to the current
+    # directory, Values: (status letter, path of the base contents).
+    # GetBaseFile only reads it, so GetBaseFiles' threads need no lock.
+    self.status_cache = {}
     if self.options.revision:
       self.base_rev = self.options.revision
     else:
-      self.base_rev = RunShell(["hg", "parent", "-q"]).split(':')[1].strip()
+      self.base_rev = self.RunHg(["parent", "-q"]).split(':')[1].strip()
+
+  def RunHg(self, args, silent_ok=False, universal_newlines=True):
+    """Runs an hg command like RunShell does, through the command server.
+
+    Args:
+      args: The arguments to hg, without "hg" itself.
+      silent_ok: Whether empty output is fine.
+      universal_newlines: Whether to convert all line breaks to "\\n".
+
+    Returns:
+      The command's output.
+    """
+    result = self.command_server.RunCommand(args)
+    if result is None:
+      return RunShell(["hg"] + args, silent_ok=silent_ok,
+                      universal_newlines=universal_newlines)
+    data, _, retcode = result
+    if universal_newlines:
+      data = data.replace("\r\n", "\n").replace("\r", "\n")
+    if retcode:
+      ErrorExit("Got error status from %s:\n%s" % (["hg"] + args, data))
+    if not silent_ok and not data:
+      ErrorExit("No output from %s" % (["hg"] + args))
+    return data
 
   def _GetRelPath(self, filename):
     """Get relative path of a file according to the current directory,
@@ -1395,8 +3073,8 @@ class MercurialVCS(VersionControlSystem):
     return filename[len(self.subdir):].lstrip(r"\/")
 
   def GenerateDiff(self, extra_args):
-    cmd = ["hg", "diff", "--git", "-r", self.base_rev] + extra_args
-    data = RunShell(cmd, silent_ok=True)
+    data = self.RunHg(["diff", "--git", "-r", self.base_rev] + extra_args,
+                      silent_ok=True)
     svndiff = []
     filecount = 0
     for line in data.splitlines():
@@ -1421,8 +3099,8 @@ class MercurialVCS(VersionControlSystem):
   def GetUnknownFiles(self):
     """Return a list of files unknown to the VCS."""
     args = []
-    status = RunShell(["hg", "status", "--rev", self.base_rev, "-u", "."],
-        silent_ok=True)
+    status = self.RunHg(["status", "--rev", self.base_rev, "-u", "."],
+                        silent_ok=True)
     unknown_files = []
     for line in status.splitlines():
       st, fn = line.split(" ", 1)
@@ -1430,6 +3108,27 @@ class MercurialVCS(VersionControlSystem):
         unknown_files.append(fn)
     return unknown_files
 
+  def PrefetchBaseFiles(self, filenames):
+    """Gets the status of all files with one "hg status -C"."""
+    relpaths = [self._GetRelPath(filename) for filename in filenames]
+    if not relpaths:
+      return
+    out = self.RunHg(["status", "-C", "--rev", self.base_rev] + relpaths,
+                     silent_ok=True)
+    relpath = None
+    for line in out.splitlines():
+      if line.startswith("  ") and relpath:
+        # The source of a move or copy; see GetBaseFile.
+        self.status_cache[relpath] = ("M", line.strip())
+        relpath = None
+        continue
+      match = re.match(r"([A-Z!?]) (.*)$", line)
+      if match:
+        relpath = match.group(2)
+        self.status_cache[relpath] = (match.group(1), relpath)
+      else:
+        relpath = None
+
   def GetBaseFile(self, filename):
     # "hg status" and "hg cat" both take a path relative to the current subdir
     # rather than to the repo root, but "hg diff" has given us the full path
@@ -1438,34 +3137,36 @@ class MercurialVCS(VersionControlSystem):
     new_content = None
     is_binary = False
     oldrelpath = relpath = self._GetRelPath(filename)
-    # "hg status -C" returns two lines for moved/copied files, one otherwise
-    out = RunShell(["hg", "status", "-C", "--rev", self.base_rev, relpath])
-    out = out.splitlines()
-    # HACK: strip error message about missing file/directory if it isn't in
-    # the working copy
-    if out[0].startswith('%s: ' % relpath):
-      out = out[1:]
-    status, _ = out[0].split(' ', 1)
-    if len(out) > 1 and status == "A":
-      # Moved/copied => considered as modified, use old filename to
-      # retrieve base contents
-      oldrelpath = out[1].strip()
-      status = "M"
+    if relpath in self.status_cache:
+      status, oldrelpath = self.status_cache[relpath]
+    else:
+      # "hg status -C" returns two lines for moved/copied files, one otherwise
+      out = self.RunHg(["status", "-C", "--rev", self.base_rev, relpath])
+      out = out.splitlines()
+      # HACK: strip error message about missing file/directory if it isn't in
+      # the working copy
+      if out[0].startswith('%s: ' % relpath):
+        out = out[1:]
+      status, _ = out[0].split(' ', 1)
+      if len(out) > 1 and status == "A":
+        # Moved/copied => considered as modified, use old filename to
+        # retrieve base contents
+        oldrelpath = out[1].strip()
+        status = "M"
     if ":" in self.base_rev:
       base_rev = self.base_rev.split(":", 1)[0]
     else:
       base_rev = self.base_rev
     if status != "A":
-      base_content = RunShell(["hg", "cat", "-r", base_rev, oldrelpath],
-        silent_ok=True)
+      # Fetched without converting newlines, which only text files get.
+      base_content = self.RunHg(["cat", "-r", base_rev, oldrelpath],
+                                silent_ok=True, universal_newlines=False)
       is_binary = "\0" in base_content  # Mercurial's heuristic
     if status != "R":
       new_content = open(relpath, "rb").read()
       is_binary = is_binary or "\0" in new_content
-    if is_binary and base_content:
-      # Fetch again without converting newlines
-      base_content = RunShell(["hg", "cat", "-r", base_rev, oldrelpath],
-        silent_ok=True, universal_newlines=False)
+    if not is_binary:
+      base_content = base_content.replace("\r\n", "\n").replace("\r", "\n")
     if not is_binary or not self.IsImage(relpath):
       new_content = None
     return base_content, new_content, is_binary, status
@@ -1474,6 +3175,8 @@ class MercurialVCS(VersionControlSystem):
 class PerforceVCS(VersionControlSystem):
   """Implementation of the VersionControlSystem interface for Perforce."""
 
+  thread_safe_base_files = True
+
   def __init__(self, options):
     
     def ConfirmLogin():
@@ -1499,12 +3202,28 @@ class PerforceVCS(VersionControlSystem):
     self.p4_port = options.p4_port
     self.p4_client = options.p4_client
     self.p4_user = options.p4_user
+
+    # Metadata of the changelist, fetched once per session. See
+    # GetDescription and LoadFileMetadata.
+    self.description = None
+    # property key prefix -> GetFileProperties result.
+    self.file_properties = {}
+    self.file_metadata_loaded = False
+    # Guards description, file_properties and the metadata caches while
+    # they are filled in lazily. It is reentrant since LoadFileMetadata
+    # itself calls GetBaseFilename.
+    self.file_metadata_lock = threading.RLock()
+    # depot filename -> "p4 fstat -Or", "p4 have" and "p4 where" record.
+    self.fstat_cache = {}
+    self.have_cache = {}
+    self.where_cache = {}
+    # (depot filename, revision or None) -> content, see PrefetchContents.
+    self.content_cache = {}
     
     ConfirmLogin()
     
     if not options.message:
-      description = self.RunPerforceCommand(["describe", self.p4_changelist],
-                                            marshal_output=True)
+      description = self.GetDescription()
       if description and "desc" in description:
         # Rietveld doesn't support multi-line descriptions
         raw_message = description["desc"].strip()
@@ -1512,8 +3231,8 @@ class PerforceVCS(VersionControlSystem):
         if len(lines):
           options.message = lines[0]
   
-  def RunPerforceCommandWithReturnCode(self, extra_args, marshal_output=False,
-                                       universal_newlines=True):
+  def GetPerforceArgs(self, marshal_output=False):
+    """Returns the p4 command line up to the command name."""
     args = ["p4"]
     if marshal_output:
       # -G makes perforce format its output as marshalled python objects
@@ -1524,7 +3243,14 @@ class PerforceVCS(VersionControlSystem):
       args.extend(["-c", self.p4_client])
     if self.p4_user:
       args.extend(["-u", self.p4_user])
-    args.extend(extra_args)
+    return args
+
+  def RunPerforceCommandWithReturnCode(self, extra_args, marshal_output=False,
+                                       universal_newlines=True):
+    args = self.GetPerforceArgs(marshal_output) + extra_args
+    if marshal_output:
+      # Newline translation would corrupt the binary marshal format.
+      universal_newlines = False
     
     data, retcode = RunShellWithReturnCode(
         args, print_output=False, universal_newlines=universal_newlines)
@@ -1534,17 +3260,190 @@ class PerforceVCS(VersionControlSystem):
     
   def RunPerforceCommand(self, extra_args, marshal_output=False,
                          universal_newlines=True):
-    # This might be a good place to cache call results, since things like
-    # describe or fstat might get called repeatedly.
     data, retcode = self.RunPerforceCommandWithReturnCode(
         extra_args, marshal_output, universal_newlines)
     if retcode:
       ErrorExit("Got error status from %s:\n%s" % (extra_args, data))
     return data
 
+  def RunPerforceCommandOnFiles(self, extra_args, filenames,
+                                marshal_output=True):
+    """Runs one p4 command for many files and returns all of its output.
+
+    The filenames are passed on stdin with "-x -", so any number of them
+    takes a single round trip to the server.
+
+    Returns:
+      With marshal_output, the list of -G records p4 printed, including
+      error records. Otherwise the output, with universal newlines.
+    """
+    args = self.GetPerforceArgs(marshal_output) + ["-x", "-"] + extra_args
+    logging.info("Running %s for %d files", args, len(filenames))
+    # marshal.load needs a real file, and p4's output may be large, so it
+    # goes to a temporary file rather than a pipe.
+    output = tempfile.TemporaryFile()
+    records = []
+    try:
+      p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=output,
+                           shell=use_shell)
+      p.communicate("".join(filename + "\n" for filename in filenames))
+      output.seek(0)
+      if not marshal_output:
+        return output.read().replace("\r\n", "\n").replace("\r", "\n")
+      while True:
+        try:
+          records.append(marshal.load(output))
+        except EOFError:
+          break
+    finally:
+      output.close()
+    if p.returncode and not records:
+      ErrorExit("Got error status from %s" % extra_args)
+    return records
+
+  def GetDescription(self):
+    """Returns the "p4 describe" record of the changelist."""
+    self.file_metadata_lock.acquire()
+    try:
+      if self.description is None:
+        self.description = self.RunPerforceCommand(
+            ["describe", self.p4_changelist], marshal_output=True)
+      return self.description
+    finally:
+      self.file_metadata_lock.release()
+
+  def LoadFileMetadata(self):
+    """Fetches fstat, have and where records for every changed file at once.
+
+    One "p4 fstat -Or", "p4 have" and "p4 where" call each covers all files
+    of the changelist; GetBaseFilename, GetBaseRevision, GetLocalFilename
+    and GenerateDiff then look the records up.
+    """
+    self.file_metadata_lock.acquire()
+    try:
+      if not self.file_metadata_loaded:
+        self.file_metadata_loaded = True
+        self._LoadFileMetadata()
+    finally:
+      self.file_metadata_lock.release()
+
+  def _LoadFileMetadata(self):
+    """Runs the p4 commands for LoadFileMetadata."""
+    filenames = sorted(self.GetChangedFiles().keys())
+    if not filenames:
+      return
+    for cache, command, names in (
+        (self.fstat_cache, ["fstat", "-Or"], filenames),
+        (self.have_cache, ["have"], None),
+        (self.where_cache, ["where"], filenames)):
+      if names is None:
+        # Base files depend on the fstat records loaded above.
+        names = sorted(set(self.GetBaseFilename(filename)
+                           for filename in filenames))
+      for record in self.RunPerforceCommandOnFiles(command, names):
+        if "depotFile" in record and not "unmap" in record:
+          cache.setdefault(record["depotFile"], record)
+
+  def PrefetchContents(self, file_revisions):
+    """Prints many files with one "p4 print" for GetFileContent.
+
+    The -G output has a "stat" record per file followed by its content in
+    records of up to a few KB, which are joined per file.
+
+    Args:
+      file_revisions: (depot filename, revision) pairs. A revision of None
+        stands for the head revision.
+    """
+    wanted = set(file_revisions) - set(self.content_cache)
+    if not wanted:
+      return
+    file_args = sorted(filename + (revision and "#" + revision or "")
+                       for filename, revision in wanted)
+    contents = {}
+    keys = None
+    for record in self.RunPerforceCommandOnFiles(["print"], file_args):
+      code = record.get("code")
+      if code == "stat":
+        filename = record.get("depotFile")
+        # The head revision's content is also that of the revision printed.
+        keys = [(filename, record.get("rev")), (filename, None)]
+        if keys[0] not in wanted and keys[1] not in wanted:
+          keys = None
+        elif keys[0] in wanted:
+          keys = keys[:1]
+        chunks = []
+        for key in keys or []:
+          contents[key] = chunks
+      elif code == "error":
+        keys = None
+      elif keys and "data" in record:
+        chunks.append(record["data"])
+    for key, chunks in contents.items():
+      self.content_cache[key] = "".join(chunks)
+
+  def DiffFiles(self, filenames, args):
+    """Runs one "p4 diff -du" for many files and splits its output.
+
+    Each file's part starts at its "--- " header line. Hunk line counts are
+    followed, so removed lines that look like headers don't split a file.
+
+    Returns:
+      A dict of depot filename -> the file's hunks, as GenerateDiff keeps
+      them. Files p4 printed nothing usable for are missing.
+    """
+    wanted = set(filenames)
+    diffs = {}
+    lines = None
+    old_lines = new_lines = 0
+    output = self.RunPerforceCommandOnFiles(["diff", "-du"] + args, filenames,
+                                            marshal_output=False)
+    for line in output.splitlines():
+      if old_lines > 0 or new_lines > 0:
+        if line.startswith("-"):
+          old_lines -= 1
+        elif line.startswith("+"):
+          new_lines -= 1
+        elif not line.startswith("\\"):
+          old_lines -= 1
+          new_lines -= 1
+        lines.append(line)
+        continue
+      filename = None
+      if line.startswith("==== "):
+        # ==== //depot/file#rev - /local/file ====
+        filename = line[5:].split(" - ", 1)[0].split("#", 1)[0]
+      elif line.startswith("--- "):
+        filename = line[4:].split("\t", 1)[0].split("#", 1)[0]
+      elif line.startswith("+++ "):
+        continue
+      if filename is not None:
+        if filename in wanted and filename not in diffs:
+          lines = diffs[filename] = []
+        continue
+      if lines is None:
+        continue
+      match = re.match(r"@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@", line)
+      if match:
+        old_lines = int(match.group(1) or 1)
+        new_lines = int(match.group(2) or 1)
+      if match or lines:
+        lines.append(line)
+    return dict((filename, "\n".join(lines))
+                for filename, lines in diffs.items())
+
   def GetFileProperties(self, property_key_prefix = "", command = "describe"):
-    description = self.RunPerforceCommand(["describe", self.p4_changelist],
-                                          marshal_output=True)
+    self.file_metadata_lock.acquire()
+    try:
+      if property_key_prefix not in self.file_properties:
+        self.file_properties[property_key_prefix] = (
+            self._ParseFileProperties(property_key_prefix))
+      return self.file_properties[property_key_prefix]
+    finally:
+      self.file_metadata_lock.release()
+
+  def _ParseFileProperties(self, property_key_prefix):
+    """Maps each file of the changelist to one of its describe fields."""
+    description = self.GetDescription()
     
     changed_files = {}
     file_index = 0
@@ -1587,6 +3486,11 @@ class PerforceVCS(VersionControlSystem):
     return not file_types[filename].endswith("text")
 
   def GetFileContent(self, filename, revision, is_binary):
+    content = self.content_cache.get((filename, revision))
+    if content is not None:
+      if not is_binary:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+      return content
     file_arg = filename
     if revision:
       file_arg += "#" + revision
@@ -1603,10 +3507,13 @@ class PerforceVCS(VersionControlSystem):
     
     # We only see a different base for "add" if this is a downgraded branch
     # after a file was branched (integrated), then edited. 
+    self.LoadFileMetadata()
     if self.GetAction(filename) in actionsWithDifferentBases:
       # -Or shows information about pending integrations/moves
-      fstat_result = self.RunPerforceCommand(["fstat", "-Or", filename],
-                                             marshal_output=True)
+      fstat_result = self.fstat_cache.get(filename)
+      if fstat_result is None:
+        fstat_result = self.RunPerforceCommand(["fstat", "-Or", filename],
+                                               marshal_output=True)
       
       baseFileKey = "resolveFromFile0" # I think it's safe to use only file0
       if baseFileKey in fstat_result:
@@ -1615,15 +3522,21 @@ class PerforceVCS(VersionControlSystem):
     return filename
 
   def GetBaseRevision(self, filename):
+    self.LoadFileMetadata()
     base_filename = self.GetBaseFilename(filename)
     
-    have_result = self.RunPerforceCommand(["have", base_filename],
-                                          marshal_output=True)
+    have_result = self.have_cache.get(base_filename)
+    if have_result is None:
+      have_result = self.RunPerforceCommand(["have", base_filename],
+                                            marshal_output=True)
     if "haveRev" in have_result:
       return have_result["haveRev"]
     
   def GetLocalFilename(self, filename):
-    where = self.RunPerforceCommand(["where", filename], marshal_output=True)
+    self.LoadFileMetadata()
+    where = self.where_cache.get(filename)
+    if where is None:
+      where = self.RunPerforceCommand(["where", filename], marshal_output=True)
     if "path" in where:
       return where["path"]
 
@@ -1664,11 +3577,14 @@ class PerforceVCS(VersionControlSystem):
       return header
   
     def GenerateMergeDiff(diffData, args):
+      diffData.base_rev = self.GetBaseRevision(diffData.filename)
+      diffData.prefix = ""
+      if diffData.filename in diffs:
+        diffData.file_body = diffs[diffData.filename]
+        return diffData
       # -du generates a unified diff, which is nearly svn format
       diffData.file_body = self.RunPerforceCommand(
           ["diff", "-du", diffData.filename] + args)
-      diffData.base_rev = self.GetBaseRevision(diffData.filename)
-      diffData.prefix = ""
       
       # We have to replace p4's file status output (the lines starting
       # with +++ or ---) to match svn's diff format
@@ -1681,8 +3597,10 @@ class PerforceVCS(VersionControlSystem):
       return diffData
 
     def GenerateAddDiff(diffData):
-      fstat = self.RunPerforceCommand(["fstat", diffData.filename],
-                                      marshal_output=True)
+      fstat = self.fstat_cache.get(diffData.filename)
+      if fstat is None:
+        fstat = self.RunPerforceCommand(["fstat", diffData.filename],
+                                        marshal_output=True)
       if "headRev" in fstat:
         diffData.base_rev = fstat["headRev"] # Re-adding a deleted file
       else:
@@ -1716,6 +3634,18 @@ class PerforceVCS(VersionControlSystem):
       return diffData
   
     changed_files = self.GetChangedFiles()
+    self.LoadFileMetadata()
+    # One p4 call diffs all edited files, and one prints all deleted ones.
+    statuses = dict((filename, self.PerforceActionToSvnStatus(action))
+                    for filename, action in changed_files.items())
+    edited = sorted(filename for filename, status in statuses.items()
+                    if status == "M")
+    diffs = {}
+    if edited:
+      diffs = self.DiffFiles(edited, args)
+    self.PrefetchContents([(self.GetBaseFilename(filename), None)
+                           for filename, status in statuses.items()
+                           if status == "D"])
     
     svndiff = []
     filecount = 0
@@ -1767,6 +3697,24 @@ class PerforceVCS(VersionControlSystem):
       
     return changed_files[filename]
 
+  def PrefetchBaseFiles(self, filenames):
+    """Prints the base revisions of all files with one "p4 print".
+
+    It also fills in the lazily loaded metadata GetBaseFile needs, so that
+    GetBaseFiles' worker threads don't wait for each other on its lock.
+    """
+    self.GetFileProperties("type")
+    file_revisions = []
+    for filename in filenames:
+      status = self.PerforceActionToSvnStatus(self.GetAction(filename))
+      if status == "A":
+        continue
+      base_filename = self.GetBaseFilename(filename)
+      revision = self.GetBaseRevision(base_filename)
+      if revision:
+        file_revisions.append((base_filename, revision))
+    self.PrefetchContents(file_revisions)
+
   def GetBaseFile(self, filename):
     base_filename = self.GetBaseFilename(filename)
     base_content = ""
@@ -1791,10 +3739,209 @@ class PerforceVCS(VersionControlSystem):
     
     return base_content, new_content, is_binary, status
 
+class FileDiff(object):
+  """One file's part of a diff, see ParsedDiff.
+
+  All offsets are into the diff's text, so text[start:end] is the file's
+  patch.
+
+  Attributes:
+    filename: The file's name after the change.
+    old_filename: The name before the change; differs for git renames.
+    header: The line that started this part, without its line break.
+    hashes: The (before, after) blob hashes of git's "index" line, or None.
+    added: The number of added lines.
+    removed: The number of removed lines.
+    added_lines: (start, end) of each added line, without its line break.
+    hunks: (start, end) of each "@@" hunk, header line included.
+  """
+
+  def __init__(self, filename, header, start):
+    self.filename = filename
+    self.old_filename = filename
+    self.header = header
+    self.start = start
+    self.end = start
+    self.hashes = None
+    self.added = 0
+    self.removed = 0
+    self.added_lines = []
+    self.hunks = []
+    # Whether the "diff --git" line of this file has been seen.
+    self._git_header_seen = False
+
+  def Shifted(self, delta):
+    """Returns a copy with every offset moved by delta bytes."""
+    shifted = FileDiff(self.filename, self.header, self.start)
+    shifted.__dict__.update(self.__dict__)
+    shifted.start = self.start + delta
+    shifted.end = self.end + delta
+    shifted.added_lines = [(start + delta, end + delta)
+                           for start, end in self.added_lines]
+    shifted.hunks = [(start + delta, end + delta)
+                     for start, end in self.hunks]
+    return shifted
+
+
+class ParsedDiff(object):
+  """The per-file structure of a diff, found in one pass over its text.
+
+  A file's part starts at an svn-style "Index:" line, at a "Property changes
+  on:" line naming another file, or at a "diff --git" line that doesn't
+  belong to the preceding "Index:" line. So raw git diffs parse as well as
+  the svn-style diffs upload.py sends. Added and removed lines are the ones
+  starting with a single "+" or "-" followed by more text.
+  """
+
+  def __init__(self, text, files=None):
+    """Parses text, unless its FileDiffs are given.
+
+    Args:
+      text: The diff.
+      files: The FileDiffs of text, e.g. as built by GitVCS.PostProcessDiff.
+    """
+    self.text = text
+    self.files = files
+    if files is None:
+      self.files = []
+      self._Parse()
+
+  @property
+  def added(self):
+    return sum(file_diff.added for file_diff in self.files)
+
+  @property
+  def removed(self):
+    return sum(file_diff.removed for file_diff in self.files)
+
+  def _Parse(self):
+    current = None
+    hunk_start = None
+    end = 0
+    for line in self.text.splitlines(True):
+      start = end
+      end += len(line)
+      sign = line[:1]
+      if sign == " ":
+        if current is not None:
+          current.end = end
+        continue
+      content = line.rstrip("\r\n")
+      if sign == "+" or sign == "-":
+        if current is not None:
+          current.end = end
+          if len(content) > 1 and content[1] != sign:
+            if sign == "+":
+              current.added += 1
+              current.added_lines.append((start, start + len(content)))
+            else:
+              current.removed += 1
+        continue
+
+      filename = old_filename = None
+      if content.startswith("Index:"):
+        filename = content.split(":", 1)[1].strip()
+      elif content.startswith("Property changes on:"):
+        # When a file is modified, paths use '/' between directories, however
+        # when a property is modified '\' is used on Windows.  Make them the
+        # same otherwise the file shows up twice.
+        name = content.split(":", 1)[1].strip().replace("\\", "/")
+        if current is None or name != current.filename:
+          # File has property changes but no modifications.
+          filename = name
+      elif content.startswith("diff --git "):
+        match = re.match(r"diff --git a/(.*) b/(.*)$", content)
+        if match:
+          if (current is not None and not current._git_header_seen and
+              current.header.startswith("Index:")):
+            current.old_filename = match.group(1)
+            current._git_header_seen = True
+          else:
+            filename, old_filename = match.group(2), match.group(1)
+
+      if filename:
+        if hunk_start is not None:
+          current.hunks.append((hunk_start, current.end))
+          hunk_start = None
+        current = FileDiff(filename, content, start)
+        if old_filename:
+          current.old_filename = old_filename
+          current._git_header_seen = True
+        self.files.append(current)
+      if current is None:
+        continue
+      current.end = end
+      if content.startswith("index "):
+        match = re.match(r"index (\w+)\.\.(\w+)", content)
+        if match:
+          current.hashes = (match.group(1), match.group(2))
+      elif content.startswith("@@"):
+        if hunk_start is not None:
+          current.hunks.append((hunk_start, start))
+        hunk_start = start
+    if hunk_start is not None:
+      current.hunks.append((hunk_start, current.end))
+
+
+# The diff ParseDiff parsed last, so all consumers of one diff share it.
+_last_parsed_diff = ParsedDiff("")
+
+
+def ParseDiff(data):
+  """Returns the ParsedDiff of data, parsing it only if it is a new diff.
+
+  The same diff string is passed to several functions, which call ParseDiff
+  instead of scanning the text themselves.
+  """
+  global _last_parsed_diff
+  parsed = _last_parsed_diff
+  if parsed.text is not data:
+    parsed = _last_parsed_diff = ParsedDiff(data)
+  return parsed
+
+
+def RememberParsedDiff(parsed):
+  """Makes ParseDiff(parsed.text) return parsed without parsing again."""
+  global _last_parsed_diff
+  _last_parsed_diff = parsed
+
+
+class DiffStats(object):
+  """The number of lines a diff adds and removes, in total and per file."""
+
+  def __init__(self):
+    # filename -> (lines added, lines removed)
+    self.files = {}
+    self.added = 0
+    self.removed = 0
+
+  def Add(self, filename, added, removed):
+    """Adds the counts of one file."""
+    old_added, old_removed = self.files.get(filename, (0, 0))
+    self.files[filename] = (old_added + added, old_removed + removed)
+    self.added += added
+    self.removed += removed
+
+  @classmethod
+  def FromParsedDiff(cls, parsed):
+    """Returns the DiffStats counted by a ParsedDiff."""
+    stats = cls()
+    for file_diff in parsed.files:
+      stats.Add(file_diff.filename, file_diff.added, file_diff.removed)
+    return stats
+
+
 # NOTE: The SplitPatch function is duplicated in engine.py, keep them in sync.
 def SplitPatch(data):
   """Splits a patch into separate pieces for each file.
 
+  The pieces are the files of ParseDiff(data). They start at the same lines
+  as before, with one addition: a "diff --git" line that doesn't follow its
+  own "Index:" line now starts a new file. Before, it was part of the
+  preceding file, and a raw git diff, which has no "Index:" lines, didn't
+  split at all. engine.py's copy still splits the old way, but the diffs
+  GenerateDiff sends always have an "Index:" line per file.
+
   Args:
     data: A string containing the output of svn diff.
 
@@ -1802,62 +3949,109 @@ def SplitPatch(data):
     A list of 2-tuple (filename, text) where text is the svn diff output
       pertaining to filename.
   """
-  patches = []
-  filename = None
-  diff = []
-  for line in data.splitlines(True):
-    new_filename = None
-    if line.startswith('Index:'):
-      unused, new_filename = line.split(':', 1)
-      new_filename = new_filename.strip()
-    elif line.startswith('Property changes on:'):
-      unused, temp_filename = line.split(':', 1)
-      # When a file is modified, paths use '/' between directories, however
-      # when a property is modified '\' is used on Windows.  Make them the same
-      # otherwise the file shows up twice.
-      temp_filename = temp_filename.strip().replace('\\', '/')
-      if temp_filename != filename:
-        # File has property changes but no modifications, create a new diff.
-        new_filename = temp_filename
-    if new_filename:
-      if filename and diff:
-        patches.append((filename, ''.join(diff)))
-      filename = new_filename
-      diff = [line]
-      continue
-    if diff is not None:
-      diff.append(line)
-  if filename and diff:
-    patches.append((filename, ''.join(diff)))
-  return patches
+  return [(file_diff.filename, data[file_diff.start:file_diff.end])
+          for file_diff in ParseDiff(data).files]
 
 
-def UploadSeparatePatches(issue, rpc_server, patchset, data, options):
+def UploadSeparatePatches(issue, rpc_server, patchset, data, options,
+                          journal=None):
   """Uploads a separate patch for each file in the diff output.
 
-  Returns a list of [patch_key, filename] for each file.
+  Up to options.upload_threads patches are uploaded at the same time, on
+  threads or with --async_uploads from this one. Patches the UploadJournal
+  journal lists as uploaded are skipped, and each completed upload is
+  recorded in it.
+
+  Returns a list of [patch_key, filename] for each file, in diff order.
   """
   patches = SplitPatch(data)
-  rv = []
-  for patch in patches:
-    if len(patch[1]) > MAX_UPLOAD_SIZE:
-      print ("Not uploading the patch for " + patch[0] +
-             " because the file is too large.")
-      continue
+
+  def PatchRequest(patch):
+    """Returns the (url, body, content_type) uploading one file's patch.
+
+    Patches larger than MAX_UPLOAD_SIZE are uploaded in chunks right away,
+    and their [patch_key, filename] is returned instead, or None if the
+    server doesn't accept chunked uploads.
+    """
     form_fields = [("filename", patch[0])]
     if not options.download_base:
       form_fields.append(("content_upload", "1"))
+    if len(patch[1]) > MAX_UPLOAD_SIZE:
+      print "Uploading patch for %s in chunks" % patch[0]
+      url = "/%d/upload_patch_chunk/%d" % (int(issue), int(patchset))
+      response_body = UploadInChunks(rpc_server, url, form_fields,
+                                     "data.diff", patch[1], options)
+      if response_body is None:
+        print ("Not uploading the patch for " + patch[0] +
+               " because the file is too large.")
+        return None
+      return PatchUploaded(response_body, patch)
     files = [("data", "data.diff", patch[1])]
-    ctype, body = EncodeMultipartFormData(form_fields, files)
+    ctype, body = EncodeMultipartFormDataStream(form_fields, files)
     url = "/%d/upload_patch/%d" % (int(issue), int(patchset))
     print "Uploading patch for " + patch[0]
-    response_body = rpc_server.Send(url, body, content_type=ctype)
+    return url, body, ctype
+
+  def PatchUploaded(response_body, patch):
+    """Checks the response and returns the patch's [patch_key, filename]."""
     lines = response_body.splitlines()
     if not lines or lines[0] != "OK":
       StatusUpdate("  --> %s" % response_body)
       sys.exit(1)
-    rv.append([lines[1], patch[0]])
-  return rv
+    if journal:
+      journal.RecordPatch(patch[0], lines[1])
+    return [lines[1], patch[0]]
+
+  def UploadPatch(patch):
+    """Uploads one file's patch and returns its [patch_key, filename].
+
+    Returns None if the patch is too large and the server doesn't accept
+    chunked uploads.
+    """
+    request = PatchRequest(patch)
+    if not isinstance(request, tuple):
+      return request
+    url, body, ctype = request
+    response_body = rpc_server.Send(url, body, content_type=ctype,
+                                    content_encoding=options.compress)
+    return PatchUploaded(response_body, patch)
+
+  def ResumeOrUploadPatch(patch):
+    patch_key = journal and journal.GetPatchKey(patch[0])
+    if patch_key:
+      return [patch_key, patch[0]]
+    return UploadPatch(patch)
+
+  async_server = GetAsyncRpcServer(rpc_server, options)
+  if async_server is None:
+    uploaded = ParallelMap(ResumeOrUploadPatch, patches,
+                           options.upload_threads)
+    return [patch for patch in uploaded if patch is not None]
+
+  uploaded = [None] * len(patches)
+
+  def Uploaded(future, index):
+    uploaded[index] = PatchUploaded(future.Result(), patches[index])
+
+  for index, patch in enumerate(patches):
+    patch_key = journal and journal.GetPatchKey(patch[0])
+    if patch_key:
+      uploaded[index] = [patch_key, patch[0]]
+      continue
+    request = PatchRequest(patch)
+    if not isinstance(request, tuple):
+      uploaded[index] = request
+      continue
+    url, body, ctype = request
+    future = async_server.SendAsync(url, body, content_type=ctype,
+                                    content_encoding=options.compress)
+    future.AddDoneCallback(lambda future, index=index: Uploaded(future,
+                                                                index))
+  try:
+    async_server.Run()
+  finally:
+    async_server.Close()
+  return [patch for patch in uploaded if patch is not None]
 
 
 def GuessVCSName(options):
@@ -2107,6 +4301,8 @@ def RealMain(argv, data=None):
     logging.getLogger().setLevel(logging.DEBUG)
   elif verbosity >= 2:
     logging.getLogger().setLevel(logging.INFO)
+  if options.rpc_stats:
+    rpc_stats.DumpAtExit(options.rpc_stats)
 
   vcs = GuessVCS(options)
 
@@ -2134,7 +4330,35 @@ def RealMain(argv, data=None):
     print "Rietveld diff start:*****"
     print data
     print "Rietveld diff end:*****"
-  files = vcs.GetBaseFiles(data)
+  journal = UploadJournal(options.server)
+  if options.resume:
+    if not journal.Load():
+      ErrorExit("There is no interrupted upload from %s to resume." %
+                os.getcwd())
+    if not journal.Matches(data):
+      ErrorExit("The diff has changed since the interrupted upload. Upload "
+                "it as a new patch set, without --resume.")
+    issue = journal.entries["issue"]
+    patchset = journal.entries["patchset"]
+    manifest = None
+    if not options.download_base:
+      manifest = BaseFileManifest(options.server, issue)
+    files = vcs.GetBaseFiles(data, manifest)
+    rpc_server = GetRpcServer(options.server,
+                              options.email,
+                              options.host,
+                              options.save_cookies,
+                              options.account_type)
+    StatusUpdate("Resuming the upload of patch set %s of issue %s." %
+                 (patchset, issue))
+    UploadRemaining(vcs, issue, rpc_server, patchset, data, options, files,
+                    journal.entries["patches"],
+                    journal.entries["separate_patches"], manifest, journal)
+    return issue, patchset
+  manifest = None
+  if options.issue and not options.download_base:
+    manifest = BaseFileManifest(options.server, options.issue)
+  files = vcs.GetBaseFiles(data, manifest)
   if verbosity >= 1:
     print "Upload server:", options.server, "(change with -s/--server)"
   if options.issue:
@@ -2192,11 +4416,15 @@ def RealMain(argv, data=None):
   # already exists in an earlier patchset.
   base_hashes = ""
   for file, info in files.iteritems():
-    if not info[0] is None:
+    if info is None:
+      checksum = manifest.Lookup(file, vcs.GetBaseFileKey(file))
+    elif not info[0] is None:
       checksum = md5(info[0]).hexdigest()
-      if base_hashes:
-        base_hashes += "|"
-      base_hashes += checksum + ":" + file
+    else:
+      continue
+    if base_hashes:
+      base_hashes += "|"
+    base_hashes += checksum + ":" + file
   form_fields.append(("base_hashes", base_hashes))
   if options.private:
     if options.issue:
@@ -2219,9 +4447,12 @@ def RealMain(argv, data=None):
   if options.dryrun:
     print "This is only a dry run, exiting now."
     sys.exit(0)
-  ctype, body = EncodeMultipartFormData(form_fields, uploaded_diff_file)
-  response_body = rpc_server.Send("/upload", body, content_type=ctype)
+  ctype, body = EncodeMultipartFormDataStream(form_fields,
+                                              uploaded_diff_file)
+  response_body = rpc_server.Send("/upload", body, content_type=ctype,
+                                  content_encoding=options.compress)
   patchset = None
+  patches = None
   if not options.download_base or not uploaded_diff_file:
     lines = response_body.splitlines()
     if len(lines) >= 2:
@@ -2238,16 +4469,44 @@ def RealMain(argv, data=None):
     sys.exit(0)
   issue = msg[msg.rfind("/")+1:]
 
-  if not uploaded_diff_file:
-    result = UploadSeparatePatches(issue, rpc_server, patchset, data, options)
+  journal.Start(data, issue, patchset, patches, not uploaded_diff_file)
+  UploadRemaining(vcs, issue, rpc_server, patchset, data, options, files,
+                  patches, not uploaded_diff_file, manifest, journal)
+  return issue, patchset
+
+
+def UploadRemaining(vcs, issue, rpc_server, patchset, data, options, files,
+                    patches, separate_patches, manifest, journal):
+  """Uploads the patches and files of a patch set after /upload created it.
+
+  Args:
+    vcs: The VersionControlSystem the diff came from.
+    issue: The issue id, as a string.
+    rpc_server: The AbstractRpcServer to upload to.
+    patchset: The patch set id, as a string.
+    data: The diff.
+    options: The parsed command line options.
+    files: The dictionary returned by vcs.GetBaseFiles.
+    patches: The [patch_key, filename] list returned by /upload, or None.
+    separate_patches: True if the diff is uploaded one patch per file.
+    manifest: The BaseFileManifest used by GetBaseFiles, or None.
+    journal: The UploadJournal recording the progress; deleted when done.
+  """
+  if separate_patches:
+    result = UploadSeparatePatches(issue, rpc_server, patchset, data, options,
+                                   journal)
     if not options.download_base:
       patches = result
 
   if not options.download_base:
-    vcs.UploadBaseFiles(issue, rpc_server, patches, patchset, options, files)
+    vcs.UploadBaseFiles(issue, rpc_server, patches, patchset, options, files,
+                        journal)
+    if not manifest or options.issue != int(issue):
+      manifest = BaseFileManifest(options.server, issue)
+    manifest.Update(vcs, files)
     if options.send_mail:
       rpc_server.Send("/" + issue + "/mail", payload="")
-  return issue, patchset
+  journal.Delete()
 
 
 def main():
@@ -2264,4 +4523,6 @@ def main():
 
 
 if __name__ == "__main__":
+  # async_rpc imports this module as "upload"; don't let it load a copy.
+  sys.modules.setdefault("upload", sys.modules[__name__])
   main()
@@ -0,0 +1,163 @@
+"""Tests for uploading with the asyncore client, --async_uploads."""
+
+import threading
+import unittest
+import urllib2
+
+import testing
+from testing import upload
+
+import async_rpc
+
+
+class AsyncUploadTest(testing.LocalServerTestCase):
+
+  def setUp(self):
+    testing.LocalServerTestCase.setUp(self)
+    self.files = dict(("f%d.txt" % i, "".join("base %d line %d\n" % (i, j)
+                                               for j in range(50)))
+                      for i in range(6))
+    self.Commit(self.files)
+    for filename, content in self.files.items():
+      self.WriteFile(filename, content + "changed\n")
+    self.addCleanup(setattr, upload, "rpc_stats", upload.rpc_stats)
+    upload.rpc_stats = upload.RpcStats()
+    self.runs = []
+    run = async_rpc.AsyncRpcServer.__dict__["Run"]
+    self.addCleanup(setattr, async_rpc.AsyncRpcServer, "Run", run)
+    async_rpc.AsyncRpcServer.Run = (
+        lambda server: self.runs.append(server) or run(server))
+
+  def AsyncUpload(self, *args):
+    return self.Upload("--async_uploads", "--upload_threads", "3", *args)
+
+  def testUploadsBaseFiles(self):
+    self.AsyncUpload("HEAD")
+
+    self.assertEqual(1, len(self.runs))
+    patches = self.Patches()
+    self.assertEqual(sorted(self.files), sorted(patches))
+    for filename, content in self.files.items():
+      self.assertEqual(content, patches[filename]["base"])
+    self.assertEqual(
+        6, self.store.stats["/N/upload_content/P/F"]["requests"])
+    # The async requests are recorded like Send's.
+    summary = upload.rpc_stats.Summary()
+    self.assertEqual(6, summary["POST /N/upload_content/N/N"]["count"])
+    self.assertEqual(0, summary["POST /N/upload_content/N/N"]["errors"])
+
+  def testUploadsSeparatePatchesAndChunks(self):
+    self.addCleanup(setattr, upload, "MAX_UPLOAD_SIZE",
+                    upload.MAX_UPLOAD_SIZE)
+    upload.MAX_UPLOAD_SIZE = 500
+    self.AsyncUpload("HEAD")
+
+    # One event loop for the patches, one for the files.
+    self.assertEqual(2, len(self.runs))
+    patches = self.Patches()
+    for filename, content in self.files.items():
+      self.assertEqual(content, patches[filename]["base"])
+      self.assertTrue("+changed" in patches[filename]["text"])
+    self.assertEqual({}, self.store.chunks)
+
+  def testFailedUploadStopsWithError(self):
+    original = testing.local_server.LocalServerHandler.UploadContent
+
+    def FailOne(handler, body, issue_id, patchset_id, patch_id):
+      if handler.ParseForm(body)["filename"] == "f3.txt":
+        handler.Respond(404, "No such patch")
+        return
+      original(handler, body, issue_id, patchset_id, patch_id)
+
+    self.PatchHandler("UploadContent", FailOne)
+    self.assertRaises(urllib2.HTTPError, self.AsyncUpload, "HEAD")
+
+
+class AsyncRpcServerTest(testing.LocalServerTestCase):
+
+  def setUp(self):
+    testing.LocalServerTestCase.setUp(self)
+    self.rpc_server = upload.GetRpcServer(
+        "localhost:%d" % self.server.server_port, save_cookies=False)
+    self.async_server = async_rpc.AsyncRpcServer(self.rpc_server,
+                                                 max_connections=2)
+    self.addCleanup(self.async_server.Close)
+    self.mails = []
+
+  def testSendsConcurrentRequestsOverFewConnections(self):
+    futures = [self.async_server.SendAsync("/1/mail", "body %d" % i)
+               for i in range(5)]
+    self.async_server.Run()
+    self.assertEqual(["OK"] * 5, [future.Result() for future in futures])
+
+  def testReauthenticatesOnce(self):
+    authentications = []
+    refused = []
+    both_refused = threading.Event()
+    now = [1000.0]
+
+    def Authenticate():
+      authentications.append(True)
+      now[0] += 3.0
+
+    def Mail(handler, body, issue_id):
+      if not authentications:
+        # Answer only once both requests are here, so that both need the
+        # login the first 401 starts.
+        refused.append(body)
+        if len(refused) == 2:
+          both_refused.set()
+        both_refused.wait(5)
+        handler.Respond(401, "Login required")
+      else:
+        handler.Respond(200, "OK")
+
+    self.rpc_server._Authenticate = Authenticate
+    self.rpc_server.retry_policy.clock = lambda: now[0]
+    self.PatchHandler("Mail", Mail)
+    futures = [self.async_server.SendAsync("/1/mail", "body %d" % i)
+               for i in range(2)]
+    self.async_server.Run()
+
+    self.assertEqual(["OK"] * 2, [future.Result() for future in futures])
+    self.assertEqual(2, len(refused))
+    self.assertEqual(1, len(authentications))
+    summary = self.rpc_server.stats.Summary()["POST /N/mail"]
+    self.assertEqual(1, summary["authentications"])
+    self.assertEqual(3.0, summary["auth_seconds"])
+
+  def testDoesNotReplayPostAfterItWasSent(self):
+    self.async_server.Send("/stats")
+    original = testing.local_server.LocalServerHandler.Mail
+
+    def DropFirst(handler, body, issue_id):
+      self.mails.append(body)
+      if len(self.mails) == 1:
+        handler.close_connection = 1
+        return
+      original(handler, body, issue_id)
+
+    self.PatchHandler("Mail", DropFirst)
+    self.assertRaises(urllib2.URLError, self.async_server.Send, "/1/mail",
+                      "body")
+    self.assertEqual(1, len(self.mails))
+
+  def testResendsIdempotentRequestAfterDroppedConnection(self):
+    self.async_server.Send("/stats")
+    stats = testing.local_server.LocalServerHandler.Stats
+    calls = []
+
+    def DropFirst(handler, body):
+      calls.append(body)
+      if len(calls) == 1:
+        handler.close_connection = 1
+        return
+      stats(handler, body)
+
+    self.PatchHandler("Stats", DropFirst)
+    self.assertTrue(self.async_server.Send("/stats").startswith("{"))
+    self.assertEqual(2, len(calls))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,94 @@
+"""Tests for skipping base files already uploaded to an issue."""
+
+import glob
+import json
+import os
+import unittest
+
+import testing
+from testing import upload
+
+
+class BaseFileManifestTest(testing.LocalServerTestCase):
+
+  def setUp(self):
+    testing.LocalServerTestCase.setUp(self)
+    self.Commit({"a.txt": "a base\n", "b.txt": "b base\n"})
+    self.WriteFile("a.txt", "a base\na change\n")
+    self.WriteFile("b.txt", "b base\nb change\n")
+    self.issue, unused = self.Upload("HEAD")
+    self.uploads = []
+    original = testing.local_server.LocalServerHandler.UploadContent
+
+    def RecordUploadContent(handler, body, *args):
+      self.uploads.append(handler.ParseForm(body)["filename"])
+      original(handler, body, *args)
+
+    self.PatchHandler("UploadContent", RecordUploadContent)
+
+  def UploadPatchset(self):
+    """Uploads HEAD as a new patch set; returns its filename -> patch."""
+    unused, patchset = self.Upload("--issue", self.issue, "HEAD")
+    files = self.store.patchsets[int(patchset)]["files"]
+    return dict((filename, self.store.patches[patch_id])
+                for filename, patch_id in files.items())
+
+  def testSkipsUnchangedBaseFiles(self):
+    self.WriteFile("a.txt", "a base\nanother change\n")
+    read = []
+    get_base_file = upload.GitVCS.__dict__["GetBaseFile"]
+    self.addCleanup(setattr, upload.GitVCS, "GetBaseFile", get_base_file)
+    upload.GitVCS.GetBaseFile = (
+        lambda vcs, filename: read.append(filename) or
+        get_base_file(vcs, filename))
+
+    patches = self.UploadPatchset()
+
+    # Neither base file was read again, nor uploaded.
+    self.assertEqual([], read)
+    self.assertEqual([], self.uploads)
+    self.assertEqual("a base\n", patches["a.txt"]["base"])
+    self.assertEqual("b base\n", patches["b.txt"]["base"])
+
+  def testUploadsBaseFileThatChanged(self):
+    self.Git("add", "a.txt")
+    self.Git("commit", "-q", "-m", "New base", "--", "a.txt")
+    self.WriteFile("a.txt", "a base\na change\nand another\n")
+
+    patches = self.UploadPatchset()
+
+    self.assertEqual(["a.txt"], self.uploads)
+    self.assertEqual("a base\na change\n", patches["a.txt"]["base"])
+    self.assertEqual("b base\n", patches["b.txt"]["base"])
+
+  def testUploadsBaseFileWithStaleEntry(self):
+    manifest_path, = glob.glob(os.path.join(
+        self.scratch_dir, ".codereview_base_manifests", "*.json"))
+    manifest_file = open(manifest_path)
+    entries = json.load(manifest_file)
+    manifest_file.close()
+    # The key still matches, but the server has no base with this checksum,
+    # so it must not answer "nobase" and the base has to be read after all.
+    entries["a.txt"]["checksum"] = "0" * 32
+    manifest_file = open(manifest_path, "w")
+    json.dump(entries, manifest_file)
+    manifest_file.close()
+    prefetched = []
+    prefetch = upload.VersionControlSystem.__dict__["PrefetchBaseFiles"]
+    self.addCleanup(setattr, upload.VersionControlSystem,
+                    "PrefetchBaseFiles", prefetch)
+    upload.VersionControlSystem.PrefetchBaseFiles = (
+        lambda vcs, filenames: prefetched.append(filenames))
+
+    patches = self.UploadPatchset()
+
+    # The stale base is prefetched like any other; GetBaseFiles itself had
+    # nothing to read, since the manifest knew both files.
+    self.assertEqual([["a.txt"]], prefetched)
+    self.assertEqual(["a.txt"], self.uploads)
+    self.assertEqual("a base\n", patches["a.txt"]["base"])
+    self.assertEqual("b base\n", patches["b.txt"]["base"])
+
+
+if __name__ == "__main__":
+  unittest.main()
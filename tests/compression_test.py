@@ -0,0 +1,63 @@
+"""Tests for compressing uploads with --compress."""
+
+import unittest
+import zlib
+
+import testing
+from testing import upload
+
+
+class CompressBodyTest(unittest.TestCase):
+
+  def testRoundTrip(self):
+    body = "".join("line %d\n" % i for i in range(10000))
+    gzipped = upload.CompressBody(body, "gzip")
+    self.assertEqual("\x1f\x8b", gzipped[:2])
+    self.assertEqual(body, zlib.decompress(gzipped, 16 + zlib.MAX_WBITS))
+    self.assertEqual(body, zlib.decompress(upload.CompressBody(body,
+                                                               "deflate")))
+
+  def testCompressesStreamedBody(self):
+    unused, body = upload.EncodeMultipartFormDataStream(
+        [("subject", "Test")], [("data", "data.diff", "x" * 200000)])
+    compressed = upload.CompressBody(body, "gzip")
+    body.seek(0)
+    self.assertEqual(body.read(),
+                     zlib.decompress(compressed, 16 + zlib.MAX_WBITS))
+
+  def testRejectsUnknownEncoding(self):
+    self.assertRaises(ValueError, upload.CompressBody, "body", "br")
+
+
+class CompressedUploadTest(testing.LocalServerTestCase):
+
+  def setUp(self):
+    testing.LocalServerTestCase.setUp(self)
+    self.base = "".join("base line %d\n" % i for i in range(2000))
+    self.Commit({"a.txt": self.base})
+    self.WriteFile("a.txt", self.base.replace("line 1", "line one"))
+
+  def CheckUpload(self, encoding):
+    self.Upload("--compress", encoding, "HEAD")
+
+    self.assertEqual(self.base, self.Patches()["a.txt"]["base"])
+    for template in ("/upload", "/N/upload_content/P/F"):
+      counters = self.store.stats[template]
+      self.assertTrue(counters["wire_bytes"] < counters["body_bytes"] / 4,
+                      "%s: %r" % (template, counters))
+
+  def testGzip(self):
+    self.CheckUpload("gzip")
+
+  def testDeflate(self):
+    self.CheckUpload("deflate")
+
+  def testUncompressedByDefault(self):
+    self.Upload("HEAD")
+
+    counters = self.store.stats["/N/upload_content/P/F"]
+    self.assertEqual(counters["body_bytes"], counters["wire_bytes"])
+
+
+if __name__ == "__main__":
+  unittest.main()
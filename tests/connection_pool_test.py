@@ -0,0 +1,131 @@
+"""Tests for reusing keep-alive connections through a ConnectionPool."""
+
+import threading
+import unittest
+import urllib2
+
+import testing
+from testing import upload
+
+
+class FakeConnection(object):
+
+  sock = None
+
+  def __init__(self):
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+  def testReusesIdleConnections(self):
+    pool = upload.ConnectionPool()
+    conn = FakeConnection()
+    pool.Put("key", conn)
+    self.assertEqual((conn, True), pool.Get("key", FakeConnection))
+    new_conn, reused = pool.Get("key", FakeConnection)
+    self.assertFalse(reused)
+    self.assertFalse(new_conn is conn)
+
+  def testClosesConnectionsBeyondMaxIdle(self):
+    pool = upload.ConnectionPool(max_idle_per_host=1)
+    first, second = FakeConnection(), FakeConnection()
+    pool.Put("key", first)
+    pool.Put("key", second)
+    self.assertFalse(first.closed)
+    self.assertTrue(second.closed)
+    pool.CloseAll()
+    self.assertTrue(first.closed)
+
+
+class KeepAliveTest(testing.LocalServerTestCase):
+
+  def setUp(self):
+    testing.LocalServerTestCase.setUp(self)
+    self.rpc_server = upload.GetRpcServer(
+        "localhost:%d" % self.server.server_port, save_cookies=False)
+    self.client_ports = []
+    self.mails = []
+    dispatch = testing.local_server.LocalServerHandler.Dispatch
+
+    def RecordingDispatch(handler, method):
+      self.client_ports.append(handler.client_address[1])
+      dispatch(handler, method)
+
+    self.PatchHandler("Dispatch", RecordingDispatch)
+
+  def CloseAfterResponse(self):
+    """Makes the server close the next connection once it has answered.
+
+    Returns an Event that is set when the server has closed it.
+    """
+    closed = threading.Event()
+    respond = testing.local_server.LocalServerHandler.Respond
+    shutdown_request = self.server.shutdown_request
+
+    def RespondAndClose(handler, *args, **kwargs):
+      respond(handler, *args, **kwargs)
+      if not closed.is_set():
+        handler.close_connection = 1
+
+    def ShutdownAndSignal(request):
+      shutdown_request(request)
+      closed.set()
+
+    self.PatchHandler("Respond", RespondAndClose)
+    self.server.shutdown_request = ShutdownAndSignal
+    return closed
+
+  def testReusesOneConnection(self):
+    for unused in range(3):
+      self.rpc_server.Send("/stats")
+    self.assertEqual(3, len(self.client_ports))
+    self.assertEqual(1, len(set(self.client_ports)))
+
+  def testReconnectsAfterServerClosedIdleConnection(self):
+    closed = self.CloseAfterResponse()
+    self.rpc_server.Send("/stats")
+    closed.wait(5)
+    self.assertEqual("OK", self.rpc_server.Send("/1/mail", "body"))
+    self.assertEqual(2, len(self.client_ports))
+    self.assertNotEqual(self.client_ports[0], self.client_ports[1])
+
+  def testResendsIdempotentRequestWithoutResponse(self):
+    self.rpc_server.Send("/stats")
+    self.DropNextRequest("Stats")
+    self.rpc_server.Send("/stats")
+    self.assertEqual(3, len(self.client_ports))
+    self.assertEqual(2, len(set(self.client_ports)))
+
+  def testDoesNotReplayPostAfterItWasSent(self):
+    self.rpc_server.Send("/stats")
+    self.DropNextRequest("Mail")
+    self.assertRaises(urllib2.URLError, self.rpc_server.Send, "/1/mail",
+                      "body")
+    # The server got the POST once, on the reused connection.
+    self.assertEqual(2, len(self.client_ports))
+    self.assertEqual(1, len(set(self.client_ports)))
+    self.assertEqual(1, len(self.mails))
+
+  def DropNextRequest(self, name):
+    """Makes the server close the connection instead of answering name."""
+    handler_class = testing.local_server.LocalServerHandler
+    original = handler_class.__dict__[name]
+
+    def Drop(handler, body, *args):
+      if name == "Mail":
+        self.mails.append(body)
+      if not getattr(self, "dropped", False):
+        self.dropped = True
+        handler.close_connection = 1
+        return
+      original(handler, body, *args)
+
+    self.PatchHandler(name, Drop)
+
+
+if __name__ == "__main__":
+  unittest.main()
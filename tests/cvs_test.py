@@ -0,0 +1,143 @@
+"""Tests for CVSVCS's statuses and base files, against a fake `cvs`."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import testing
+from testing import upload
+
+# Logs its arguments; prints status.txt for "status" and the file under
+# bases/<revision>/ for "-Q update -p -r <revision> <file>".
+FAKE_CVS = """#!%s
+import json, os, sys
+
+fixture_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+log = open(os.path.join(fixture_dir, "cvs.log"), "a")
+log.write(json.dumps(sys.argv[1:]) + "\\n")
+log.close()
+if sys.argv[1] == "status":
+  sys.stdout.write(open(os.path.join(fixture_dir, "status.txt")).read())
+elif sys.argv[1:5] == ["-Q", "update", "-p", "-r"]:
+  path = os.path.join(fixture_dir, "bases", sys.argv[5], sys.argv[6])
+  sys.stdout.write(open(path, "rb").read())
+else:
+  sys.exit(1)
+"""
+
+# "cvs status" with its stderr, the "Examining" lines, merged in.
+STATUS = """\
+cvs status: Examining .
+===================================================================
+File: a.txt            \tStatus: Locally Modified
+
+   Working revision:\t1.2\tMon Oct 12 10:00:00 2026
+   Repository revision:\t1.2\t/cvsroot/mod/a.txt,v
+   Sticky Tag:\t\t(none)
+
+===================================================================
+File: new.txt          \tStatus: Locally Added
+
+   Working revision:\tNew file!
+   Repository revision:\tNo revision control file
+
+===================================================================
+File: unrelated.txt    \tStatus: Up-to-date
+
+   Working revision:\t1.1\tMon Oct 12 10:00:00 2026
+
+cvs status: Examining sub
+===================================================================
+File: no file gone.txt \tStatus: Locally Removed
+
+   Working revision:\t-1.4\tMon Oct 12 10:00:00 2026
+   Repository revision:\t1.4\t/cvsroot/mod/sub/gone.txt,v
+
+===================================================================
+File: stale.txt        \tStatus: Needs Merge
+
+   Working revision:\t1.1\tMon Oct 12 10:00:00 2026
+   Repository revision:\t1.3\t/cvsroot/mod/sub/stale.txt,v
+
+===================================================================
+File: both.txt         \tStatus: Unresolved Conflict
+
+   Working revision:\t1.5\tMon Oct 12 10:00:00 2026
+"""
+
+BASES = {
+    ("1.2", "a.txt"): "a\r\nbase\r\n",
+    ("1.4", "sub/gone.txt"): "gone\n",
+    ("1.1", "sub/stale.txt"): "stale base\n",
+}
+
+
+class CVSVCSTest(unittest.TestCase):
+
+  def setUp(self):
+    self.fixture_dir = tempfile.mkdtemp(prefix="cr_test_")
+    self.addCleanup(shutil.rmtree, self.fixture_dir)
+    self.WriteFixture("cvs", FAKE_CVS % sys.executable)
+    os.chmod(os.path.join(self.fixture_dir, "cvs"), 0755)
+    self.WriteFixture("status.txt", STATUS)
+    for (revision, filename), content in BASES.items():
+      directory = os.path.dirname(os.path.join(self.fixture_dir, "bases",
+                                               revision, filename))
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      self.WriteFixture(os.path.join("bases", revision, filename), content)
+    old_path = os.environ["PATH"]
+    os.environ["PATH"] = self.fixture_dir + os.pathsep + old_path
+    self.addCleanup(os.environ.__setitem__, "PATH", old_path)
+    options, unused = upload.parser.parse_args([])
+    self.vcs = upload.CVSVCS(options)
+
+  def WriteFixture(self, name, content):
+    fixture_file = open(os.path.join(self.fixture_dir, name), "wb")
+    fixture_file.write(content)
+    fixture_file.close()
+
+  def Calls(self):
+    log_path = os.path.join(self.fixture_dir, "cvs.log")
+    if not os.path.exists(log_path):
+      return []
+    return [json.loads(line) for line in open(log_path)]
+
+  def testReadsStatusesOnceAndEachBase(self):
+    filenames = ["a.txt", "new.txt", "sub/gone.txt", "sub/stale.txt",
+                 "sub/both.txt", "missing.txt"]
+
+    files = self.vcs.ReadBaseFiles(filenames)
+
+    self.assertEqual({
+        "a.txt": ("a\nbase\n", None, False, "M"),
+        "new.txt": ("", None, False, "A"),
+        "sub/gone.txt": ("gone\n", None, False, "D"),
+        # Read at the working revision, not the newer one in the repository.
+        "sub/stale.txt": ("stale base\n", None, False, "M"),
+        # Statuses that don't map, and files cvs didn't report on, are sent
+        # as added.
+        "sub/both.txt": ("", None, False, "A"),
+        "missing.txt": ("", None, False, "A"),
+    }, files)
+    calls = self.Calls()
+    self.assertEqual([["status"] + filenames], calls[:1])
+    self.assertEqual(
+        sorted([["-Q", "update", "-p", "-r", "1.2", "a.txt"],
+                ["-Q", "update", "-p", "-r", "1.4", "sub/gone.txt"],
+                ["-Q", "update", "-p", "-r", "1.1", "sub/stale.txt"]]),
+        sorted(calls[1:]))
+
+  def testGetBaseFileFetchesStatusOnce(self):
+    for unused in range(2):
+      self.assertEqual(("a\nbase\n", None, False, "M"),
+                       self.vcs.GetBaseFile("a.txt"))
+    self.assertEqual([["status", "a.txt"]],
+                     [call for call in self.Calls() if call[0] == "status"])
+
+
+if __name__ == "__main__":
+  unittest.main()
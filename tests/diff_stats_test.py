@@ -0,0 +1,71 @@
+"""Tests for the line counts in the subject line, see GetDiffStats."""
+
+import unittest
+
+import testing
+from testing import upload
+
+
+class GitDiffStatsTest(testing.GitRepoTestCase):
+
+  def setUp(self):
+    testing.GitRepoTestCase.setUp(self)
+    self.Commit({"a.txt": "one\ntwo\nthree\n",
+                 "old.txt": "".join("line %d\n" % i for i in range(20)),
+                 "image.bin": "\0\1\2"})
+    self.WriteFile("a.txt", "one\n2\n2.5\nthree\n")
+    self.Git("mv", "old.txt", "new.txt")
+    self.WriteFile("new.txt", "".join("line %d\n" % i for i in range(19)))
+    self.WriteFile("image.bin", "\0\1\2\3")
+    self.Git("add", "-A")
+    options, unused = upload.parser.parse_args(["--rev", "HEAD"])
+    self.vcs = upload.GitVCS(options)
+    self.addCleanup(self.vcs.blob_reader.Close)
+
+  def testCountsWithNumstat(self):
+    self.vcs.GenerateDiff([])
+    # The diff itself isn't looked at: git counts the lines.
+    stats = self.vcs.GetDiffStats("")
+    self.assertEqual({"a.txt": (2, 1), "new.txt": (0, 1),
+                      "image.bin": (0, 0)}, stats.files)
+    self.assertEqual((2, 2), (stats.added, stats.removed))
+
+  def testCountsForTheSubjectLine(self):
+    self.Commit({"same.txt": "x\ny\n"})
+    self.WriteFile("a.txt", "one\n\n--flag\n+++x\n2\n2.5\nthree\n")
+    self.WriteFile("image.bin", "\0\1\2\3\4")
+    self.Git("mv", "same.txt", "moved.txt")
+    self.Git("add", "-A")
+    diff = self.vcs.PostProcessDiff(self.vcs.GenerateDiff([]))
+
+    stats = self.vcs.GetDiffStats(diff)
+
+    # Every added line counts, a pure rename and a binary change count 0.
+    self.assertEqual((3, 0), stats.files["a.txt"])
+    self.assertEqual((0, 0), stats.files["moved.txt"])
+    self.assertEqual((0, 0), stats.files["image.bin"])
+    self.assertEqual((3, 0), (stats.added, stats.removed))
+    # Counting the parsed diff misses the blank and the "+++x" lines.
+    parsed = upload.DiffStats.FromParsedDiff(upload.ParseDiff(diff))
+    self.assertEqual((1, 0), parsed.files["a.txt"])
+    self.assertEqual((0, 0), parsed.files["moved.txt"])
+    self.assertEqual((0, 0), parsed.files["image.bin"])
+
+  def testCountsParsedDiffWithoutGenerateDiff(self):
+    diff = self.vcs.PostProcessDiff(self.Git(
+        "diff", "--no-ext-diff", "--full-index", "-M", "HEAD"))
+    vcs = upload.GitVCS(self.vcs.options)
+    self.addCleanup(vcs.blob_reader.Close)
+    stats = vcs.GetDiffStats(diff)
+    self.assertEqual({"a.txt": (2, 1), "new.txt": (0, 1),
+                      "image.bin": (0, 0)}, stats.files)
+
+  def testCountsParsedDiffWhenNumstatFails(self):
+    diff = self.vcs.PostProcessDiff(self.vcs.GenerateDiff([]))
+    self.vcs.diff_args = ["no-such-revision"]
+    stats = self.vcs.GetDiffStats(diff)
+    self.assertEqual((2, 2), (stats.added, stats.removed))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,63 @@
+"""Tests for reading git blobs through one `git cat-file --batch`."""
+
+import unittest
+
+import testing
+from testing import upload
+
+
+class GitBlobReaderTest(testing.GitRepoTestCase):
+
+  def setUp(self):
+    testing.GitRepoTestCase.setUp(self)
+    self.Commit({"crlf.txt": "one\r\ntwo\r\n", "binary.bin": "a\0b\n"})
+    self.reader = upload.GitBlobReader()
+    self.addCleanup(self.reader.Close)
+
+  def testReadsExactBytes(self):
+    self.assertEqual("one\r\ntwo\r\n", self.reader.Read("HEAD:crlf.txt"))
+    blob_hash = self.Git("rev-parse", "HEAD:binary.bin").strip()
+    self.assertEqual("a\0b\n", self.reader.Read(blob_hash))
+
+  def testMissingObjectsInTheBatch(self):
+    self.assertEqual(None, self.reader.Read("HEAD:no_such_file"))
+    self.assertEqual(None, self.reader.Read("0" * 40))
+    # The process is still in step with its requests afterwards.
+    self.assertEqual("one\r\ntwo\r\n", self.reader.Read("HEAD:crlf.txt"))
+
+  def testRestartsAfterClose(self):
+    self.assertEqual("a\0b\n", self.reader.Read("HEAD:binary.bin"))
+    self.reader.Close()
+    self.assertEqual("a\0b\n", self.reader.Read("HEAD:binary.bin"))
+
+
+class GitBaseFilesUploadTest(testing.LocalServerTestCase):
+
+  def testUploadsBaseFilesReadFromTheBatch(self):
+    self.Commit({"crlf.txt": "one\r\ntwo\r\n",
+                 "old.txt": "".join("line %d\n" % i for i in range(20))})
+    self.WriteFile("crlf.txt", "one\r\ntwo\r\nthree\r\n")
+    self.Git("mv", "old.txt", "new.txt")
+    self.WriteFile("new.txt", "".join("line %d\n" % i for i in range(21)))
+
+    self.Upload("HEAD")
+
+    patches = self.Patches()
+    # Text files get the newlines of the diff, as with `git show`.
+    self.assertEqual("one\ntwo\n", patches["crlf.txt"]["base"])
+    self.assertEqual("".join("line %d\n" % i for i in range(20)),
+                     patches["new.txt"]["base"])
+
+  def testUploadsBaseOfUnchangedRename(self):
+    self.Commit({"a.txt": "a\n", "old.txt": "same\r\ncontent\r\n"})
+    self.WriteFile("a.txt", "a\nb\n")
+    self.Git("mv", "old.txt", "new.txt")
+
+    self.Upload("HEAD")
+
+    patches = self.Patches()
+    self.assertEqual("same\ncontent\n", patches["new.txt"]["base"])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,79 @@
+"""Tests for HgCommandServer, against a fake `hg serve --cmdserver`."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import testing
+from testing import upload
+
+# Answers runcommand with its arguments, the way the real server frames it.
+FAKE_HG = """#!%s
+import struct, sys
+
+def Write(channel, data):
+  sys.stdout.write(struct.pack(">cI", channel, len(data)) + data)
+  sys.stdout.flush()
+
+Write("o", "capabilities: getencoding runcommand\\nencoding: UTF-8")
+while sys.stdin.readline():
+  length, = struct.unpack(">I", sys.stdin.read(4))
+  Write("o", " ".join(sys.stdin.read(length).split("\\0")))
+  Write("e", "a warning\\n")
+  Write("r", struct.pack(">i", 0))
+"""
+
+# Like hg older than 1.9, which has no command server.
+OLD_HG = """#!/bin/sh
+echo "hg serve: option --cmdserver not recognized" >&2
+exit 255
+"""
+
+
+class HgCommandServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.bin_dir = tempfile.mkdtemp(prefix="cr_test_")
+    self.addCleanup(shutil.rmtree, self.bin_dir)
+    old_path = os.environ["PATH"]
+    os.environ["PATH"] = self.bin_dir + os.pathsep + old_path
+    self.addCleanup(os.environ.__setitem__, "PATH", old_path)
+    self.server = upload.HgCommandServer()
+    self.addCleanup(self.server.Close)
+
+  def WriteHg(self, script):
+    path = os.path.join(self.bin_dir, "hg")
+    hg_file = open(path, "w")
+    hg_file.write(script)
+    hg_file.close()
+    os.chmod(path, 0755)
+
+  def testRunsCommandsAndClosesFilesOnClose(self):
+    self.WriteHg(FAKE_HG % sys.executable)
+    self.assertEqual(("cat -r 1 a.txt", "a warning\n", 0),
+                     self.server.RunCommand(["cat", "-r", "1", "a.txt"]))
+    devnull = self.server._devnull
+    self.server.Close()
+    self.assertTrue(devnull.closed)
+    # It starts again with a new one.
+    self.assertEqual(("status", "a warning\n", 0),
+                     self.server.RunCommand(["status"]))
+    self.assertFalse(self.server._devnull.closed)
+
+  def testUnsupportedCommandServer(self):
+    self.WriteHg(OLD_HG)
+    self.assertEqual(None, self.server.RunCommand(["status"]))
+    self.assertTrue(self.server.unavailable)
+    self.assertEqual(None, self.server._devnull)
+
+  def testNoHg(self):
+    os.environ["PATH"] = self.bin_dir
+    self.assertEqual(None, self.server.RunCommand(["status"]))
+    self.assertTrue(self.server.unavailable)
+    self.assertEqual(None, self.server._devnull)
+
+
+if __name__ == "__main__":
+  unittest.main()
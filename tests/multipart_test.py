@@ -0,0 +1,100 @@
+"""Tests for streaming multipart/form-data request bodies."""
+
+import tempfile
+import unittest
+
+import testing
+from testing import upload
+
+
+class MultipartFormDataTest(unittest.TestCase):
+
+  def setUp(self):
+    self.data_file = tempfile.TemporaryFile()
+    self.addCleanup(self.data_file.close)
+    self.data_file.write("skipped" + "".join(chr(i % 256)
+                                             for i in range(200000)))
+    self.data_file.seek(len("skipped"))
+
+  def Encode(self):
+    return upload.EncodeMultipartFormDataStream(
+        [("subject", u"Caf\xe9"), ("issue", "1")],
+        [("data", "data.bin", self.data_file), ("more", "more.txt", "text")])
+
+  def testMatchesJoinedEncoding(self):
+    unused, body = self.Encode()
+    self.data_file.seek(len("skipped"))
+    content_type, joined = upload.EncodeMultipartFormData(
+        [("subject", u"Caf\xe9"), ("issue", "1")],
+        [("data", "data.bin", self.data_file.read()),
+         ("more", "more.txt", "text")])
+    self.assertTrue(content_type.startswith("multipart/form-data"))
+    self.assertEqual(len(joined), len(body))
+    self.assertEqual(joined, body.read())
+    # The file part is read from where the file was positioned, not from
+    # its start.
+    self.assertTrue("skipped" not in joined)
+
+  def testReadsInBlocksAndRewinds(self):
+    unused, body = self.Encode()
+    whole = body.read()
+    self.assertEqual("", body.read())
+    body.seek(0)
+    blocks = []
+    while True:
+      block = body.read(1000)
+      if not block:
+        break
+      self.assertTrue(len(block) <= 1000)
+      blocks.append(block)
+    self.assertEqual(whole, "".join(blocks))
+    self.assertEqual(whole, "".join(body))
+    self.assertRaises(IOError, body.seek, 10)
+
+  def testFileChangingSizeIsAnError(self):
+    unused, body = self.Encode()
+    self.data_file.truncate(1000)
+    self.assertRaises(IOError, body.read)
+
+
+class StreamedUploadTest(testing.LocalServerTestCase):
+
+  def testStreamsFileToServer(self):
+    self.Commit({"a.txt": "one\n"})
+    self.WriteFile("a.txt", "one\ntwo\n")
+    diff = self.Git("diff", "--no-ext-diff", "--full-index", "HEAD")
+    diff_file = tempfile.TemporaryFile()
+    self.addCleanup(diff_file.close)
+    diff_file.write(diff)
+    diff_file.seek(0)
+    content_type, body = upload.EncodeMultipartFormDataStream(
+        [("subject", "Streamed")], [("data", "data.diff", diff_file)])
+    rpc_server = upload.GetRpcServer(
+        "localhost:%d" % self.server.server_port, save_cookies=False)
+
+    response = rpc_server.Send("/upload", body, content_type=content_type)
+    # Sent again, the body starts over from the beginning of the file.
+    rpc_server.Send("/upload", body, content_type=content_type)
+
+    self.assertTrue(response.startswith("Issue created."))
+    self.assertEqual(2, self.store.stats["/upload"]["requests"])
+    self.assertEqual(2 * len(body), self.store.stats["/upload"]["wire_bytes"])
+    self.assertEqual(["a.txt"] * 2,
+                     [patch["filename"]
+                      for patch in self.store.patches.values()])
+    self.assertEqual(["Streamed"] * 2,
+                     [issue["subject"]
+                      for issue in self.store.issues.values()])
+
+  def testUploadsFilesAcrossBlocks(self):
+    base = "".join("base line %d\n" % i for i in range(20000))
+    self.Commit({"big.txt": base})
+    self.WriteFile("big.txt", base + "one more line\n")
+
+    self.Upload("HEAD")
+
+    self.assertEqual(base, self.Patches()["big.txt"]["base"])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,256 @@
+"""Tests for PerforceVCS's batched p4 calls, against a fake `p4`."""
+
+import marshal
+import os
+import unittest
+
+import testing
+from testing import upload
+
+FILES = [
+    # depot filename, action, type
+    ("//depot/edit.c", "edit", "text"),
+    ("//depot/new.txt", "add", "text"),
+    ("//depot/gone.txt", "delete", "text"),
+    ("//depot/moved.c", "move/add", "text"),
+    ("//depot/orig.c", "move/delete", "text"),
+    ("//depot/img.png", "edit", "binary"),
+]
+
+DEPOT_FILES = sorted(filename for filename, unused, unused in FILES)
+
+
+def Records(*records):
+  """Returns records the way "p4 -G" prints them."""
+  return "".join(marshal.dumps(record) for record in records)
+
+
+def Describe():
+  """Returns the "p4 -G describe" record of the changelist."""
+  record = {"code": "stat", "change": "42", "desc": "Fix things\n"}
+  for index, (filename, action, file_type) in enumerate(FILES):
+    record["depotFile%d" % index] = filename
+    record["action%d" % index] = action
+    record["type%d" % index] = file_type
+  return record
+
+
+class PerforceTestCase(testing.FakeCommandTestCase):
+
+  def setUp(self):
+    testing.FakeCommandTestCase.setUp(self)
+    self.WriteFile("new.txt", "first\nsecond\n")
+    self.WriteFile("img.png", "\x89PNG\r\nnew")
+    self.responses = {
+        "-G login -s": Records({"code": "stat", "User": "alice"}),
+        "-G describe 42": Records(Describe()),
+        "-G -x - fstat -Or < " + " ".join(DEPOT_FILES): Records(
+            {"code": "stat", "depotFile": "//depot/edit.c", "headRev": "3"},
+            {"code": "stat", "depotFile": "//depot/gone.txt",
+             "headRev": "4"},
+            {"code": "stat", "depotFile": "//depot/img.png", "headRev": "3"},
+            {"code": "stat", "depotFile": "//depot/moved.c",
+             "resolveFromFile0": "//depot/orig.c"},
+            {"code": "stat", "depotFile": "//depot/new.txt"},
+            {"code": "stat", "depotFile": "//depot/orig.c", "headRev": "2"}),
+        # Base files: //depot/moved.c's is //depot/orig.c.
+        "-G -x - have < //depot/edit.c //depot/gone.txt //depot/img.png "
+        "//depot/new.txt //depot/orig.c": Records(
+            {"code": "stat", "depotFile": "//depot/edit.c", "haveRev": "3"},
+            {"code": "stat", "depotFile": "//depot/gone.txt",
+             "haveRev": "4"},
+            {"code": "stat", "depotFile": "//depot/img.png", "haveRev": "3"},
+            {"code": "error", "data": "//depot/new.txt - file(s) not on "
+             "client.\n"},
+            {"code": "stat", "depotFile": "//depot/orig.c", "haveRev": "2"}),
+        "-G -x - where < " + " ".join(DEPOT_FILES): Records(*[
+            {"code": "stat", "depotFile": filename,
+             "path": os.path.join(self.work_dir, filename[len("//depot/"):])}
+            for filename in DEPOT_FILES]),
+    }
+
+  def CreateVCS(self):
+    self.FakeCommand("p4", self.responses)
+    options, unused = upload.parser.parse_args(
+        ["--p4_changelist", "42", "--message", "Fix things"])
+    return upload.PerforceVCS(options)
+
+
+class PerforceMetadataTest(PerforceTestCase):
+
+  def testLoadsMetadataWithOneCallPerCommand(self):
+    vcs = self.CreateVCS()
+
+    self.assertEqual("//depot/orig.c", vcs.GetBaseFilename("//depot/moved.c"))
+    self.assertEqual("//depot/edit.c", vcs.GetBaseFilename("//depot/edit.c"))
+    # A new file has no fstat -Or record naming another base.
+    self.assertEqual("//depot/new.txt", vcs.GetBaseFilename("//depot/new.txt"))
+    self.assertEqual("2", vcs.GetBaseRevision("//depot/moved.c"))
+    self.assertEqual("4", vcs.GetBaseRevision("//depot/gone.txt"))
+    self.assertEqual(os.path.join(self.work_dir, "new.txt"),
+                     vcs.GetLocalFilename("//depot/new.txt"))
+    self.assertEqual(sorted(self.responses), sorted(self.Calls("p4")))
+
+  def testFallsBackToOneCallPerFile(self):
+    # Records the bulk calls leave out, or mark as unmapped, are fetched
+    # one file at a time.
+    fstat = "-G -x - fstat -Or < " + " ".join(DEPOT_FILES)
+    self.responses[fstat] = Records(
+        {"code": "stat", "depotFile": "//depot/edit.c", "headRev": "3"})
+    self.responses["-G fstat -Or //depot/moved.c"] = Records(
+        {"code": "stat", "depotFile": "//depot/moved.c",
+         "resolveFromFile0": "//depot/orig.c"})
+    self.responses["-G fstat -Or //depot/new.txt"] = Records(
+        {"code": "stat", "depotFile": "//depot/new.txt"})
+    self.responses["-G -x - have < //depot/edit.c //depot/gone.txt "
+                   "//depot/img.png //depot/new.txt //depot/orig.c"] = (
+                       Records({"code": "stat", "depotFile": "//depot/edit.c",
+                                "haveRev": "3"}))
+    self.responses["-G have //depot/orig.c"] = Records(
+        {"code": "stat", "depotFile": "//depot/orig.c", "haveRev": "2"})
+    self.responses["-G -x - where < " + " ".join(DEPOT_FILES)] = Records(
+        {"code": "stat", "depotFile": "//depot/new.txt", "unmap": "",
+         "path": "/elsewhere/new.txt"})
+    self.responses["-G where //depot/new.txt"] = Records(
+        {"code": "stat", "depotFile": "//depot/new.txt",
+         "path": os.path.join(self.work_dir, "new.txt")})
+    vcs = self.CreateVCS()
+
+    self.assertEqual("//depot/orig.c", vcs.GetBaseFilename("//depot/moved.c"))
+    self.assertEqual("3", vcs.GetBaseRevision("//depot/edit.c"))
+    self.assertEqual("2", vcs.GetBaseRevision("//depot/moved.c"))
+    self.assertEqual(os.path.join(self.work_dir, "new.txt"),
+                     vcs.GetLocalFilename("//depot/new.txt"))
+    calls = self.Calls("p4")
+    self.assertEqual(1, calls.count(fstat))
+    self.assertEqual(sorted(self.responses), sorted(set(calls)))
+
+
+# "p4 diff -du" of the edited files. A removed line and an added line in
+# the first hunk look like file headers. //depot/img.png isn't in it.
+COMBINED_DIFF = """\
+--- //depot/edit.c\t2026/10/01 10:00:00
++++ /ws/edit.c\t2026/10/02 10:00:00
+@@ -1,3 +1,3 @@
+ keep
+--- looks like a header
++++ looks like one too
+ end
+@@ -10 +10 @@
+-old
++new
+==== //depot/moved.c#2 - /ws/moved.c ====
+--- //depot/moved.c\t2026/10/01 10:00:00
++++ /ws/moved.c\t2026/10/02 10:00:00
+@@ -1 +1 @@
+-int x;
++int y;
+"""
+
+
+class PerforceDiffTest(PerforceTestCase):
+
+  def setUp(self):
+    PerforceTestCase.setUp(self)
+    self.responses.update({
+        "-x - diff -du < //depot/edit.c //depot/img.png //depot/moved.c":
+            COMBINED_DIFF,
+        "diff -du //depot/img.png":
+            "==== //depot/img.png#3 - /ws/img.png ====\n",
+        "-G -x - print < //depot/gone.txt": Records(
+            {"code": "stat", "depotFile": "//depot/gone.txt", "rev": "4"},
+            {"code": "text", "data": "gone\r\n"},
+            {"code": "text", "data": "line\n"}),
+    })
+
+  def testSplitsOneDiffForAllEditedFiles(self):
+    vcs = self.CreateVCS()
+
+    patches = dict(upload.SplitPatch(vcs.GenerateDiff([])))
+
+    separator = "=" * 67
+    self.assertEqual(
+        "Index: //depot/edit.c\n" + separator + "\n"
+        "--- //depot/edit.c\t(revision 3)\n"
+        "+++ //depot/edit.c\t(working copy)\n"
+        "@@ -1,3 +1,3 @@\n"
+        " keep\n"
+        "--- looks like a header\n"
+        "+++ looks like one too\n"
+        " end\n"
+        "@@ -10 +10 @@\n"
+        "-old\n"
+        "+new\n", patches["//depot/edit.c"])
+    self.assertEqual(
+        "Index: //depot/moved.c\n" + separator + "\n"
+        "rename from //depot/orig.c\n"
+        "rename to //depot/moved.c\n"
+        "--- //depot/orig.c\t(revision 2)\n"
+        "+++ //depot/moved.c\t(working copy)\n"
+        "@@ -1 +1 @@\n"
+        "-int x;\n"
+        "+int y;\n", patches["//depot/moved.c"])
+    self.assertEqual(
+        "Index: //depot/gone.txt\n" + separator + "\n"
+        "--- //depot/gone.txt\t(revision 4)\n"
+        "+++ //depot/gone.txt\t(working copy)\n"
+        "@@ -1,2 +0,0 @@\n"
+        "-gone\n"
+        "-line\n", patches["//depot/gone.txt"])
+    self.assertEqual(
+        "Index: //depot/new.txt\n" + separator + "\n"
+        "--- //depot/new.txt\t(revision 0)\n"
+        "+++ //depot/new.txt\t(revision 0)\n"
+        "@@ -0,0 +1,2 @@\n"
+        "+first\n"
+        "+second\n", patches["//depot/new.txt"])
+    self.assertEqual(
+        "Index: //depot/img.png\n" + separator + "\n"
+        "--- //depot/img.png\t(revision 3)\n"
+        "+++ //depot/img.png\t(working copy)\n", patches["//depot/img.png"])
+    # The file missing from the combined diff is diffed on its own, after
+    # the deleted files are printed.
+    self.assertEqual(
+        ["-x - diff -du < //depot/edit.c //depot/img.png //depot/moved.c",
+         "-G -x - print < //depot/gone.txt",
+         "diff -du //depot/img.png"], self.Calls("p4")[5:])
+    # The head revision printed is also the base revision.
+    self.assertEqual(("gone\nline\n", None, False, "D"),
+                     vcs.GetBaseFile("//depot/gone.txt"))
+    self.assertEqual(8, len(self.Calls("p4")))
+
+  def testPrintsAllBaseFilesAtOnce(self):
+    # The content of each file follows its "stat" record, in one or more
+    # records. //depot/orig.c#2 can't be printed in bulk, so it is printed
+    # on its own.
+    print_all = ("-G -x - print < //depot/edit.c#3 //depot/gone.txt#4 "
+                 "//depot/img.png#3 //depot/orig.c#2")
+    self.responses[print_all] = Records(
+        {"code": "stat", "depotFile": "//depot/edit.c", "rev": "3"},
+        {"code": "text", "data": "one\r\n"},
+        {"code": "text", "data": "two\n"},
+        {"code": "stat", "depotFile": "//depot/gone.txt", "rev": "4"},
+        {"code": "text", "data": "gone\n"},
+        {"code": "error", "data": "//depot/orig.c#2 - no such file(s).\n"},
+        {"code": "stat", "depotFile": "//depot/img.png", "rev": "3"},
+        {"code": "binary", "data": "\x89PNG\r\nbase"})
+    self.responses["print -q //depot/orig.c#2"] = "int x;\r\n"
+    vcs = self.CreateVCS()
+
+    files = vcs.ReadBaseFiles(["//depot/edit.c", "//depot/new.txt",
+                               "//depot/gone.txt", "//depot/moved.c",
+                               "//depot/img.png"])
+
+    self.assertEqual({
+        "//depot/edit.c": ("one\ntwo\n", None, False, "M"),
+        "//depot/new.txt": ("", None, False, "A"),
+        "//depot/gone.txt": ("gone\n", None, False, "D"),
+        "//depot/moved.c": ("int x;\n", None, False, "M"),
+        "//depot/img.png": ("\x89PNG\r\nbase", "\x89PNG\r\nnew", True, "M"),
+    }, files)
+    self.assertEqual([print_all, "print -q //depot/orig.c#2"],
+                     self.Calls("p4")[5:])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,179 @@
+"""Tests for RetryPolicy, with a fake clock and random source."""
+
+import errno
+import httplib
+import socket
+import StringIO
+import unittest
+import urllib2
+
+import testing
+from testing import upload
+
+
+class FakeClock(object):
+  """A clock that only advances when something sleeps."""
+
+  def __init__(self):
+    self.now = 1000.0
+    self.sleeps = []
+
+  def Time(self):
+    return self.now
+
+  def Sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
+
+class MaxRandom(object):
+  """Always picks the upper end, so the jitter is deterministic."""
+
+  def uniform(self, a, b):
+    return b
+
+
+def HttpError(code, headers=None):
+  header_text = "".join("%s: %s\r\n" % item
+                        for item in (headers or {}).items())
+  return urllib2.HTTPError(
+      "http://server/path", code, "Error",
+      httplib.HTTPMessage(StringIO.StringIO(header_text + "\r\n")), None)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.policy = upload.RetryPolicy(max_tries=4, initial_delay=0.5,
+                                     max_delay=3.0, budget=10.0,
+                                     clock=self.clock.Time,
+                                     sleep=self.clock.Sleep,
+                                     random_source=MaxRandom())
+
+  def testBackoffDoublesUpToMaxDelay(self):
+    self.assertEqual([0.5, 1.0, 2.0, 3.0, 3.0],
+                     [self.policy.Backoff(retries)
+                      for retries in range(1, 6)])
+
+  def testBackoffIsJitteredBelowTheCap(self):
+    calls = []
+
+    class RecordingRandom(object):
+      def uniform(self, a, b):
+        calls.append((a, b))
+        return a
+
+    self.policy.random_source = RecordingRandom()
+    self.assertEqual(0, self.policy.Backoff(3))
+    self.assertEqual([(0, 2.0)], calls)
+
+  def testClassifiesHttpErrors(self):
+    self.assertTrue(self.policy.IsRetryable(HttpError(503), False))
+    self.assertTrue(self.policy.IsRetryable(HttpError(500), True))
+    self.assertFalse(self.policy.IsRetryable(HttpError(500), False))
+    self.assertFalse(self.policy.IsRetryable(HttpError(404), True))
+    self.assertFalse(self.policy.IsRetryable(HttpError(401), True))
+
+  def testClassifiesConnectionErrors(self):
+    def URLError(reason):
+      return urllib2.URLError(reason)
+
+    refused = socket.error(errno.ECONNREFUSED, "Connection refused")
+    reset = socket.error(errno.ECONNRESET, "Connection reset")
+    self.assertTrue(self.policy.IsRetryable(URLError(refused), False))
+    self.assertTrue(self.policy.IsRetryable(URLError(reset), True))
+    self.assertFalse(self.policy.IsRetryable(URLError(reset), False))
+    self.assertTrue(self.policy.IsRetryable(reset, True))
+    timeout = socket.timeout("timed out")
+    self.assertTrue(self.policy.IsRetryable(URLError(timeout), True))
+    self.assertFalse(self.policy.IsRetryable(URLError(timeout), False))
+    bad_status = httplib.BadStatusLine("")
+    self.assertTrue(self.policy.IsRetryable(URLError(bad_status), True))
+    self.assertFalse(self.policy.IsRetryable(URLError(bad_status), False))
+    self.assertFalse(self.policy.IsRetryable(URLError("unknown url type"),
+                                             True))
+    self.assertFalse(self.policy.IsRetryable(ValueError("bug"), True))
+
+  def testNextDelayStopsAfterMaxTries(self):
+    start = self.clock.Time()
+    delays = [self.policy.NextDelay(HttpError(503), False, retries, start)
+              for retries in range(4)]
+    self.assertEqual([0.5, 1.0, 2.0, None], delays)
+
+  def testNextDelayStopsForNonRetryableErrors(self):
+    self.assertEqual(None, self.policy.NextDelay(HttpError(404), True, 0,
+                                                 self.clock.Time()))
+
+  def testNextDelayHonorsRetryAfter(self):
+    error = HttpError(503, {"Retry-After": "5"})
+    self.assertEqual(5, self.policy.NextDelay(error, False, 0,
+                                              self.clock.Time()))
+
+  def testNextDelayStopsWhenBudgetIsUsedUp(self):
+    start = self.clock.Time()
+    self.clock.now += 9.2
+    self.assertEqual(0.5, self.policy.NextDelay(HttpError(503), False, 0,
+                                                start))
+    self.assertEqual(None, self.policy.NextDelay(HttpError(503), False, 1,
+                                                 start))
+
+  def testAttemptsSleepsBetweenAttempts(self):
+    self.assertEqual([0, 1, 2, 3], list(self.policy.Attempts()))
+    self.assertEqual([0.5, 1.0, 2.0], self.clock.sleeps)
+
+  def testAttemptsStopWhenBudgetIsUsedUp(self):
+    attempts = []
+    for attempt in self.policy.Attempts():
+      attempts.append(attempt)
+      self.clock.now += 4.0
+    # After the third attempt, 13.5s have passed.
+    self.assertEqual([0, 1, 2], attempts)
+    self.assertEqual([0.5, 1.0], self.clock.sleeps)
+
+
+class SendRetryTest(testing.LocalServerTestCase):
+
+  def setUp(self):
+    testing.LocalServerTestCase.setUp(self)
+    self.clock = FakeClock()
+    self.rpc_server = upload.GetRpcServer(
+        "localhost:%d" % self.server.server_port, save_cookies=False)
+    self.rpc_server.retry_policy = upload.RetryPolicy(
+        clock=self.clock.Time, sleep=self.clock.Sleep,
+        random_source=MaxRandom())
+    self.requests = []
+
+  def FailFirst(self, count, code):
+    def Mail(handler, body, issue_id):
+      self.requests.append(body)
+      if len(self.requests) <= count:
+        handler.Respond(code, "Try again")
+      else:
+        handler.Respond(200, "OK")
+
+    self.PatchHandler("Mail", Mail)
+
+  def testRetriesOverloadedServer(self):
+    self.FailFirst(2, 503)
+    self.assertEqual("OK", self.rpc_server.Send("/1/mail", "body"))
+    self.assertEqual(3, len(self.requests))
+    self.assertEqual([0.5, 1.0], self.clock.sleeps)
+
+  def testDoesNotRetryFailedPost(self):
+    self.FailFirst(1, 500)
+    self.assertRaises(urllib2.HTTPError, self.rpc_server.Send, "/1/mail",
+                      "body")
+    self.assertEqual(1, len(self.requests))
+    self.assertEqual([], self.clock.sleeps)
+
+  def testRetriesFailedIdempotentPost(self):
+    self.FailFirst(1, 500)
+    self.assertEqual("OK", self.rpc_server.Send("/1/mail", "body",
+                                                idempotent=True))
+    self.assertEqual(2, len(self.requests))
+    self.assertEqual([0.5], self.clock.sleeps)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,69 @@
+"""Tests for authentication in AbstractRpcServer."""
+
+import threading
+import unittest
+
+import testing
+from testing import upload
+
+
+class ReauthenticationTest(testing.LocalServerTestCase):
+
+  def testConcurrentRequestsAuthenticateOnce(self):
+    rpc_server = upload.GetRpcServer(
+        "localhost:%d" % self.server.server_port, save_cookies=False)
+    refused = []
+    all_refused = threading.Event()
+    authentications = []
+
+    def Authenticate():
+      # Only authenticate once every request was refused with the old
+      # cookie, so that all of them need a new one.
+      all_refused.wait(5)
+      authentications.append(threading.current_thread())
+
+    def Stats(handler, body):
+      if not authentications:
+        refused.append(handler.path)
+        if len(refused) == 4:
+          all_refused.set()
+        handler.Respond(401, "Login required")
+      else:
+        handler.Respond(200, "OK")
+
+    rpc_server._Authenticate = Authenticate
+    self.PatchHandler("Stats", Stats)
+
+    results = upload.ParallelMap(lambda i: rpc_server.Send("/stats"),
+                                 range(4), 4)
+
+    self.assertEqual(["OK"] * 4, results)
+    self.assertEqual(4, len(refused))
+    self.assertEqual(1, len(authentications))
+
+  def testEnsureAuthenticatedLogsInOnce(self):
+    rpc_server = upload.GetRpcServer(
+        "localhost:%d" % self.server.server_port, save_cookies=False)
+    authentications = []
+
+    def Authenticate():
+      authentications.append(rpc_server.AuthGeneration())
+      rpc_server.authenticated = True
+
+    rpc_server._Authenticate = Authenticate
+    self.assertFalse(rpc_server.EnsureAuthenticated())
+    rpc_server.authenticated = False
+
+    results = upload.ParallelMap(
+        lambda i: rpc_server.EnsureAuthenticated(), range(4), 4)
+
+    self.assertEqual([True], filter(None, results))
+    self.assertEqual([0], authentications)
+    self.assertEqual(1, rpc_server.AuthGeneration())
+    # A request refused before that authentication needs no new one.
+    self.assertFalse(rpc_server.EnsureAuthenticated(0))
+    self.assertTrue(rpc_server.EnsureAuthenticated(1))
+
+
+if __name__ == "__main__":
+  unittest.main()
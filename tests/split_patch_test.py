@@ -0,0 +1,231 @@
+"""Tests that SplitPatch still splits diffs the way it did before ParseDiff."""
+
+import unittest
+
+import testing
+from testing import upload
+
+
+def BaselineSplitPatch(data):
+  """SplitPatch as it was before it used ParseDiff, for comparison."""
+  patches = []
+  filename = None
+  diff = []
+  for line in data.splitlines(True):
+    new_filename = None
+    if line.startswith('Index:'):
+      unused, new_filename = line.split(':', 1)
+      new_filename = new_filename.strip()
+    elif line.startswith('Property changes on:'):
+      unused, temp_filename = line.split(':', 1)
+      temp_filename = temp_filename.strip().replace('\\', '/')
+      if temp_filename != filename:
+        new_filename = temp_filename
+    if new_filename:
+      if filename and diff:
+        patches.append((filename, ''.join(diff)))
+      filename = new_filename
+      diff = [line]
+      continue
+    if diff is not None:
+      diff.append(line)
+  if filename and diff:
+    patches.append((filename, ''.join(diff)))
+  return patches
+
+
+SVN_DIFF = """\
+Index: src/main.c
+===================================================================
+--- src/main.c\t(revision 10)
++++ src/main.c\t(working copy)
+@@ -1,3 +1,3 @@
+ int main() {
+-  return 1;
++  return 0;
+ }
+\\ No newline at end of file
+
+Property changes on: src/main.c
+___________________________________________________________________
+Added: svn:eol-style
+   + native
+
+Index: docs/logo.png
+===================================================================
+Cannot display: file marked as a binary type.
+svn:mime-type = application/octet-stream
+
+Property changes on: docs/logo.png
+___________________________________________________________________
+Added: svn:mime-type
+## -0,0 +1 ##
++application/octet-stream
+\\ No newline at end of property
+
+Property changes on: tools\\build.sh
+___________________________________________________________________
+Added: svn:executable
+   + *
+
+Index: README\r
+===================================================================\r
+--- README\t(revision 10)\r
++++ README\t(working copy)\r
+@@ -1 +1,2 @@\r
+ Read me.\r
++Please.\r
+"""
+
+# As MercurialVCS.GenerateDiff rewrites the "diff --git" lines.
+HG_DIFF = """\
+Index: lib/old_name.py
+===================================================================
+rename from lib/old.py
+rename to lib/old_name.py
+--- a/lib/old.py
++++ b/lib/old_name.py
+@@ -1,2 +1,2 @@
+ import os
+-import sys
++import re
+Index: data/blob.bin
+===================================================================
+new file mode 100644
+index 0000000000000000000000000000000000000000..6b2aaa7640726588bcd3d57e1de4b1315b7f315e
+GIT binary patch
+literal 4
+Lc${NkU|;|M00aO5
+
+Index: setup.py
+===================================================================
+old mode 100644
+new mode 100755
+Index: notes.txt
+===================================================================
+--- a/notes.txt
++++ b/notes.txt
+@@ -1,1 +1,1 @@
+-note
+\\ No newline at end of file
++note
+"""
+
+# As PerforceVCS.GenerateDiff builds it, with a move, an add and a delete.
+P4_DIFF = """\
+Index: depot/new/path.c
+===================================================================
+rename from depot/old/path.c
+rename to depot/new/path.c
+--- depot/old/path.c\t(revision 3)
++++ depot/new/path.c\t(working copy)
+@@ -1,2 +1,2 @@
+ int x;
+-int y;
++int z;
+Index: depot/added.txt
+===================================================================
+--- depot/added.txt\t(revision 0)
++++ depot/added.txt
+@@ -0,0 +1,2 @@
++first
++second
+Index: depot/image.gif
+===================================================================
+Cannot display: file marked as a binary type.
+Index: depot/deleted.txt
+===================================================================
+--- depot/deleted.txt\t(revision 7)
++++ depot/deleted.txt
+@@ -1 +0,0 @@
+-gone
+\\ No newline at end of file
+"""
+
+
+class SplitPatchTest(unittest.TestCase):
+
+  def CheckSameAsBaseline(self, diff):
+    self.assertEqual(BaselineSplitPatch(diff), upload.SplitPatch(diff))
+
+  def testSvnDiff(self):
+    self.CheckSameAsBaseline(SVN_DIFF)
+    self.assertEqual(["src/main.c", "docs/logo.png", "tools/build.sh",
+                      "README"],
+                     [filename for filename, unused in
+                      upload.SplitPatch(SVN_DIFF)])
+
+  def testMercurialDiff(self):
+    self.CheckSameAsBaseline(HG_DIFF)
+
+  def testPerforceDiff(self):
+    self.CheckSameAsBaseline(P4_DIFF)
+
+  def testBareGitHeaderStartsNewFile(self):
+    # "Index:" followed by its own "diff --git" line is one file, as before.
+    # A "diff --git" line without an "Index:" line used to be part of the
+    # preceding file; it now starts a file of its own.
+    diff = ("Index: a.txt\n"
+            "diff --git a/a.txt b/a.txt\n"
+            "--- a/a.txt\n"
+            "+++ b/a.txt\n"
+            "@@ -1 +1 @@\n"
+            "-a\n"
+            "+A\n"
+            "diff --git a/b.txt b/b.txt\n"
+            "--- a/b.txt\n"
+            "+++ b/b.txt\n"
+            "@@ -1 +1 @@\n"
+            "-b\n"
+            "+B\n")
+    self.assertEqual([("a.txt", diff)], BaselineSplitPatch(diff))
+    split = diff.index("diff --git a/b.txt")
+    self.assertEqual([("a.txt", diff[:split]), ("b.txt", diff[split:])],
+                     upload.SplitPatch(diff))
+
+
+class GitSplitPatchTest(testing.GitRepoTestCase):
+
+  def setUp(self):
+    testing.GitRepoTestCase.setUp(self)
+    self.Commit({"a.txt": "one\ntwo\n",
+                 "old.txt": "".join("line %d\n" % i for i in range(20)),
+                 "image.bin": "\0\1\2"})
+    self.WriteFile("a.txt", "one\n2")
+    self.Git("mv", "old.txt", "new.txt")
+    self.WriteFile("new.txt", "".join("line %d\n" % i for i in range(19)))
+    self.WriteFile("image.bin", "\0\1\2\3")
+    self.Git("add", "-A")
+    self.raw_diff = self.Git("diff", "--no-ext-diff", "--full-index", "-M",
+                             "HEAD")
+    options, unused = upload.parser.parse_args([])
+    self.vcs = upload.GitVCS(options)
+    self.addCleanup(self.vcs.blob_reader.Close)
+
+  def testAfterPostProcessDiff(self):
+    diff = self.vcs.PostProcessDiff(self.raw_diff)
+    # PostProcessDiff hands its own FileDiffs to SplitPatch; a new parse of
+    # a copy of the text splits the same way.
+    copy = "".join(diff)
+    self.assertFalse(copy is diff)
+    self.assertEqual(BaselineSplitPatch(diff), upload.SplitPatch(diff))
+    self.assertEqual(BaselineSplitPatch(diff), upload.SplitPatch(copy))
+    self.assertEqual(["a.txt", "image.bin", "new.txt"],
+                     [filename for filename, unused in
+                      upload.SplitPatch(diff)])
+
+  def testBeforePostProcessDiff(self):
+    # With no "Index:" lines the baseline found no files at all; now the
+    # raw diff splits at its "diff --git" lines.
+    self.assertEqual([], BaselineSplitPatch(self.raw_diff))
+    patches = upload.SplitPatch(self.raw_diff)
+    self.assertEqual(["a.txt", "image.bin", "new.txt"],
+                     [filename for filename, unused in patches])
+    self.assertEqual(self.raw_diff, "".join(text for unused, text in patches))
+    self.assertTrue("\\ No newline at end of file" in patches[0][1])
+    self.assertTrue("Binary files" in patches[1][1])
+    self.assertTrue("rename from old.txt" in patches[2][1])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,61 @@
+"""Tests for SubversionVCS's statuses over --rev, against a fake `svn`."""
+
+import unittest
+
+import testing
+from testing import upload
+
+INFO = "Path: .\nURL: http://svn.example.com/repo/trunk\nRevision: 7\n"
+
+SUMMARY_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<diff>
+<paths>
+<path item="modified" props="none" kind="file"
+>http://svn.example.com/repo/trunk/a.txt</path>
+<path item="added" props="none" kind="file">sub/new.txt</path>
+<path item="deleted" props="none" kind="file"
+>http://svn.example.com/repo/trunk/gone.txt</path>
+<path item="none" props="modified" kind="file">props.txt</path>
+</paths>
+</diff>
+"""
+
+
+class SubversionRevisionRangeStatusTest(testing.FakeCommandTestCase):
+
+  def GetStatuses(self, responses, filenames):
+    responses["info"] = INFO
+    self.FakeCommand("svn", responses)
+    options, unused = upload.parser.parse_args(["--rev", "5:7"])
+    vcs = upload.SubversionVCS(options)
+    return [vcs.GetStatus(filename) for filename in filenames]
+
+  def testOneSummaryForAllFiles(self):
+    statuses = self.GetStatuses({
+        "diff --summarize --xml -r 5:7": SUMMARY_XML,
+        "list -r 5 other": "x.txt\n",
+        "list -r 7 other": "x.txt\ny.txt\n",
+    }, ["a.txt", "sub/new.txt", "gone.txt", "props.txt", "other/x.txt",
+        "other/y.txt"])
+
+    self.assertEqual(["M   ", "A   ", "D   ", "M   ", "M   ", "A   "],
+                     statuses)
+    # The files the summary doesn't list cost one listing per directory.
+    self.assertEqual(["info", "diff --summarize --xml -r 5:7",
+                      "list -r 5 other", "list -r 7 other"],
+                     self.Calls("svn"))
+
+  def testListsDirectoriesWhenSummaryFails(self):
+    statuses = self.GetStatuses({
+        "diff --summarize --xml -r 5:7": ("", 1),
+        "list -r 5 .": "a.txt\ngone.txt\n",
+        "list -r 7 .": "a.txt\nb.txt\n",
+    }, ["a.txt", "b.txt", "gone.txt"])
+
+    self.assertEqual(["M   ", "A   ", "D   "], statuses)
+    self.assertEqual(["info", "diff --summarize --xml -r 5:7",
+                      "list -r 5 .", "list -r 7 ."], self.Calls("svn"))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,145 @@
+"""Tests for SubversionVCS's bulk base file reads, against a fake `svn`."""
+
+import unittest
+
+import testing
+from testing import upload
+
+INFO = "Path: .\nURL: http://svn.example.com/repo/trunk\nRevision: 7\n"
+
+FILENAMES = ["a.txt", "logo.png", "data.bin", "new.txt", "new.png",
+             "copied.txt", "gone.txt", "props.txt"]
+
+STATUS_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<status>
+<target path="a.txt">
+<entry path="a.txt"><wc-status item="modified" props="none" revision="5"/>
+</entry>
+<entry path="logo.png"><wc-status item="modified" props="none" revision="5"/>
+</entry>
+<entry path="data.bin"><wc-status item="modified" props="none" revision="5"/>
+</entry>
+<entry path="new.txt"><wc-status item="added" props="none" revision="0"/>
+</entry>
+<entry path="new.png"><wc-status item="added" props="modified" revision="0"/>
+</entry>
+<entry path="copied.txt"><wc-status item="added" props="none" copied="true"
+revision="-1"/></entry>
+<entry path="gone.txt"><wc-status item="deleted" props="none" revision="5"/>
+</entry>
+<entry path="props.txt"><wc-status item="normal" props="modified"
+revision="5"/></entry>
+</target>
+</status>
+"""
+
+WORKING_PROPS_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<properties>
+<target path="new.png">
+<property name="svn:mime-type">image/png</property>
+</target>
+</properties>
+"""
+
+BASE_PROPS_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<properties>
+<target path="a.txt">
+<property name="svn:keywords">Id</property>
+</target>
+<target path="logo.png">
+<property name="svn:mime-type">image/png</property>
+</target>
+<target path="data.bin">
+<property name="svn:mime-type">application/octet-stream</property>
+</target>
+</properties>
+"""
+
+CATS = {
+    "cat a.txt": "$Id: a.txt 5 2026-10-01 alice $\nold\n",
+    "cat logo.png": "\x89PNG\r\nbase",
+    "cat copied.txt": "copied base\n",
+    "cat gone.txt": "gone base\n",
+}
+
+
+class SubversionPrefetchTest(testing.FakeCommandTestCase):
+
+  def setUp(self):
+    testing.FakeCommandTestCase.setUp(self)
+    self.WriteFile("logo.png", "\x89PNG\r\nnew")
+    self.WriteFile("new.png", "png new")
+    self.responses = {
+        "info": INFO,
+        "status --xml --ignore-externals " + " ".join(FILENAMES):
+            STATUS_XML,
+        "proplist --xml --verbose new.txt new.png": WORKING_PROPS_XML,
+        "proplist --xml --verbose -r BASE a.txt logo.png data.bin "
+        "copied.txt gone.txt props.txt": BASE_PROPS_XML,
+    }
+    self.responses.update(CATS)
+
+  def ReadBaseFiles(self):
+    self.FakeCommand("svn", self.responses)
+    options, unused = upload.parser.parse_args([])
+    return upload.SubversionVCS(options).ReadBaseFiles(FILENAMES)
+
+  def testReadsEverythingInBulk(self):
+    files = self.ReadBaseFiles()
+
+    self.assertEqual({
+        "a.txt": ("$Id$\nold\n", None, False, "M    "),
+        "logo.png": ("\x89PNG\r\nbase", "\x89PNG\r\nnew", True, "M    "),
+        "data.bin": ("", None, True, "M    "),
+        "new.txt": ("", None, False, "A    "),
+        "new.png": ("", "png new", True, "AM   "),
+        "copied.txt": ("copied base\n", None, False, "A  + "),
+        "gone.txt": ("gone base\n", None, False, "D    "),
+        "props.txt": ("", None, False, " M   "),
+    }, files)
+    calls = self.Calls("svn")
+    # Only "svn cat" runs per file, and only for files with a text or image
+    # base.
+    self.assertEqual(sorted(self.responses), sorted(calls))
+
+  def testFallsBackToPropgetWhenProplistFails(self):
+    self.responses["proplist --xml --verbose -r BASE a.txt logo.png "
+                   "data.bin copied.txt gone.txt props.txt"] = ("", 1)
+    for filename in ("a.txt", "copied.txt", "gone.txt", "props.txt"):
+      self.responses["-r BASE propget svn:mime-type " + filename] = ""
+    self.responses["-r BASE propget svn:keywords a.txt"] = "Id"
+    for filename in ("copied.txt", "gone.txt"):
+      self.responses["-r BASE propget svn:keywords " + filename] = ""
+    self.responses["-r BASE propget svn:mime-type logo.png"] = "image/png"
+    self.responses["-r BASE propget svn:mime-type data.bin"] = (
+        "application/octet-stream")
+
+    files = self.ReadBaseFiles()
+
+    self.assertEqual(("$Id$\nold\n", None, False, "M    "), files["a.txt"])
+    self.assertEqual(("\x89PNG\r\nbase", "\x89PNG\r\nnew", True, "M    "),
+                     files["logo.png"])
+    self.assertEqual(("", None, True, "M    "), files["data.bin"])
+    self.assertEqual(("", "png new", True, "AM   "), files["new.png"])
+
+  def testFallsBackToStatusPerFileWhenXmlStatusFails(self):
+    self.responses = {
+        "info": INFO,
+        "status --xml --ignore-externals a.txt": ("", 1),
+        # In a changelist, the status follows a header.
+        "status --ignore-externals a.txt":
+            "\n--- Changelist 'work':\nM       a.txt\n",
+        "-r BASE propget svn:mime-type a.txt": "",
+        "-r BASE propget svn:keywords a.txt": "",
+        "cat a.txt": "old\n",
+    }
+    self.FakeCommand("svn", self.responses)
+    options, unused = upload.parser.parse_args([])
+
+    files = upload.SubversionVCS(options).ReadBaseFiles(["a.txt"])
+
+    self.assertEqual({"a.txt": ("old\n", None, False, "M    ")}, files)
+
+
+if __name__ == "__main__":
+  unittest.main()
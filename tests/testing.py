@@ -0,0 +1,195 @@
+"""Shared fixtures for the tests: a scratch git repository and a server.
+
+The tests drive upload.py end to end against bin/local_server.py, so they
+need git but no network. Other VCSs are replaced by fake commands with
+canned output. Run them from the top of the tree with:
+  python -m unittest discover -s tests -p "*_test.py"
+"""
+
+import base64
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "bin")
+if BIN_DIR not in sys.path:
+  sys.path.insert(0, BIN_DIR)
+
+import local_server
+import upload
+
+
+class GitRepoTestCase(unittest.TestCase):
+  """Runs each test in a new git repository.
+
+  HOME points into the test's scratch directory as well, so journals,
+  manifests and cookies never touch the user's own.
+  """
+
+  def setUp(self):
+    self.scratch_dir = tempfile.mkdtemp(prefix="cr_test_")
+    self.addCleanup(shutil.rmtree, self.scratch_dir)
+    old_home = os.environ.get("HOME")
+    os.environ["HOME"] = self.scratch_dir
+    self.addCleanup(os.environ.__setitem__, "HOME", old_home)
+    self.addCleanup(os.chdir, os.getcwd())
+    self.repo_dir = os.path.join(self.scratch_dir, "repo")
+    os.mkdir(self.repo_dir)
+    os.chdir(self.repo_dir)
+    self.Git("init", "-q")
+
+  def Git(self, *args):
+    """Runs a git command in the repository and returns its output."""
+    return subprocess.check_output(
+        ["git", "-c", "user.name=Test", "-c", "user.email=test@example.com"] +
+        list(args))
+
+  def WriteFile(self, filename, content):
+    content_file = open(os.path.join(self.repo_dir, filename), "wb")
+    try:
+      content_file.write(content)
+    finally:
+      content_file.close()
+
+  def Commit(self, files):
+    """Writes files, a dict of filename -> content, and commits them."""
+    for filename, content in files.items():
+      self.WriteFile(filename, content)
+    self.Git("add", "-A")
+    self.Git("commit", "-q", "-m", "Test commit")
+
+
+# Answers each call with the output FakeCommand was given for it, and logs
+# the call. The calls and outputs are in <command>.json next to it.
+FAKE_COMMAND = """#!%s
+import base64, json, os, sys
+
+path = os.path.abspath(sys.argv[0])
+call = " ".join(sys.argv[1:])
+args = sys.argv[1:]
+if "-x" in args and args[args.index("-x") + 1:][:1] == ["-"]:
+  call += " < " + " ".join(sys.stdin.read().splitlines())
+log = open(path + ".log", "a")
+log.write(call + "\\n")
+log.close()
+responses = json.load(open(path + ".json"))
+if call not in responses:
+  sys.stderr.write("unexpected call: %%s\\n" %% call)
+  sys.exit(1)
+output, returncode = responses[call]
+sys.stdout.write(base64.b64decode(output))
+sys.exit(returncode)
+"""
+
+
+class FakeCommandTestCase(unittest.TestCase):
+  """Runs each test in a scratch directory, with fake commands on PATH."""
+
+  def setUp(self):
+    self.scratch_dir = tempfile.mkdtemp(prefix="cr_test_")
+    self.addCleanup(shutil.rmtree, self.scratch_dir)
+    self.fake_dir = os.path.join(self.scratch_dir, "bin")
+    os.mkdir(self.fake_dir)
+    old_path = os.environ["PATH"]
+    os.environ["PATH"] = self.fake_dir + os.pathsep + old_path
+    self.addCleanup(os.environ.__setitem__, "PATH", old_path)
+    self.addCleanup(os.chdir, os.getcwd())
+    self.work_dir = os.path.join(self.scratch_dir, "work")
+    os.mkdir(self.work_dir)
+    os.chdir(self.work_dir)
+
+  def FakeCommand(self, name, responses):
+    """Puts a command on PATH that answers calls from responses.
+
+    Args:
+      name: The command, e.g. "svn".
+      responses: A dict of call -> output, or (output, return code). A call
+        is the arguments joined by spaces. For "-x -", " < " and the lines
+        the command reads from stdin, joined by spaces, are appended. Other
+        calls fail.
+    """
+    path = os.path.join(self.fake_dir, name)
+    encoded = {}
+    for call, response in responses.items():
+      if not isinstance(response, tuple):
+        response = (response, 0)
+      encoded[call] = (base64.b64encode(response[0]), response[1])
+    json_file = open(path + ".json", "w")
+    json.dump(encoded, json_file)
+    json_file.close()
+    script = open(path, "w")
+    script.write(FAKE_COMMAND % sys.executable)
+    script.close()
+    os.chmod(path, 0755)
+
+  def Calls(self, name):
+    """Returns the calls the fake command name got, in order."""
+    log_path = os.path.join(self.fake_dir, name + ".log")
+    if not os.path.exists(log_path):
+      return []
+    log_file = open(log_path)
+    try:
+      return log_file.read().splitlines()
+    finally:
+      log_file.close()
+
+  def WriteFile(self, filename, content):
+    content_file = open(os.path.join(self.work_dir, filename), "wb")
+    try:
+      content_file.write(content)
+    finally:
+      content_file.close()
+
+
+class LocalServerTestCase(GitRepoTestCase):
+  """A GitRepoTestCase with a LocalServer running for each test."""
+
+  def setUp(self):
+    GitRepoTestCase.setUp(self)
+    self.server = local_server.LocalServer(("localhost", 0))
+    self.store = self.server.store
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    # Close the client's keep-alive connections after each test, so that
+    # no handler thread is left waiting for another request.
+    pools = []
+    original_pool_class = upload.ConnectionPool
+
+    class RecordingConnectionPool(original_pool_class):
+      def __init__(pool):
+        original_pool_class.__init__(pool)
+        pools.append(pool)
+
+    upload.ConnectionPool = RecordingConnectionPool
+    self.addCleanup(setattr, upload, "ConnectionPool", original_pool_class)
+    self.addCleanup(lambda: [pool.CloseAll() for pool in pools])
+
+  def PatchHandler(self, name, replacement):
+    """Replaces a LocalServerHandler method for the rest of the test."""
+    handler_class = local_server.LocalServerHandler
+    self.addCleanup(setattr, handler_class, name,
+                    handler_class.__dict__[name])
+    setattr(handler_class, name, replacement)
+
+  def Upload(self, *args):
+    """Runs upload.py against the local server; returns RealMain's result."""
+    return upload.RealMain(["upload.py", "--quiet",
+                            "--server",
+                            "localhost:%d" % self.server.server_port,
+                            "--email", "test@example.com",
+                            "--message", "Test upload",
+                            "--upload_threads", "1"] + list(args))
+
+  def Patches(self):
+    """Returns filename -> patch dict of the store's patches."""
+    return dict((patch["filename"], patch)
+                for patch in self.store.patches.values())
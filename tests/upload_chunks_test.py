@@ -0,0 +1,43 @@
+"""Tests for uploading patches and files in chunks of MAX_UPLOAD_SIZE."""
+
+import unittest
+
+import testing
+from testing import upload
+
+
+class ChunkedUploadTest(testing.LocalServerTestCase):
+
+  def setUp(self):
+    testing.LocalServerTestCase.setUp(self)
+    self.addCleanup(setattr, upload, "MAX_UPLOAD_SIZE",
+                    upload.MAX_UPLOAD_SIZE)
+    upload.MAX_UPLOAD_SIZE = 1000
+
+  def testChunksAreReassembled(self):
+    base = "".join("line %d of the base file\n" % i for i in range(200))
+    self.Commit({"big.txt": base, "small.txt": "small\n"})
+    self.WriteFile("big.txt", base.replace("base", "new"))
+    self.WriteFile("small.txt", "still small\n")
+
+    self.Upload("HEAD")
+
+    patches = self.Patches()
+    self.assertEqual(base, patches["big.txt"]["base"])
+    self.assertTrue(len(patches["big.txt"]["text"]) > upload.MAX_UPLOAD_SIZE)
+    self.assertEqual("small\n", patches["small.txt"]["base"])
+    stats = self.store.stats
+    content_chunks = [counters["requests"]
+                      for template, counters in stats.items()
+                      if "upload_content_chunk" in template]
+    patch_chunks = [counters["requests"]
+                    for template, counters in stats.items()
+                    if "upload_patch_chunk" in template]
+    self.assertEqual([(len(base) + 999) // 1000], content_chunks)
+    self.assertTrue(patch_chunks and patch_chunks[0] > 1)
+    # Nothing was left half assembled.
+    self.assertEqual({}, self.store.chunks)
+
+
+if __name__ == "__main__":
+  unittest.main()
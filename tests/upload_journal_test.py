@@ -0,0 +1,56 @@
+"""Tests for resuming an interrupted upload with --resume."""
+
+import os
+import unittest
+import urllib2
+
+import testing
+
+
+class ResumeTest(testing.LocalServerTestCase):
+
+  def setUp(self):
+    testing.LocalServerTestCase.setUp(self)
+    self.Commit(dict(("f%d.txt" % i, "base %d\n" % i) for i in range(3)))
+    for i in range(3):
+      self.WriteFile("f%d.txt" % i, "base %d\nchanged\n" % i)
+
+  def testResumeAfterInterruptedUpload(self):
+    uploads = []
+    original = testing.local_server.LocalServerHandler.UploadContent
+
+    def FailSecondUpload(handler, body, *args):
+      uploads.append(args)
+      if len(uploads) == 2:
+        handler.Respond(400, "Interrupted")
+        return
+      original(handler, body, *args)
+
+    self.PatchHandler("UploadContent", FailSecondUpload)
+    self.assertRaises(urllib2.HTTPError, self.Upload, "HEAD")
+    journal_dir = os.path.join(self.scratch_dir,
+                               ".codereview_upload_journals")
+    self.assertEqual(1, len(os.listdir(journal_dir)))
+
+    issue, patchset = self.Upload("--resume", "HEAD")
+
+    self.assertEqual(self.store.issues.keys(), [int(issue)])
+    self.assertEqual(self.store.patchsets.keys(), [int(patchset)])
+    # Only the failed base file and the one after it are sent again.
+    self.assertEqual(4, len(uploads))
+    patches = self.Patches()
+    self.assertEqual(["f0.txt", "f1.txt", "f2.txt"], sorted(patches))
+    for i in range(3):
+      self.assertEqual("base %d\n" % i, patches["f%d.txt" % i]["base"])
+    self.assertEqual([], os.listdir(journal_dir))
+
+  def testResumeRefusesChangedDiff(self):
+    self.PatchHandler("UploadContent",
+                      lambda handler, body, *args: handler.Respond(400, "No"))
+    self.assertRaises(urllib2.HTTPError, self.Upload, "HEAD")
+    self.WriteFile("f0.txt", "edited after the interruption\n")
+    self.assertRaises(SystemExit, self.Upload, "--resume", "HEAD")
+
+
+if __name__ == "__main__":
+  unittest.main()